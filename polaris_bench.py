@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import os
+import getopt
+import asyncio
+import functools
+import json
+import platform
+import random
+import struct
+import time
+from datetime import datetime
+from datetime import timezone
+from math import pi, asin, cos, hypot, degrees, radians
+
+# https://rhodesmill.org/pyephem
+import ephem
+
+import polaris_stellarium as polaris
+import polaris_simulator
+import stellarium_core
+from stellarium_core import STELLARIUM_RA_UNIT, STELLARIUM_DEC_UNIT, dms2dec
+
+####### Globals
+
+lat = 44.5
+lon = 4.42
+
+count = 10000
+goto_count = 50
+parser_count = 200000
+simulator_speed = 90.0
+simulator_accel = 180.0
+
+
+####### Transform
+
+def legacy_radec_to_azalt(ra, dec, t):
+    """
+    legacy_radec_to_azalt is the conversion done on each Stellarium goto before
+    the CoordinateTransform engine: a new ephem observer and body per packet, with
+    every angle going through dec2dms strings.
+
+    :param ra: J2000 right ascension in hours
+    :param dec: J2000 declination in degrees
+    :param t: UTC unix timestamp in seconds
+    """
+    observer = ephem.Observer()
+    observer.long = polaris.dec2dms(lon)
+    observer.lat = polaris.dec2dms(lat)
+    observer.elevation = 0
+    observer.pressure = 0 # no refraction correction.
+    observer.epoch = ephem.J2000
+    observer.date = ephem.Date(datetime.fromtimestamp(t, tz=timezone.utc))
+
+    target = ephem.FixedBody()
+    target._ra = polaris.dec2dms(ra)
+    target._dec = polaris.dec2dms(dec)
+    target._epoch = ephem.J2000
+    target.compute(observer)
+    return (dms2dec(str(target.az)), dms2dec(str(target.alt)))
+
+
+def reference_radec_to_azalt(ra, dec, t):
+    """
+    reference_radec_to_azalt is the ephem conversion without the dec2dms round trip,
+    which loses the sign of the declinations between -1° and 0°.
+    """
+    observer = ephem.Observer()
+    observer.long = radians(lon)
+    observer.lat = radians(lat)
+    observer.elevation = 0
+    observer.pressure = 0
+    observer.epoch = ephem.J2000
+    observer.date = ephem.Date(datetime.fromtimestamp(t, tz=timezone.utc))
+
+    target = ephem.FixedBody()
+    target._ra = ra
+    target._dec = dec
+    target._epoch = ephem.J2000
+    target.compute(observer)
+    return (float(target.az), float(target.alt))
+
+
+def random_targets(n, t0, span=8 * 3600):
+    """
+    random_targets returns n (ra, dec, t) J2000 targets in radians above the horizon,
+    legacy_radec_to_azalt can't parse negative altitudes.
+    """
+    transform = polaris.site_transform(lat, lon)
+    targets = []
+    while len(targets) < n:
+        t = t0 + random.uniform(0, span)
+        ra = random.uniform(0, 2 * pi)
+        dec = asin(random.uniform(-1, 1))
+        if transform.radec_to_azalt(ra, dec, t)[1] > radians(1):
+            targets.append((ra, dec, t))
+    return targets
+
+
+def max_difference(azalt, references):
+    """
+    max_difference returns the largest angle in arc seconds between the (az, alt)
+    pairs of azalt and references, all in radians.
+    """
+    error = 0
+    for ((az, alt), (ref_az, ref_alt)) in zip(azalt, references):
+        daz = (az - ref_az + pi) % (2 * pi) - pi
+        error = max(error, degrees(hypot(daz * cos(alt), alt - ref_alt)) * 3600)
+    return error
+
+
+def bench_transform(n):
+    random.seed(0)
+    targets = random_targets(n, time.time())
+    transform = polaris.CoordinateTransform(lat, lon)
+
+    start = time.perf_counter()
+    legacy = [legacy_radec_to_azalt(degrees(ra) / 15, degrees(dec), t) for (ra, dec, t) in targets]
+    legacy_time = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    results = [transform.radec_to_azalt(ra, dec, t) for (ra, dec, t) in targets]
+    scalar_time = (time.perf_counter() - start) / n
+
+    (ra, dec, t) = zip(*targets)
+    if polaris.np is not None:
+        (ra, dec, t) = (polaris.np.asarray(ra), polaris.np.asarray(dec), polaris.np.asarray(t))
+    transform.radec_to_azalt_batch(ra[:1], dec[:1], t[:1])
+    start = time.perf_counter()
+    batch = transform.radec_to_azalt_batch(ra, dec, t)
+    batch_time = (time.perf_counter() - start) / n
+
+    error = max_difference(results, [reference_radec_to_azalt(*target) for target in targets])
+    # both transforms must agree with the conversion they replace, within the rounding
+    # of its dms strings, except on the declinations between -1° and 0° it gets wrong
+    kept = [i for (i, (ra, dec, t)) in enumerate(targets) if not -radians(1) < dec < 0]
+    references = [(radians(legacy[i][0]), radians(legacy[i][1])) for i in kept]
+    legacy_error = max(max_difference([results[i] for i in kept], references),
+                       max_difference([(batch[0][i], batch[1][i]) for i in kept], references))
+    assert legacy_error < 2, f"the transform differs from the legacy conversion by {legacy_error:.3f} arcsec"
+
+    print(f"transform: {n} conversions")
+    print(f"  legacy ephem: {legacy_time*1E6:9.2f} us/conversion")
+    print(f"  scalar:       {scalar_time*1E6:9.2f} us/conversion ({legacy_time/scalar_time:.1f}x)")
+    print(f"  batch:        {batch_time*1E6:9.2f} us/conversion ({legacy_time/batch_time:.1f}x){'' if polaris.np else ' numpy not installed'}")
+    print(f"  max difference with ephem: {error:.3f} arcsec, with legacy: {legacy_error:.3f} arcsec")
+    return {
+        'conversions': n,
+        'legacy_us': legacy_time * 1E6,
+        'scalar_us': scalar_time * 1E6,
+        'batch_us': batch_time * 1E6,
+        'max_error_arcsec': error,
+        'max_legacy_error_arcsec': legacy_error,
+    }
+
+
+####### Statistics
+
+def percentiles(samples):
+    """
+    percentiles summarizes latency samples in seconds as milliseconds.
+    """
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    def pick(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1E3
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1E3,
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': samples[-1] * 1E3,
+    }
+
+
+def print_stages(title, stages):
+    print(title)
+    for (name, stats) in stages.items():
+        if isinstance(stats, dict) and stats.get('count'):
+            print(f"  {name:12} p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms  p99 {stats['p99_ms']:9.3f} ms  ({stats['count']} samples)")
+
+
+####### Goto
+
+def encode_stellarium_goto(ra, dec, t):
+    """
+    encode_stellarium_goto builds the 20 bytes goto packet Stellarium sends.
+
+    :param ra: J2000 right ascension in radians
+    :param dec: J2000 declination in radians
+    :param t: UTC unix timestamp in seconds
+    """
+    return struct.pack('<HHqIi', 20, 0, int(t * 1E6),
+                       int(round(ra / STELLARIUM_RA_UNIT)) & 0xffffffff,
+                       int(round(dec / STELLARIUM_DEC_UNIT)))
+
+
+class GotoProbe:
+    """
+    GotoProbe timestamps the stages of the gotos going through the bridge: it wraps
+    the packet decoding of stellarium_core, the coordinate transform of
+    polaris_stellarium, the 519 handler of the simulator and listens to the 519
+    replies of the client. The planner converts the target again for its lead
+    time, only the first conversion of each goto, the one of the goto packet, is
+    timed and the other ones are counted.
+    """
+
+    def __init__(self, client, simulator):
+        self.decode = []
+        self.transform = []
+        self.transform_calls = 0
+        self.timing = False
+        self.sent = None
+        self.received_519 = None
+        self.ret1 = None
+        self.ret0 = None
+        self.done = asyncio.Event()
+
+        decode = stellarium_core.decode_stellarium_goto
+        def timed_decode(data):
+            start = time.perf_counter()
+            result = decode(data)
+            self.decode.append(time.perf_counter() - start)
+            return result
+        stellarium_core.decode_stellarium_goto = timed_decode
+
+        transform = polaris.site_transform(lat, lon)
+        radec_to_azalt = transform.radec_to_azalt
+        def timed_transform(ra, dec, t):
+            self.transform_calls += 1
+            if not self.timing:
+                return radec_to_azalt(ra, dec, t)
+            self.timing = False
+            start = time.perf_counter()
+            result = radec_to_azalt(ra, dec, t)
+            self.transform.append(time.perf_counter() - start)
+            return result
+        transform.radec_to_azalt = timed_transform
+
+        handle = simulator.head.handle
+        def timed_handle(cmd, args):
+            if cmd == '519':
+                self.received_519 = time.perf_counter()
+            return handle(cmd, args)
+        simulator.head.handle = timed_handle
+
+        client.subscribe('519', self.on_goto_reply)
+        self.restore = functools.partial(self.unwrap, decode, transform, radec_to_azalt)
+
+    def unwrap(self, decode, transform, radec_to_azalt):
+        stellarium_core.decode_stellarium_goto = decode
+        del transform.radec_to_azalt
+
+    def on_goto_reply(self, reply):
+        if reply.ret == 1:
+            self.ret1 = time.perf_counter()
+        else:
+            self.ret0 = time.perf_counter()
+            self.done.set()
+
+    def start(self):
+        self.received_519 = self.ret1 = self.ret0 = None
+        self.done.clear()
+        self.timing = True
+        self.sent = time.perf_counter()
+
+
+async def bench_goto(n):
+    random.seed(1)
+    polaris_simulator.max_speed = simulator_speed
+    polaris_simulator.max_accel = simulator_accel
+    polaris_simulator.rate518 = 10.0
+    simulator = polaris_simulator.Simulator()
+    simulator_server = await asyncio.start_server(simulator.handle_client, '127.0.0.1', 0)
+    simulator_port = simulator_server.sockets[0].getsockname()[1]
+    physics = asyncio.create_task(simulator.physics_loop())
+
+    # the same pipeline as the bridge, the slews are planned from the 518 heading
+    backend = polaris.PolarisBackend('127.0.0.1', simulator_port, heartbeat=0, status_interval=0,
+                                     site=polaris.PolarisSite(lat, lon))
+    scheduler = backend.scheduler
+    server = stellarium_core.StellariumServer(backend, 0, rate=0)
+    targets = random_targets(n, time.time(), 0)
+    probe = GotoProbe(backend.client, simulator)
+    backend_task = asyncio.create_task(backend.run())
+    await backend.supervisor.connected.wait()
+
+    local_server = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+    (stellarium_reader, stellarium_writer) = await asyncio.open_connection('127.0.0.1', local_server.sockets[0].getsockname()[1])
+
+    stages = {'send_519': [], 'ret1': [], 'ret0': []}
+    failed = 0
+    for (ra, dec, t) in targets:
+        probe.start()
+        stellarium_writer.write(encode_stellarium_goto(ra, dec, time.time()))
+        await stellarium_writer.drain()
+        try:
+            await asyncio.wait_for(probe.done.wait(), 60)
+        except asyncio.TimeoutError:
+            failed += 1
+            continue
+        if probe.ret1 is None:
+            # refused by the Polaris, 519@ret:-1
+            failed += 1
+            continue
+        stages['send_519'].append(probe.received_519 - probe.sent)
+        stages['ret1'].append(probe.ret1 - probe.sent)
+        stages['ret0'].append(probe.ret0 - probe.sent)
+
+    probe.restore()
+    stellarium_writer.close()
+    await stellarium_writer.wait_closed()
+    await backend.close()
+    # let the connection handlers see the end of their connections
+    await asyncio.sleep(0.1)
+    for task in (backend_task, physics):
+        task.cancel()
+    local_server.close()
+    simulator_server.close()
+
+    results = {'decode': percentiles(probe.decode), 'transform': percentiles(probe.transform)}
+    results.update((name, percentiles(samples)) for (name, samples) in stages.items())
+    results['failed'] = failed
+    results['transform_calls'] = probe.transform_calls
+    results['scheduler'] = scheduler.stats()
+    results['planner'] = scheduler.planner.stats()
+    print_stages(f"goto: {n} Stellarium gotos, simulator axes {simulator_speed}°/s {simulator_accel}°/s²", results)
+    print(f"  {failed} failed, {probe.transform_calls} transforms, scheduler {results['scheduler']}")
+    print(f"  planner {results['planner']}")
+    return results
+
+
+####### Parser
+
+def bench_parser(n):
+    frame = b"518@w:0.2806630;x:0.6388316;y:-0.6583711;z:0.2822593;w:0.2822592;x:0.6388316;y:-0.6583711;z:-0.2806630;compass:0.7005098;alt:-43.0876274;#"
+    stream = frame * n
+    chunks = [stream[i:i + 4096] for i in range(0, len(stream), 4096)]
+
+    parser = polaris.PolarisFrameParser()
+    start = time.perf_counter()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parse_time = time.perf_counter() - start
+
+    # the whole reader path: parsing, dispatch and the telemetry bus with 2 subscribers
+    class NullWriter:
+        def close(self):
+            pass
+    client = polaris.PolarisClient(None, NullWriter())
+    bus = polaris.TelemetryBus(client)
+    bus.subscribe(1)
+    bus.subscribe(10)
+    start = time.perf_counter()
+    for chunk in chunks:
+        for (cmd, args) in client.parser.feed(chunk):
+            client.dispatch(cmd, args)
+    dispatch_time = time.perf_counter() - start
+
+    results = {
+        'frames': n,
+        'parsed': parser.frames,
+        'parse_frames_per_s': n / parse_time,
+        'dispatch_frames_per_s': n / dispatch_time,
+        'bus_records': bus.count,
+    }
+    print(f"parser: {n} 518 frames in {len(chunks)} reads of 4096 bytes")
+    print(f"  parse only:            {results['parse_frames_per_s']:12.0f} frames/s")
+    print(f"  parse + dispatch + bus: {results['dispatch_frames_per_s']:11.0f} frames/s")
+    return results
+
+
+####### main
+
+async def main(argv):
+    global lat, lon, count, goto_count, parser_count, simulator_speed, simulator_accel
+
+    usage = f"{os.path.basename(sys.argv[0])} [-h] [-n <count>] [--gotos <count>] [--frames <count>] [--speed <°/s>] [--accel <°/s²>] [--lat <latitude>] [--lon <longitude>] [--json <file>] [transform] [goto] [parser]"
+    json_path = None
+    try:
+        opts, args = getopt.getopt(argv,"hn:",["lat=","lon=","gotos=","frames=","speed=","accel=","json="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt == "-n":
+            count = int(arg)
+        elif opt == "--gotos":
+            goto_count = int(arg)
+        elif opt == "--frames":
+            parser_count = int(arg)
+        elif opt == "--speed":
+            simulator_speed = float(arg)
+        elif opt == "--accel":
+            simulator_accel = float(arg)
+        elif opt == "--lat":
+            lat = float(arg)
+        elif opt == "--lon":
+            lon = float(arg)
+        elif opt == "--json":
+            json_path = arg
+
+    benchmarks = args or ['transform', 'goto', 'parser']
+    polaris.lat = lat
+    polaris.lon = lon
+
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'numpy': polaris.np.__version__ if polaris.np else None,
+    }
+    if 'transform' in benchmarks:
+        results['transform'] = bench_transform(count)
+    if 'goto' in benchmarks:
+        results['goto'] = await bench_goto(goto_count)
+    if 'parser' in benchmarks:
+        results['parser'] = bench_parser(parser_count)
+
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {json_path}")
+
+
+#######
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import os
+import getopt
+import asyncio
+import time
+from bisect import bisect_left
+from math import radians, degrees
+
+import polaris_stellarium as polaris
+
+####### Globals
+
+lat = None
+lon = None
+
+min_alt = 10.0
+max_alt = 88.0
+step = 60.0
+slew_speed = 5.0
+settle_time = 2.0
+
+DRY_RUN = False
+
+
+####### Plan
+
+class PlanTarget:
+    """
+    PlanTarget is an object of the observing plan with its Az/Alt precomputed over
+    the session.
+    """
+    __slots__ = ('name', 'ra', 'dec', 'body', 'dwell', 'photos', 'az', 'alt')
+
+    def __init__(self, name, ra, dec, dwell, photos=0, body=None):
+        """
+        :param name: name of the object
+        :param ra: J2000 right ascension in radians, None for a solar system body
+        :param dec: J2000 declination in radians, None for a solar system body
+        :param dwell: time spent tracking the object in seconds
+        :param photos: number of photos, informative, the dwell time covers them
+        :param body: the name of the solar system body, one of EphemerisCache.bodies
+        """
+        self.name = name
+        self.ra = ra
+        self.dec = dec
+        self.body = body
+        self.dwell = dwell
+        self.photos = photos
+        self.az = []
+        self.alt = []
+
+
+def parse_sexagesimal(value):
+    """
+    parse_sexagesimal reads "12:34:56.7", "-5:06:07" or a decimal number.
+    """
+    value = value.strip()
+    sign = -1 if value.startswith('-') else 1
+    fields = [float(field) for field in value.lstrip('+-').split(':')]
+    return sign * sum(field / 60 ** i for (i, field) in enumerate(fields))
+
+
+def load_plan(path):
+    """
+    load_plan reads an observing plan, one target per line:
+
+        name, RA, Dec, dwell seconds[, photos x exposure seconds]
+
+    RA is in hours and Dec in degrees, decimal or h:m:s/d:m:s. RA and Dec are left
+    empty for the Sun, the Moon and the planets, named in English. With the photos
+    column (e.g. "30x20") the dwell time is the time needed by the photos if it is
+    longer. Empty lines and lines starting with # are ignored.
+    """
+    targets = []
+    with open(path) as file:
+        for (number, line) in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            try:
+                (name, ra, dec, dwell) = fields[:4]
+                dwell = float(dwell)
+                photos = 0
+                if len(fields) > 4 and fields[4]:
+                    (count, _, exposure) = fields[4].partition('x')
+                    photos = int(count)
+                    dwell = max(dwell, photos * float(exposure or 0))
+                if not ra and not dec and name.capitalize() in polaris.EphemerisCache.bodies:
+                    targets.append(PlanTarget(name, None, None, dwell, photos, name.capitalize()))
+                else:
+                    targets.append(PlanTarget(name, radians(parse_sexagesimal(ra) * 15), radians(parse_sexagesimal(dec)), dwell, photos))
+            except ValueError as error:
+                raise ValueError(f"{path}:{number}: invalid target line '{line}': {error}")
+    return targets
+
+
+def precompute(targets, t0, duration, step):
+    """
+    precompute fills the Az/Alt in degrees of every target every step seconds from
+    t0 to t0 + duration with a single batch transform, the solar system bodies are
+    read in the EphemerisCache.
+
+    :return: the list of the sample times
+    """
+    times = [t0 + i * step for i in range(int(duration / step) + 2)]
+    fixed = [target for target in targets if target.body is None]
+    ra = [target.ra for target in fixed for t in times]
+    dec = [target.dec for target in fixed for t in times]
+    (az, alt) = polaris.site_transform(lat, lon).radec_to_azalt_batch(ra, dec, times * len(fixed))
+    for (i, target) in enumerate(fixed):
+        target.az = [degrees(a) for a in az[i * len(times):(i + 1) * len(times)]]
+        target.alt = [degrees(a) for a in alt[i * len(times):(i + 1) * len(times)]]
+    ephemerides = polaris.site_ephemerides(lat, lon)
+    for target in targets:
+        if target.body:
+            (target.az, target.alt) = map(list, zip(*(ephemerides.azalt(target.body, t) for t in times)))
+    return times
+
+
+def target_azalt(target, t):
+    """
+    target_azalt returns the (az, alt) in degrees of a target at time t.
+    """
+    if target.body:
+        return polaris.site_ephemerides(lat, lon).azalt(target.body, t)
+    (az, alt) = polaris.site_transform(lat, lon).radec_to_azalt(target.ra, target.dec, t)
+    return (degrees(az), degrees(alt))
+
+
+def position_at(target, times, t):
+    # linear interpolation between the samples, the azimuth wraps at 360°
+    i = min(max(bisect_left(times, t), 1), len(times) - 1)
+    f = (t - times[i - 1]) / (times[i] - times[i - 1])
+    (az0, az1) = (target.az[i - 1], target.az[i])
+    if az1 - az0 > 180:
+        az0 += 360
+    elif az0 - az1 > 180:
+        az1 += 360
+    return ((az0 + f * (az1 - az0)) % 360, target.alt[i - 1] + f * (target.alt[i] - target.alt[i - 1]))
+
+
+def slew_distance(planner, position, azalt):
+    """
+    slew_distance returns the (distance, yaw) of the slew from the (yaw, pitch)
+    position of the head to azalt, the yaw is the one the SlewPlanner sends so a
+    target across the ±180° yaw is far when yaw_limit doesn't let the head cross it.
+    """
+    (yaw, _) = planner.choose_yaw(azalt[0], position[0])
+    # the axes move at the same time, the longest one gives the slew duration
+    return (max(abs(yaw - position[0]), abs(azalt[1] - position[1])), yaw)
+
+
+def reachable(target, times, t):
+    for when in (t, t + target.dwell):
+        alt = position_at(target, times, when)[1]
+        if not min_alt <= alt <= max_alt:
+            return False
+    return True
+
+
+def plan_order(targets, times, t0, start, planner):
+    """
+    plan_order orders the targets to minimise the slews: from the current position
+    the next target is the closest one reachable when the head gets to it, the
+    Az/Alt are read in the precomputed samples and the distances measured on the
+    yaw turns of the planner (see slew_distance). A target below min_alt or above
+    max_alt at the start or the end of its dwell is postponed and skipped if it
+    never becomes reachable.
+
+    :param start: the (yaw, pitch) position of the head at t0
+    :param planner: the SlewPlanner choosing the yaw of the gotos
+    :return: (planned, skipped), planned is a list of (target, start time, slew seconds)
+    """
+    remaining = list(targets)
+    planned = []
+    (t, position) = (t0, start)
+    while remaining:
+        candidates = []
+        for target in remaining:
+            (distance, yaw) = slew_distance(planner, position, position_at(target, times, t))
+            arrival = t + distance / slew_speed + settle_time
+            if reachable(target, times, arrival):
+                candidates.append((distance, yaw, target))
+        if not candidates:
+            # wait for a target to rise
+            t += step
+            if t > times[-1]:
+                break
+            continue
+        (distance, yaw, target) = min(candidates, key=lambda candidate: candidate[0])
+        slew = distance / slew_speed + settle_time
+        planned.append((target, t, slew))
+        remaining.remove(target)
+        t += slew + target.dwell
+        # the head follows the target from the yaw it was sent to
+        (az, alt) = position_at(target, times, t)
+        position = (planner.choose_yaw(az, yaw)[0], alt)
+    return (planned, remaining)
+
+
+####### Execution
+
+async def run_plan(client, planned, t0, planner):
+    """
+    run_plan points and tracks the planned targets in order, the Az/Alt are computed
+    again when the goto is sent and the yaw chosen by the planner from the 518
+    heading. A target not risen yet is waited for until its planned time.
+
+    :param t0: the start time of the plan
+    :param planner: the SlewPlanner choosing the yaw of the gotos
+
+    :return: list of (target, planned start, planned slew, actual start, actual slew, actual dwell, status)
+    """
+    report = []
+    actual_t0 = time.time()
+    for (target, planned_start, planned_slew) in planned:
+        start = time.time()
+        (az, alt) = target_azalt(target, start)
+        delay = actual_t0 + (planned_start - t0) - start
+        if not min_alt <= alt <= max_alt and delay > 0:
+            polaris.console.info("%s: waiting %.0fs", target.name, delay)
+            await asyncio.sleep(delay)
+            start = time.time()
+            (az, alt) = target_azalt(target, start)
+        if not min_alt <= alt <= max_alt:
+            polaris.console.info("%s: Alt. %.2f° out of limits, skipped", target.name, alt)
+            report.append((target, planned_start, planned_slew, start, 0.0, 0.0, 'skipped'))
+            continue
+        polaris.console.info("%s: goto Az.: %.3f Alt.: %.3f", target.name, az, alt)
+        try:
+            plan = await planner.plan(az, alt, start, False)
+            reply = await polaris.polaris_goto(client, plan.az, plan.alt, True, plan.yaw)
+            status = 'failed' if reply.ret == -1 else 'done'
+        except (asyncio.TimeoutError, ConnectionError) as error:
+            polaris.console.info("%s: goto error %s", target.name, error or 'timeout')
+            status = 'failed'
+        slew = time.time() - start
+        dwell = 0.0
+        if status == 'done':
+            polaris.console.info("%s: tracking for %.0fs", target.name, target.dwell)
+            await asyncio.sleep(target.dwell)
+            dwell = time.time() - start - slew
+        report.append((target, planned_start, planned_slew, start, slew, dwell, status))
+    return report
+
+
+def print_plan(planned, skipped, times, t0):
+    print(f"{'target':20} {'start':>8} {'slew':>7} {'dwell':>7} {'Az.':>8} {'Alt.':>7}")
+    for (target, start, slew) in planned:
+        (az, alt) = position_at(target, times, start + slew)
+        print(f"{target.name:20} {start - t0:8.0f} {slew:7.1f} {target.dwell:7.0f} {az:8.2f} {alt:7.2f}")
+    for target in skipped:
+        print(f"{target.name:20} skipped, below {min_alt}° or above {max_alt}° during the session")
+
+
+def print_report(report, t0, actual_t0):
+    print(f"{'target':20} {'planned start':>13} {'actual':>8} {'planned slew':>12} {'actual':>8} {'dwell':>7} {'actual':>8}  status")
+    for (target, planned_start, planned_slew, start, slew, dwell, status) in report:
+        print(f"{target.name:20} {planned_start - t0:13.0f} {start - actual_t0:8.0f} {planned_slew:12.1f} {slew:8.1f} {target.dwell:7.0f} {dwell:8.1f}  {status}")
+
+
+####### main
+
+async def main(argv):
+    global lat, lon, min_alt, max_alt, step, slew_speed, settle_time, DRY_RUN
+
+    usage = f"{os.path.basename(sys.argv[0])} [-hln] --lat <latitude> --lon <longitude> [--polaris <address[:port]>] [--min-alt <degrees>] [--max-alt <degrees>] [--step <seconds>] [--slew-speed <°/s>] [--settle <seconds>] [--yaw-limit <degrees>] [--model <file>] <plan file>"
+    try:
+        opts, args = getopt.getopt(argv,"hln",["lat=","lon=","polaris=","min-alt=","max-alt=","step=","slew-speed=","settle=","yaw-limit=","model="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt == "--lat":
+            lat = float(arg)
+        elif opt == "--lon":
+            lon = float(arg)
+        elif opt == "--polaris":
+            (polaris.polaris_ip, _, port) = arg.partition(':')
+            if port:
+                polaris.polaris_port = int(port)
+        elif opt == "--min-alt":
+            min_alt = float(arg)
+        elif opt == "--max-alt":
+            max_alt = float(arg)
+        elif opt == "--step":
+            step = float(arg)
+        elif opt == "--slew-speed":
+            slew_speed = float(arg)
+        elif opt == "--settle":
+            settle_time = float(arg)
+        elif opt == "--yaw-limit":
+            polaris.yaw_limit = float(arg)
+        elif opt == "--model":
+            polaris.pointing_model = polaris.PointingModel.load(arg)
+        elif opt == "-l":
+            polaris.LOGGING = True
+        elif opt == "-n":
+            DRY_RUN = True
+
+    if lat == None or lon == None or len(args) != 1:
+        print(usage)
+        sys.exit(2)
+    polaris.lat = lat
+    polaris.lon = lon
+    listener = polaris.setup_logging()
+
+    targets = load_plan(args[0])
+    t0 = time.time()
+    # long enough for every target one after the other with the longest slews
+    duration = sum(target.dwell + 180 / slew_speed + settle_time for target in targets)
+    times = precompute(targets, t0, duration, step)
+
+    client = polaris.PolarisClient()
+    supervisor = polaris.PolarisSupervisor(client, polaris.polaris_ip, polaris.polaris_port, (polaris.polaris_init,), polaris.heartbeat_interval)
+    bus = polaris.TelemetryBus(client)
+    planner = polaris.SlewPlanner(bus, polaris.yaw_limit)
+    supervisor_task = None
+    start = (0.0, 0.0)
+    if not DRY_RUN:
+        supervisor_task = asyncio.create_task(supervisor.run())
+        connected = asyncio.create_task(supervisor.connected.wait())
+        # polaris_init fails when the Polaris isn't in astro mode, the supervisor stops
+        await asyncio.wait((connected, supervisor_task), return_when=asyncio.FIRST_COMPLETED)
+        if supervisor_task.done():
+            connected.cancel()
+            listener.stop()
+            supervisor_task.result()
+        start = await planner.angles() or start
+
+    (planned, skipped) = plan_order(targets, times, t0, start, planner)
+    print(f"Plan of {len(planned)} targets, {len(skipped)} skipped, {(planned[-1][1] + planned[-1][2] + planned[-1][0].dwell - t0) / 60 if planned else 0:.1f} minutes:")
+    print_plan(planned, skipped, times, t0)
+    if DRY_RUN:
+        listener.stop()
+        return
+
+    try:
+        actual_t0 = time.time()
+        report = await run_plan(client, planned, t0, planner)
+        print(f"Plan done in {(time.time() - actual_t0) / 60:.1f} minutes:")
+        print_report(report, t0, actual_t0)
+    finally:
+        supervisor_task.cancel()
+        listener.stop()
+
+
+#######
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except ValueError as value:
+        print(f"{value}\nQuit.")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt.")
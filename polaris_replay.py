@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import os
+import getopt
+import asyncio
+import time
+
+import polaris_stellarium as polaris
+
+####### Globals
+
+local_port = 9090
+
+speed = 1.0
+SYNC = False
+LOOP = False
+LOGGING = False
+
+
+####### Replay
+
+class ReplaySession:
+    """
+    ReplaySession plays a capture to one client as if it were the Polaris.
+
+    The frames received from the Polaris in the capture are written with their
+    recorded timing divided by speed, or as fast as possible if speed is 0. In
+    sync mode the replay waits at each command of the capture until the client
+    sends a command with the same code, so the replies follow the client requests.
+    The h# heartbeat of the client is echoed like the Polaris does.
+    """
+    max_pending = 65536
+
+    def __init__(self, events, speed, sync):
+        self.events = events
+        self.speed = speed
+        self.sync = sync
+        self.received = asyncio.Queue()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+
+    async def read_client(self, reader, writer):
+        pending = ''
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            # commands are 1&NNN&n&args# frames, keep their code, a frame split
+            # across reads is completed by the next one
+            chunks = (pending + data.decode('latin-1')).split('#')
+            pending = chunks.pop()
+            if len(pending) > self.max_pending:
+                pending = ''
+            for chunk in chunks:
+                if chunk == 'h':
+                    writer.write(b'h#')
+                elif chunk:
+                    self.frames_received += 1
+                    self.received.put_nowait(chunk.split('&')[1] if '&' in chunk else chunk)
+        self.received.put_nowait(None)
+
+    async def wait_command(self, cmd):
+        while True:
+            received = await self.received.get()
+            if received is None:
+                raise ConnectionError("client disconnected")
+            if received == cmd:
+                return
+
+    async def play(self, writer):
+        start = time.monotonic()
+        origin = self.events[0][0] if self.events else 0
+        for (t, direction, data) in self.events:
+            if direction == '>':
+                if self.sync:
+                    await self.wait_command(data.split('&')[1] if '&' in data else data.rstrip('#'))
+                    # the recorded delays are relative to the command
+                    start = time.monotonic()
+                    origin = t
+                continue
+            if self.speed:
+                delay = (t - origin) / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if LOGGING:
+                print(f"<<< Replay: {data}")
+            writer.write(data.encode('latin-1'))
+            await writer.drain()
+            self.frames_sent += data.count('#')
+            self.bytes_sent += len(data)
+        return time.monotonic() - start
+
+
+async def handle_client(events, reader, writer):
+    print(f"Replay client connected {writer.get_extra_info('peername')}")
+    while True:
+        session = ReplaySession(events, speed, SYNC)
+        client_task = asyncio.create_task(session.read_client(reader, writer))
+        start = time.monotonic()
+        try:
+            await session.play(writer)
+        except ConnectionError as error:
+            print(f"Replay stopped: {error}")
+            break
+        finally:
+            elapsed = time.monotonic() - start
+            print(f"Replayed {session.frames_sent} frames ({session.bytes_sent} bytes) in {elapsed:.3f}s, "
+                  f"{session.frames_sent / elapsed if elapsed else 0:.0f} frames/s, {session.frames_received} commands received")
+            client_task.cancel()
+        if not LOOP:
+            break
+    writer.close()
+
+
+async def main(argv):
+    global local_port, speed, SYNC, LOOP, LOGGING
+
+    usage = f"{os.path.basename(sys.argv[0])} [-hlrs] [--port <port>] [--speed <factor, 0 as fast as possible>] <capture file>"
+    try:
+        opts, args = getopt.getopt(argv,"hlrs",["port=","speed="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt == "--port":
+            local_port = int(arg)
+        elif opt == "--speed":
+            speed = float(arg)
+        elif opt == "-l":
+            LOGGING = True
+        elif opt == "-r":
+            LOOP = True
+        elif opt == "-s":
+            SYNC = True
+
+    if len(args) != 1:
+        print(usage)
+        sys.exit(2)
+
+    events = polaris.load_capture(args[0])
+    print(f"Loaded {len(events)} events from {args[0]}, replay on localhost:{local_port} at speed {speed or 'max'}{' synchronized with the client commands' if SYNC else ''}")
+
+    server = await asyncio.start_server(lambda reader, writer: handle_client(events, reader, writer), 'localhost', local_port)
+    async with server:
+        await server.serve_forever()
+
+
+#######
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print("Keyboard interrupt.")
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import os
+import getopt
+import asyncio
+import random
+import time
+from collections import deque
+from math import sin, cos, asin, atan2, sqrt, copysign, radians, degrees
+
+import polaris_stellarium as polaris
+
+####### Globals
+
+local_port = 9090
+
+rate518 = 10.0
+latency = 0.0
+fragment = 0
+max_speed = 6.0
+max_accel = 3.0
+tracking_error = 0.0
+min_alt = -20.0
+home_azalt = (148.7, 44.7)
+
+LOGGING = False
+
+SIDEREAL_RATE = 360.0 / 86164.0905
+
+
+####### Head
+
+class SimulatedAxis:
+    """
+    SimulatedAxis is a rotation axis with velocity and acceleration limits, moving
+    either toward a target position or at a manual speed.
+    """
+
+    def __init__(self, position=0.0, speed=None, accel=None):
+        """
+        :param position: initial position in degrees
+        :param speed: maximum speed in degrees per second
+        :param accel: acceleration in degrees per second²
+        """
+        self.position = position
+        self.velocity = 0.0
+        self.target = None
+        self.manual = 0.0
+        self.manual_until = 0.0
+        self.max_speed = max_speed if speed is None else speed
+        self.accel = max_accel if accel is None else accel
+
+    @property
+    def moving(self):
+        return self.target is not None or self.velocity != 0.0 or self.manual != 0.0
+
+    def goto(self, target):
+        self.target = target
+        self.manual = 0.0
+
+    def set_manual(self, speed, keep_alive=None):
+        """
+        set_manual moves the axis at speed degrees per second, until keep_alive seconds
+        without a new call if keep_alive is set.
+        """
+        self.target = None
+        self.manual = max(-self.max_speed, min(self.max_speed, speed))
+        self.manual_until = time.monotonic() + keep_alive if keep_alive else 0.0
+
+    def step(self, dt):
+        """
+        step advances the axis by dt seconds.
+
+        :return: True when the axis reaches its target
+        """
+        if self.manual_until and time.monotonic() > self.manual_until:
+            self.manual = 0.0
+            self.manual_until = 0.0
+        if self.target is not None:
+            distance = self.target - self.position
+            if abs(distance) < 1E-4 and abs(self.velocity) <= self.accel * dt:
+                self.position = self.target
+                self.velocity = 0.0
+                self.target = None
+                return True
+            # fastest speed still allowing to stop on the target
+            desired = copysign(min(self.max_speed, sqrt(2 * self.accel * abs(distance))), distance)
+        else:
+            desired = self.manual
+        dv = max(-self.accel * dt, min(self.accel * dt, desired - self.velocity))
+        self.velocity += dv
+        position = self.position + self.velocity * dt
+        if self.target is not None and (self.target - position) * distance <= 0:
+            position = self.target
+            self.velocity = 0.0
+        self.position = position
+        if self.target is None and self.manual == 0.0 and abs(self.velocity) < 1E-9:
+            self.velocity = 0.0
+        return False
+
+
+class SimulatedHead:
+    """
+    SimulatedHead is the state of a Polaris head: the yaw, pitch and roll axes,
+    the mode, the tracking and the battery. The yaw is the opposite of the azimuth,
+    the way the 519 goto command expects it.
+
+    The head starts at its mechanical home (az, alt), the 517 angles are measured
+    from there like the real head does (see HeadingRecord in polaris_stellarium).
+    """
+
+    def __init__(self, home=None):
+        """
+        :param home: (az, alt) in degrees of the mechanical home of the axes
+        """
+        (az, alt) = home_azalt if home is None else home
+        self.home = ((-az + 180) % 360 - 180, alt, 0.0)
+        self.yaw = SimulatedAxis(self.home[0])
+        self.pitch = SimulatedAxis(self.home[1])
+        self.roll = SimulatedAxis(self.home[2])
+        self.mode = 8
+        self.tracking = 0
+        self.goto_track = 0
+        self.in_goto = False
+        self.lat = 45.0
+        self.battery = 80.0
+        self.gotos = 0
+
+    def azalt(self):
+        return (-self.yaw.position % 360, self.pitch.position)
+
+    def track(self, dt):
+        # follow the sky around the celestial pole, with the configured rate error
+        (az, alt) = (radians(self.azalt()[0]), radians(self.azalt()[1]))
+        lat = radians(self.lat)
+        dec = asin(sin(lat) * sin(alt) + cos(lat) * cos(alt) * cos(az))
+        ha = atan2(-sin(az) * cos(alt), cos(lat) * sin(alt) - sin(lat) * cos(alt) * cos(az))
+        ha += radians(SIDEREAL_RATE * (1 + tracking_error) * dt)
+        alt = asin(sin(lat) * sin(dec) + cos(lat) * cos(dec) * cos(ha))
+        az = atan2(-cos(dec) * sin(ha), cos(lat) * sin(dec) - sin(lat) * cos(dec) * cos(ha))
+        # the head stays on its turn, a yaw past 180° isn't brought back to -180..180
+        yaw = -degrees(az)
+        self.yaw.position += (yaw - self.yaw.position + 180) % 360 - 180
+        self.pitch.position = degrees(alt)
+
+    def step(self, dt):
+        """
+        step advances the head by dt seconds.
+
+        :return: the frames to send to the clients
+        """
+        frames = []
+        arrived = [axis.step(dt) for axis in (self.yaw, self.pitch, self.roll)]
+        if self.in_goto and any(arrived) and not (self.yaw.target is not None or self.pitch.target is not None):
+            self.in_goto = False
+            self.tracking = self.goto_track
+            frames.append(f"519@ret:0;track:{self.goto_track};#")
+        if self.tracking and not (self.in_goto or self.yaw.moving or self.pitch.moving):
+            self.track(dt)
+        self.battery = max(0.0, self.battery - dt / 360)
+        return frames
+
+    def heading(self):
+        (az, alt) = self.azalt()
+        # quaternion of the az then alt rotation, written twice like the Polaris does
+        (a, b) = (radians(-az) / 2, radians(alt) / 2)
+        (w, x, y, z) = (cos(a) * cos(b), -sin(a) * sin(b), cos(a) * sin(b), sin(a) * cos(b))
+        return (f"518@w:{w:.7f};x:{x:.7f};y:{y:.7f};z:{z:.7f};w:{z:.7f};x:{x:.7f};y:{y:.7f};z:{w:.7f};"
+                f"compass:{az:.7f};alt:{-alt:.7f};#")
+
+    def handle(self, cmd, args):
+        """
+        handle executes a command received from a client.
+
+        :return: the reply frames
+        """
+        arg_dict = {}
+        if ':' in args:
+            arg_dict = polaris.polaris_parse_args(args)
+
+        if cmd == '284':
+            return [f"284@mode:{self.mode};state:0;track:{self.tracking};speed:0;halfSpeed:0;remNum:;runTime:;photoNum:;#"]
+        if cmd == '285':
+            self.mode = int(arg_dict.get('mode', self.mode))
+            return [f"285@mode:{self.mode};ret:0;#"]
+        if cmd == '296':
+            return ["296@mode:0;#"]
+        if cmd == '517':
+            # mechanical angles from the home, the 517 yaw turns the other way than the 519 yaw
+            (yaw, pitch, roll) = (self.home[0] - self.yaw.position, self.pitch.position - self.home[1], self.roll.position - self.home[2])
+            return [f"517@yaw:{radians(yaw):.6f};pitch:{radians(pitch):.6f};roll:{radians(roll):.6f};#"]
+        if cmd in ('513', '514', '521'):
+            # positive speeds turn clockwise, toward the increasing azimuths
+            (axis, sign) = {'513': (self.yaw, -1), '514': (self.pitch, 1), '521': (self.roll, 1)}[cmd]
+            axis.set_manual(sign * float(arg_dict.get('speed', 0)) / 2000 * axis.max_speed, keep_alive=0.25)
+            return []
+        if cmd == '519':
+            pitch = float(arg_dict['pitch'])
+            self.lat = float(arg_dict.get('lat', self.lat))
+            self.goto_track = int(arg_dict.get('track', 0))
+            if pitch < min_alt or pitch > 90:
+                return [f"519@ret:-1;track:{self.goto_track};#"]
+            self.tracking = 0
+            self.in_goto = True
+            self.gotos += 1
+            self.yaw.goto(float(arg_dict['yaw']))
+            self.pitch.goto(pitch)
+            return [f"519@ret:1;track:{self.goto_track};#"]
+        if cmd == '520':
+            return ["520@ret:0;#"]
+        if cmd == '523':
+            axis = {'1': 0, '2': 1, '3': 2}.get(arg_dict.get('axis'))
+            if axis is not None:
+                (self.yaw, self.pitch, self.roll)[axis].goto(self.home[axis])
+            return []
+        if cmd == '524':
+            return ["524@state:1;#"]
+        if cmd == '527':
+            self.lat = float(arg_dict.get('lat', self.lat))
+            return ["527@ret:0;#"]
+        if cmd == '530':
+            return [f"530@step:{arg_dict.get('step', 1)};ret:0;#"]
+        if cmd == '531':
+            # answered with the new state, see the Reset rotation capture
+            self.tracking = int(arg_dict.get('state', 0))
+            return [f"531@ret:{self.tracking};#"]
+        if cmd in ('532', '533', '534'):
+            axis = {'532': self.yaw, '533': self.pitch, '534': self.roll}[cmd]
+            level = int(arg_dict.get('level', 0)) if arg_dict.get('state', '0') != '0' else 0
+            axis.set_manual((1 if arg_dict.get('key', '0') == '0' else -1) * level / 5 * axis.max_speed)
+            return []
+        if cmd == '775':
+            return ["775@status:1;totalspace:60860;freespace:60410;usespace:450;#"]
+        if cmd == '778':
+            return [f"778@capacity:{int(self.battery)};charge:0;#"]
+        if cmd == '780':
+            return ["780@hw:1.2.1.2;sw:6.0.0.40;exAxis:1.0.2.11;sv:1#"]
+        if cmd == 'h':
+            return ["h#"]
+        return []
+
+
+####### network
+
+class SimulatorSession:
+    """
+    SimulatorSession is a client connection to the simulator, its outgoing frames
+    go through a queue so the latency and the fragmentation can be injected, the
+    frames are queued in due time order since the latency is the same for all.
+    """
+
+    def __init__(self, head, reader, writer):
+        self.head = head
+        self.reader = reader
+        self.writer = writer
+        self.outgoing = deque()
+        self.queued = asyncio.Event()
+        self.frames_received = 0
+        self.frames_sent = 0
+
+    def send(self, frames):
+        if frames:
+            self.outgoing.append((time.monotonic() + latency, "".join(frames)))
+            self.queued.set()
+
+    async def write_loop(self):
+        while True:
+            while not self.outgoing:
+                self.queued.clear()
+                await self.queued.wait()
+            (due, data) = self.outgoing.popleft()
+            # frames queued meanwhile are coalesced in the same write like the Polaris does
+            while self.outgoing and self.outgoing[0][0] <= due:
+                data += self.outgoing.popleft()[1]
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if LOGGING:
+                print(f">>> Simulator: {data}")
+            payload = data.encode()
+            self.frames_sent += data.count('#')
+            if fragment:
+                i = 0
+                while i < len(payload):
+                    size = random.randint(1, fragment)
+                    self.writer.write(payload[i:i + size])
+                    await self.writer.drain()
+                    i += size
+                    await asyncio.sleep(0)
+            else:
+                self.writer.write(payload)
+                await self.writer.drain()
+
+    async def heading_loop(self):
+        period = 1 / rate518
+        deadline = time.monotonic()
+        while True:
+            deadline += period
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+            self.send([self.head.heading()])
+
+    async def read_loop(self):
+        buffer = ""
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                break
+            buffer += data.decode('latin-1')
+            *commands, buffer = buffer.split('#')
+            for command in commands:
+                if not command:
+                    continue
+                self.frames_received += 1
+                if LOGGING:
+                    print(f"<<< Simulator: {command}#")
+                if command == 'h':
+                    self.send(self.head.handle('h', ''))
+                    continue
+                parts = command.split('&', 3)
+                if len(parts) == 4:
+                    self.send(self.head.handle(parts[1], '' if parts[3] == '-1' else parts[3]))
+
+
+class Simulator:
+    """
+    Simulator is a stand-in of the Polaris TCP server, all the clients share the
+    same simulated head.
+    """
+    tick = 0.02
+
+    def __init__(self):
+        self.head = SimulatedHead()
+        self.sessions = set()
+
+    async def physics_loop(self):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            frames = self.head.step(now - last)
+            last = now
+            for session in self.sessions:
+                session.send(frames)
+
+    async def handle_client(self, reader, writer):
+        session = SimulatorSession(self.head, reader, writer)
+        self.sessions.add(session)
+        print(f"Simulator client connected {writer.get_extra_info('peername')}")
+        tasks = [asyncio.create_task(session.write_loop())]
+        if rate518 > 0:
+            tasks.append(asyncio.create_task(session.heading_loop()))
+        try:
+            await session.read_loop()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.sessions.discard(session)
+            writer.close()
+            print(f"Simulator client disconnected, {session.frames_received} commands received, {session.frames_sent} frames sent")
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.physics_loop())
+
+
+async def main(argv):
+    global local_port, rate518, latency, fragment, max_speed, max_accel, tracking_error, min_alt, home_azalt, LOGGING
+
+    usage = f"{os.path.basename(sys.argv[0])} [-hl] [--port <port>] [--rate518 <Hz>] [--latency <seconds>] [--fragment <max bytes>] [--speed <°/s>] [--accel <°/s²>] [--tracking-error <ratio>] [--min-alt <degrees>] [--home <az,alt>]"
+    try:
+        opts, args = getopt.getopt(argv,"hl",["port=","rate518=","latency=","fragment=","speed=","accel=","tracking-error=","min-alt=","home="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt == "--port":
+            local_port = int(arg)
+        elif opt == "--rate518":
+            rate518 = float(arg)
+        elif opt == "--latency":
+            latency = float(arg)
+        elif opt == "--fragment":
+            fragment = int(arg)
+        elif opt == "--speed":
+            max_speed = float(arg)
+        elif opt == "--accel":
+            max_accel = float(arg)
+        elif opt == "--tracking-error":
+            tracking_error = float(arg)
+        elif opt == "--min-alt":
+            min_alt = float(arg)
+        elif opt == "--home":
+            home_azalt = tuple(float(value) for value in arg.split(','))
+        elif opt == "-l":
+            LOGGING = True
+
+    print(f"Polaris simulator on localhost:{local_port}, 518 at {rate518} Hz, latency {latency}s, "
+          f"fragments {fragment or 'off'}, axes {max_speed}°/s {max_accel}°/s²")
+    await Simulator().serve('localhost', local_port)
+
+
+#######
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print("Keyboard interrupt.")
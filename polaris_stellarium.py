@@ -4,17 +4,35 @@ import sys
 assert sys.version_info >= (3, 0)
 
 import os
-import getopt
 import re
 import asyncio
 import time
+import functools
+import json
+import weakref
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from array import array
+from bisect import bisect_left
+from collections import deque, OrderedDict
 from datetime import datetime
 from datetime import timezone
-from math import pi
+from math import pi, sin, cos, atan2, sqrt, hypot, radians, degrees
+from urllib.parse import parse_qsl
 
 # https://rhodesmill.org/pyephem
 import ephem
 
+# https://numpy.org, optional, only used by the batch transforms
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from stellarium_core import MountBackend, MountSetupError, StellariumServer, console
+from stellarium_core import dec2dms, run_mounts, parse_options, run_main
+
 ####### Globals
 
 lat = None
@@ -24,6 +42,33 @@ polaris_ip = '192.168.0.1'
 polaris_port = 9090
 local_port = 10001
 
+polaris_timeout = 5.0
+polaris_goto_timeout = 180.0
+feedback_rate = 2.0
+log518_rate = 1.0
+telemetry_history = 60.0
+motion_rate = 20.0
+motion_accel = 4000.0
+heartbeat_interval = 5.0
+reconnect_min = 0.5
+reconnect_max = 30.0
+correct_interval = 0.0
+correct_threshold = 5.0
+correct_mode = 'goto'
+log_file = None
+log_sampling = {'518': 100}
+metrics_port = 0
+alpaca_port = 0
+status_interval = 60.0
+status_codes = ('778', '775', '780', '284')
+pointing_model = None
+model_path = None
+align_stars = ()
+yaw_limit = 180.0
+control_policy = 'last'
+control_timeout = 300.0
+max_clients = 8
+
 LOGGING = False
 LOG518 = False
 DEBUG = False
@@ -31,217 +76,784 @@ TESTS = False
 ALLMODES = False
 
 
-####### Polaris
+####### Logging
 
-response_queues = {}
-polaris_current_mode = -1
-polaris_msg_re = re.compile("^(\d\d\d)@([^#]*)#")
+log = logging.getLogger('polaris')
 
-async def polaris_send_msg(writer, msg):
-    if DEBUG:
-        print(f">>> Polaris: msg: {msg}")
-    writer.write(msg.encode())
-    await writer.drain()
-
-def polaris_parse_msg(msg):
-    m = polaris_msg_re.match(msg)
-    if m:
-        return (msg[len(m.group(0)):],m.group(1), m.group(2))
+class SamplingFilter(logging.Filter):
+    """
+    SamplingFilter lets only one record in N through for the command codes given,
+    the records carry their command code in their 'code' attribute. It runs in the
+    thread logging the record, the dropped records are never queued nor formatted.
+    """
+
+    def __init__(self, sampling):
+        """
+        :param sampling: dict {command code: N}
+        """
+        super().__init__()
+        self.sampling = dict(sampling)
+        self.counts = dict.fromkeys(self.sampling, 0)
+
+    def filter(self, record):
+        code = getattr(record, 'code', None)
+        every = self.sampling.get(code)
+        if not every:
+            return True
+        count = self.counts[code]
+        self.counts[code] = count + 1
+        return count % every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    DeferredQueueHandler queues the records without formatting them, the message
+    is built from its arguments by the listener thread. The arguments must not be
+    modified after the logging call, the frames are immutable strings.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    JSONFormatter renders a record as a JSON line {"t", "level", "code", "dir", "msg"}.
+    """
+
+    def format(self, record):
+        return json.dumps({
+            't': record.created,
+            'level': record.levelname,
+            'code': getattr(record, 'code', None),
+            'dir': getattr(record, 'dir', None),
+            'msg': record.getMessage(),
+        })
+
+
+def setup_logging(path=None, sampling=None, max_bytes=10 << 20, backups=5):
+    """
+    setup_logging sends the log records through a queue to a background thread,
+    which writes them to the console or to rotating JSONL files. The progress
+    messages of the console logger go through the same queue, whatever the log
+    level, so they don't interleave with the records, and are written to the
+    console with a log file too.
+
+    :param path: the log file, None for the console
+    :param sampling: dict {command code: N} to log one frame in N of these codes
+    :param max_bytes: size of a log file before rotation
+    :param backups: number of rotated files kept
+    :return: the started QueueListener, to stop at exit
+    """
+    log.setLevel(logging.DEBUG if DEBUG else logging.INFO if LOGGING else logging.WARNING)
+    log.propagate = False
+    screen = logging.StreamHandler(sys.stdout)
+    screen.setFormatter(logging.Formatter('%(message)s'))
+    if path:
+        target = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        target.setFormatter(JSONFormatter())
+        screen.addFilter(logging.Filter(console.name))
+        targets = (target, screen)
     else:
-        return False
+        targets = (screen,)
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+    log.handlers[:] = [handler]
+    listener = QueueListener(records, *targets)
+    listener.start()
+    return listener
+
+
+####### Commands
+
+class PolarisCommand:
+    """
+    PolarisCommand is the declaration of a command sent to the Polaris.
+
+    The frame template is built once from the names and formats of the arguments
+    so encoding a command is a single str.format() call, the frame of a command
+    without argument (the status queries) is built once and reused.
+    """
+    __slots__ = ('code', 'channel', 'fields', 'template', 'frame')
+
+    def __init__(self, code, channel, fields=()):
+        """
+        :param code: the 3 digits command code
+        :param channel: the number following the code in the frame, 2 or 3
+        :param fields: sequence of (name, format spec) of the arguments in frame order
+        """
+        self.code = code
+        self.channel = channel
+        self.fields = tuple(name for (name, spec) in fields)
+        if fields:
+            self.template = f"1&{code}&{channel}&" + "".join(f"{name}:{{:{spec}}};" for (name, spec) in fields) + "#"
+            self.frame = None
+        else:
+            self.template = None
+            self.frame = f"1&{code}&{channel}&-1#"
+
+    def encode(self, *values):
+        """
+        encode returns the frame of the command.
+
+        :param values: the arguments in the order of the fields
+        """
+        return self.frame or self.template.format(*values)
+
+    def __repr__(self):
+        return f"PolarisCommand({self.code}, {self.frame or self.template})"
+
+
+class PolarisReply:
+    """
+    PolarisReply is the base of the decoded frames received from the Polaris.
+
+    The subclasses are built by reply_type() from the declaration of their
+    arguments, the values are converted once when the frame is decoded and the
+    missing or empty ones are None. The arguments are split on the first ':' and
+    the trailing ';' is optional (the 780 and 782 replies have none).
+    """
+    __slots__ = ()
+    fields = {}
+
+    def __init__(self, args):
+        fields = self.fields
+        for attr in self.__slots__:
+            setattr(self, attr, None)
+        for item in args.split(';'):
+            (key, _, value) = item.partition(':')
+            field = fields.get(key)
+            if field is None or not value:
+                continue
+            (attr, kind) = field
+            # the 518 heading repeats w, x, y, z, the first quaternion is kept
+            if getattr(self, attr) is None:
+                setattr(self, attr, kind(value))
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{attr}={getattr(self, attr)!r}' for attr in self.__slots__)})"
+
+
+def reply_type(name, fields):
+    """
+    reply_type returns a new PolarisReply subclass.
+
+    :param name: the class name
+    :param fields: sequence of (key, attribute, type) of the arguments, key is the
+    argument name in the frame and type converts its value
+    """
+    return type(name, (PolarisReply,), {
+        '__slots__': tuple(attr for (key, attr, kind) in fields),
+        'fields': {key: (attr, kind) for (key, attr, kind) in fields},
+    })
+
+
+class RawReply(PolarisReply):
+    """
+    RawReply is a frame without declared reply type, its arguments are kept as strings.
+    """
+    __slots__ = ('args',)
+
+    def __init__(self, args):
+        self.args = polaris_parse_args(args)
+
 
 def polaris_parse_args(args_str):
-    # chop the last ";" and split
-    args = args_str[:-1].split(";")
+    """
+    polaris_parse_args returns the arguments of a frame as a dict of strings,
+    an argument without ':' (like the 525 temperature) is kept with an empty value.
+    """
     arg_dict = {}
-    for arg in args:
-        (name, value) = arg.split(":")
-        arg_dict[name] = value
+    for arg in args_str.split(";"):
+        if arg:
+            (name, _, value) = arg.partition(":")
+            arg_dict[name] = value
     return arg_dict
 
-def polaris_parse_cmd(cmd, args):
-    global response_queues
-    if cmd == "284":
-        arg_dict = polaris_parse_args(args)
-        polaris_current_mode = int(arg_dict['mode'])
-        if DEBUG:
-            print(f"<<< Polaris: current mode is {polaris_current_mode}")
-        if cmd in response_queues:
-            response_queues[cmd].put_nowait(arg_dict)
 
-    elif cmd == "518":
-        None
+POLARIS_COMMANDS = {cmd.code: cmd for cmd in (
+    PolarisCommand('284', 2),
+    PolarisCommand('285', 2, (('mode', 'd'),)),
+    PolarisCommand('513', 3, (('speed', 'd'),)),
+    PolarisCommand('514', 3, (('speed', 'd'),)),
+    PolarisCommand('517', 3),
+    PolarisCommand('519', 3, (('state', 'd'), ('yaw', '.5f'), ('pitch', '.5f'), ('lat', '.5f'), ('track', 'd'), ('speed', 'd'), ('lng', '.5f'))),
+    PolarisCommand('520', 2, (('state', 'd'),)),
+    PolarisCommand('521', 3, (('speed', 'd'),)),
+    PolarisCommand('523', 3, (('axis', 'd'),)),
+    PolarisCommand('524', 3),
+    PolarisCommand('527', 3, (('compass', 'd'), ('lat', '.5f'), ('lng', '.5f'))),
+    PolarisCommand('530', 3, (('step', 'd'), ('yaw', '.5f'), ('pitch', '.5f'), ('lat', '.5f'), ('num', 'd'), ('lng', '.5f'))),
+    PolarisCommand('531', 3, (('state', 'd'), ('speed', 'd'))),
+    PolarisCommand('532', 3, (('key', 'd'), ('state', 'd'), ('level', 'd'))),
+    PolarisCommand('533', 3, (('key', 'd'), ('state', 'd'), ('level', 'd'))),
+    PolarisCommand('534', 3, (('key', 'd'), ('state', 'd'), ('level', 'd'))),
+    PolarisCommand('775', 2),
+    PolarisCommand('778', 2),
+    PolarisCommand('780', 2),
+)}
+
+def polaris_command(code):
+    """
+    polaris_command returns the PolarisCommand of code, a query without argument
+    for the codes not declared.
+    """
+    command = POLARIS_COMMANDS.get(code)
+    return command if command else PolarisCommand(code, 2)
+
+
+RetReply = reply_type('RetReply', (('ret', 'ret', int),))
+StateReply = reply_type('StateReply', (('state', 'state', int),))
+ModeReply = reply_type('ModeReply', (
+    ('mode', 'mode', int), ('state', 'state', int), ('track', 'track', int), ('speed', 'speed', int),
+    ('halfSpeed', 'half_speed', int), ('remNum', 'remaining', int), ('runTime', 'run_time', int), ('photoNum', 'photos', int)))
+ModeChangeReply = reply_type('ModeChangeReply', (('mode', 'mode', int), ('ret', 'ret', int)))
+AnglesReply = reply_type('AnglesReply', (('yaw', 'yaw', float), ('pitch', 'pitch', float), ('roll', 'roll', float)))
+HeadingReply = reply_type('HeadingReply', (
+    ('w', 'w', float), ('x', 'x', float), ('y', 'y', float), ('z', 'z', float), ('compass', 'compass', float), ('alt', 'alt', float)))
+GotoReply = reply_type('GotoReply', (('ret', 'ret', int), ('track', 'track', int)))
+AlignmentReply = reply_type('AlignmentReply', (('step', 'step', int), ('ret', 'ret', int)))
+StorageReply = reply_type('StorageReply', (
+    ('status', 'status', int), ('totalspace', 'total', int), ('freespace', 'free', int), ('usespace', 'used', int)))
+BatteryReply = reply_type('BatteryReply', (('capacity', 'capacity', int), ('charge', 'charge', int)))
+FirmwareReply = reply_type('FirmwareReply', (('hw', 'hardware', str), ('sw', 'software', str), ('exAxis', 'axis', str), ('sv', 'sv', int)))
+ErrorReply = reply_type('ErrorReply', (('errorCode', 'error', int),))
+
+POLARIS_REPLIES = {
+    '284': ModeReply,
+    '285': ModeChangeReply,
+    '517': AnglesReply,
+    '518': HeadingReply,
+    '519': GotoReply,
+    '520': RetReply,
+    '524': StateReply,
+    '527': RetReply,
+    '530': AlignmentReply,
+    '531': RetReply,
+    '775': StorageReply,
+    '778': BatteryReply,
+    '780': FirmwareReply,
+    '782': RetReply,
+    '797': ErrorReply,
+    '799': RetReply,
+    '808': RetReply,
+}
+
+def polaris_decode(cmd, args):
+    """
+    polaris_decode returns the typed reply of a frame received from the Polaris.
+
+    :param cmd: the 3 digits command code
+    :param args: the text between '@' and '#'
+    :raise ValueError: if a numeric argument can't be converted
+    """
+    return POLARIS_REPLIES.get(cmd, RawReply)(args)
 
-    elif cmd == "519":
-        arg_dict = polaris_parse_args(args)
-        if DEBUG:
-            print(f"<<< Polaris: response to command 'goto' ({cmd}) received")
-        if cmd in response_queues:
-            response_queues[cmd].put_nowait(arg_dict)
 
-    else:
-        if DEBUG and (cmd != "518" or LOG518):
-            print(f"<<< Polaris: response to command {cmd} received")
+####### Polaris
+
+polaris_current_mode = -1
+
+class PolarisFrameParser:
+    """
+    PolarisFrameParser splits the Polaris TCP stream into frames.
+
+    The stream is a sequence of `NNN@args#` frames (plus the `h#` heartbeat),
+    several of them may be coalesced in one TCP segment and a frame may be split
+    across segments. Incoming bytes are appended to a reusable bytearray, every
+    complete frame is returned by feed() and the offset of the bytes already
+    searched for the '#' terminator is kept, so no byte is ever scanned twice.
+    """
+
+    def __init__(self, max_size=65536):
+        """
+        :param max_size: size in bytes of the pending data above which an unterminated
+        frame is considered garbage and dropped
+        """
+        self.buffer = bytearray()
+        self.scan = 0
+        self.max_size = max_size
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """
+        feed appends data to the pending buffer and returns the complete frames.
+
+        :param data: bytes received from the Polaris
+        :return: a list of (cmd, args) string tuples, cmd is the 3 digits command code
+        (or 'h' for the heartbeat) and args the text between '@' and '#'
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        end = buffer.find(b'#', self.scan)
+        with memoryview(buffer) as view:
+            while end >= 0:
+                if end - start > 3 and buffer[start + 3] == 0x40 and view[start:start + 3].tobytes().isdigit():
+                    frames.append((str(view[start:start + 3], 'latin-1'), str(view[start + 4:end], 'latin-1')))
+                elif end - start == 1 and buffer[start] == 0x68:
+                    frames.append(('h', ''))
+                elif end > start:
+                    self.errors += 1
+                start = end + 1
+                end = buffer.find(b'#', start)
+        if start:
+            del buffer[:start]
+        if len(buffer) > self.max_size:
+            self.errors += 1
+            buffer.clear()
+        self.scan = len(buffer)
+        self.frames += len(frames)
+        return frames
+
+class PolarisRequest:
+    """
+    PolarisRequest is a command sent to the Polaris waiting for its reply.
+
+    Some commands are answered more than once (the 519 goto replies `ret:1` when the
+    slew starts then `ret:0` when it ends), the request stays pending until the
+    final predicate accepts a reply. A request forgotten before its final reply
+    keeps its place until that reply is received or the forgotten time is past.
+    """
+    __slots__ = ('cmd', 'future', 'final', 'on_reply', 'replies', 'timeout', 'forgotten')
+
+    def __init__(self, cmd, future, final=None, on_reply=None):
+        self.cmd = cmd
+        self.future = future
+        self.final = final
+        self.on_reply = on_reply
+        self.replies = 0
+        self.timeout = None
+        self.forgotten = None
+
 
+class PolarisClient:
+    """
+    PolarisClient owns the TCP connection to the Polaris and correlates the replies
+    with the commands sent.
+
+    Every request gets its own future, requests with the same command code are
+    answered in FIFO order so several of them may be in flight at the same time,
+    and each wait is bounded by a timeout. Frames nobody waits for are dropped
+    unless a listener is subscribed to their command code.
+
+    The commands are not written by their callers but pushed to a bounded outgoing
+    queue drained by a single writer task, so whatever the number of Stellarium
+    clients and background tasks sending commands the Polaris receives them whole
+    and in order, and a slow link slows the senders down instead of growing an
+    unbounded write buffer.
+    """
+    max_queued = 64
+
+    def __init__(self, reader=None, writer=None, timeout=None):
+        """
+        :param reader: the asyncio stream reader of the Polaris connection
+        :param writer: the asyncio stream writer of the Polaris connection, None if the
+        connection is opened later with attach()
+        :param timeout: default timeout in seconds when waiting for a reply
+        """
+        self.reader = reader
+        self.writer = writer
+        self.timeout = polaris_timeout if timeout is None else timeout
+        self.parser = PolarisFrameParser()
+        self.outgoing = asyncio.Queue(self.max_queued)
+        self.overflow = set()
+        self.sent = 0
+        self.frames = {}
+        self.pending = {}
+        self.late = 0
+        self.listeners = {}
+        self.raw_listeners = {}
+        self.recorder = None
+        self.closed = None if writer else ConnectionError("Polaris not connected")
+
+    @classmethod
+    async def connect(cls, host, port, timeout=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, timeout)
+
+    def attach(self, reader, writer):
+        """
+        attach makes the client use a new connection to the Polaris, the listeners
+        are kept, the commands queued for the previous connection are dropped.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.parser = PolarisFrameParser()
+        for task in self.overflow:
+            task.cancel()
+        while not self.outgoing.empty():
+            self.outgoing.get_nowait()
+        self.closed = None
+
+    async def send(self, msg):
+        """
+        send writes a command to the Polaris without waiting for any reply.
+
+        :param msg: the complete command frame, e.g. "1&284&2&-1#"
+        """
+        if self.closed:
+            raise self.closed
+        await self.outgoing.put(msg)
+
+    def send_nowait(self, msg):
+        """
+        send_nowait queues a command from synchronous code (e.g. a finally clause
+        stopping the axes), if the queue is full a task queues it once there is room,
+        the write_loop stays the only writer so the command is never sent ahead of
+        or in the middle of the queued ones.
+        """
+        if self.closed:
+            return
+        try:
+            self.outgoing.put_nowait(msg)
+        except asyncio.QueueFull:
+            task = asyncio.get_running_loop().create_task(self.outgoing.put(msg))
+            self.overflow.add(task)
+            task.add_done_callback(self.overflow.discard)
+
+    async def write_loop(self):
+        """
+        write_loop is the only writer of the Polaris connection, the commands queued
+        while the previous write was draining are sent together.
+        """
+        while True:
+            msgs = [await self.outgoing.get()]
+            while not self.outgoing.empty():
+                msgs.append(self.outgoing.get_nowait())
+            for msg in msgs:
+                if DEBUG:
+                    log.debug(">>> Polaris: msg: %s", msg, extra={'code': msg[2:5], 'dir': '>'})
+                if self.recorder:
+                    self.recorder.record('>', msg)
+            self.writer.write(''.join(msgs).encode())
+            self.sent += len(msgs)
+            await self.writer.drain()
+
+    def expect(self, cmd, final=None, on_reply=None):
+        """
+        expect registers a pending request for the next reply with command code cmd,
+        it should be called before sending the command so a fast reply can't be missed.
+
+        :param cmd: the 3 digits command code of the expected reply
+        :param final: predicate on the decoded reply, True if no more reply is expected
+        :param on_reply: callback called with the decoded intermediate replies
+        :return: the PolarisRequest to pass to wait()
+        """
+        if self.closed:
+            raise self.closed
+        request = PolarisRequest(cmd, asyncio.get_running_loop().create_future(), final, on_reply)
+        self.pending.setdefault(cmd, deque()).append(request)
+        return request
+
+    async def wait(self, request, timeout=None):
+        """
+        wait for the final reply of a pending request.
+
+        :param request: the PolarisRequest returned by expect()
+        :param timeout: timeout in seconds, the client default timeout if None
+        :return: the decoded final reply
+        :raise asyncio.TimeoutError: if the reply is not received in time
+        """
+        request.timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(request.future, request.timeout)
+        finally:
+            self.forget(request)
+
+    async def request(self, cmd, msg, timeout=None, final=None, on_reply=None):
+        """
+        request sends a command and waits for its final reply.
+
+        :param cmd: the 3 digits command code of the reply
+        :param msg: the complete command frame
+        :param timeout: timeout in seconds, the client default timeout if None
+        :param final: predicate on the decoded reply, True if no more reply is expected
+        :param on_reply: callback called with the decoded intermediate replies
+        :return: the decoded final reply
+        """
+        request = self.expect(cmd, final, on_reply)
+        try:
+            await self.send(msg)
+        except BaseException:
+            self.forget(request, sent=False)
+            raise
+        return await self.wait(request, timeout)
+
+    def forget(self, request, sent=True):
+        """
+        forget stops waiting for a request (after a timeout or a cancellation).
+
+        The command was sent, its late replies would be taken for the replies of the
+        next request with the same command code (the final 519 of a superseded goto
+        completing the next goto), so the request keeps its place in the FIFO until
+        its final reply, which is dropped. If that reply doesn't come within another
+        timeout of the request the place is released.
+
+        :param sent: False if the command was never queued, no reply is expected
+        """
+        waiting = self.pending.get(request.cmd)
+        if waiting and request in waiting:
+            if sent:
+                request.forgotten = time.monotonic() + (self.timeout if request.timeout is None else request.timeout)
+            else:
+                waiting.remove(request)
+        if not request.future.done():
+            request.future.cancel()
+
+    def subscribe(self, cmd, callback, raw=False):
+        """
+        subscribe calls callback with the decoded reply (see polaris_decode) of every frame
+        received with command code cmd, including the unsolicited ones like the 518 stream.
+        If raw is True callback is called with the arguments string, not parsed.
+        """
+        listeners = self.raw_listeners if raw else self.listeners
+        listeners.setdefault(cmd, []).append(callback)
+
+    def unsubscribe(self, cmd, callback):
+        for listeners in (self.listeners, self.raw_listeners):
+            if callback in listeners.get(cmd, ()):
+                listeners[cmd].remove(callback)
+
+    def dispatch(self, cmd, args):
+        """
+        dispatch delivers a frame received from the Polaris to the listeners and to
+        the oldest pending request with the same command code.
+        """
+        if DEBUG and cmd != "518":
+            log.debug("<<< Polaris: response to command %s received", cmd)
+        raw_listeners = self.raw_listeners.get(cmd)
+        if raw_listeners:
+            for callback in raw_listeners:
+                callback(args)
+        waiting = self.pending.get(cmd)
+        listeners = self.listeners.get(cmd)
+        if not waiting and not listeners:
+            return
+        try:
+            reply = polaris_decode(cmd, args)
+        except ValueError:
+            self.parser.errors += 1
+            return
+        if listeners:
+            for callback in listeners:
+                callback(reply)
+        while waiting:
+            request = waiting[0]
+            if request.forgotten is not None:
+                if time.monotonic() > request.forgotten:
+                    # its reply was lost, the reply is for the next request
+                    waiting.popleft()
+                    continue
+                # a late reply to a forgotten request, dropped
+                self.late += 1
+                if request.final is None or request.final(reply):
+                    waiting.popleft()
+                break
+            if request.future.done():
+                waiting.popleft()
+                continue
+            request.replies += 1
+            if request.final is None or request.final(reply):
+                waiting.popleft()
+                request.future.set_result(reply)
+            elif request.on_reply:
+                request.on_reply(reply)
+            break
 
-async def polaris_start_stop_tracking(writer, tracking):
+    def close(self, exc=None):
+        """
+        close fails all the pending requests so no caller waits forever on a dead link.
+        """
+        self.closed = exc or ConnectionError("Polaris connection closed")
+        for waiting in self.pending.values():
+            for request in waiting:
+                if not request.future.done():
+                    request.future.set_exception(self.closed)
+            waiting.clear()
+        for task in self.overflow:
+            task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    async def heartbeat(self, interval=5.0, timeout=None):
+        """
+        heartbeat sends the h# ping every interval seconds, the Polaris echoes it.
+        Without echo the connection is considered dead and aborted so run() returns
+        and the pending requests fail right away.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.request('h', "h#", timeout)
+            except ConnectionError:
+                return
+            except asyncio.TimeoutError:
+                console.info("Polaris heartbeat lost")
+                self.writer.transport.abort()
+                return
+
+    async def run(self):
+        """
+        run reads the frames from the Polaris and dispatches them until the connection
+        is closed, the writer task runs alongside.
+        """
+        writer_task = asyncio.create_task(self.write_loop())
+        try:
+            while True:
+                data = await self.reader.read(4096)
+                if not data:
+                    break
+                if self.recorder:
+                    self.recorder.record('<', data.decode('latin-1'))
+                for (cmd, args) in self.parser.feed(data):
+                    self.frames[cmd] = self.frames.get(cmd, 0) + 1
+                    # the 518 stream is logged decimated by telemetry_logger, sampled in debug
+                    if LOGGING and cmd == 'h':
+                        log.info("<<< Polaris: h#", extra={'code': cmd, 'dir': '<'})
+                    elif LOGGING and (cmd != "518" or DEBUG):
+                        log.info("<<< Polaris: %s@%s#", cmd, args, extra={'code': cmd, 'dir': '<'})
+                    self.dispatch(cmd, args)
+        finally:
+            writer_task.cancel()
+            self.close(ConnectionError("Polaris connection lost"))
+
+
+async def polaris_start_stop_tracking(client, tracking):
     """
     polaris_start_stop_tracking is used to start or stop tracking
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param tracking: if 1 start tracking at star rotation speed, 0 don't track
     """
     if tracking:
         if LOGGING:
-            print(">>> Polaris: Start tracking")
+            log.info(">>> Polaris: Start tracking")
         state = 1
     else:
         if LOGGING:
-            print(">>> Polaris: Stop tracking")
+            log.info(">>> Polaris: Stop tracking")
         state = 0
-    await polaris_send_msg(writer, f"1&531&3&state:{state};speed:0;#")
+    await client.send(POLARIS_COMMANDS['531'].encode(state, 0))
 
 
-async def polaris_goto(writer, az, alt, tracking):
+async def polaris_goto(client, az, alt, tracking, yaw=None, site=None):
     """
     polaris_goto is used to turn the head to point in (az, alt) direction.
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param az: is the azimuth to point, 0° < az < 360°
     :param alt: is the altitude to point, -90° < alt < 90° (but the Polaris is hardware limited)
     :param tracking: if 1 start tracking at star rotation speed, 0 don't track
+    :param yaw: the yaw to send, chosen by the SlewPlanner for the corrected az, None for the -180..180 one
+    :param site: the PolarisSite of the head, None for the one of the command line
     """
-    
-    global response_queues
-    await polaris_start_stop_tracking(writer, False)
+    site = site or current_site()
+
+    await polaris_start_stop_tracking(client, False)
 
     if tracking:
         track = 1
     else:
         track = 0
 
+    if site.model:
+        (az, alt) = site.model.apply(az, alt)
+
     # azimuth az should be transformed before being sent to the Polaris -180° < polaris_az < 180°
-    polaris_az = 360 - az if az>180 else -az
+    polaris_az = (360 - az if az>180 else -az) if yaw is None else yaw
     cmd = '519'
-    msg = f"1&{cmd}&3&state:1;yaw:{polaris_az:.5f};pitch:{alt:.5f};lat:{lat:.5f};track:{track};speed:0;lng:{lon:.5f};#"
+    msg = POLARIS_COMMANDS[cmd].encode(1, polaris_az, alt, site.lat, track, 0, site.lon)
     if LOGGING:
-        print(f">>> Polaris: Goto Az.:{az:.5f} Alt.:{alt:.5f}")
-    response_queues[cmd] = asyncio.Queue()
-    await polaris_send_msg(writer, msg)
-    ret_dict = await response_queues[cmd].get()
-    
+        log.info(">>> Polaris: Goto Az.:%.5f Alt.:%.5f", az, alt)
+    reply = await client.request(cmd, msg, polaris_goto_timeout, final=polaris_goto_done, on_reply=polaris_goto_started)
+
     if DEBUG:
-        print(f"<<< Polaris: result for cmd: {cmd} {ret_dict}")
+        log.debug("<<< Polaris: 2nd result for cmd: %s %s", cmd, reply)
+    return reply
 
-    if 'ret' in ret_dict:
-        goto_result = int(ret_dict['ret'])
-        if goto_result == 1:
-            ret_dict = await response_queues[cmd].get()
-            if DEBUG:
-                print(f"<<< Polaris: 2nd result for cmd: {cmd} {ret_dict}")
 
-    del response_queues[cmd]
-    return ret_dict
+def polaris_goto_done(reply):
+    # the goto is answered with ret:1 when the head starts moving then ret:0 (or ret:-1)
+    return reply.ret != 1
+
+def polaris_goto_started(reply):
+    if DEBUG:
+        log.debug("<<< Polaris: result for cmd: 519 %s", reply)
+
+
+async def polaris_abort_goto(client, yaw, pitch, site=None):
+    """
+    polaris_abort_goto is used to stop the head during a goto, the protocol has no
+    stop command so the head is sent without tracking to the position of its last
+    518 heading.
+
+    :param client: is used to send commands to the Polaris
+    :param yaw: the 519 yaw of the head in degrees, on its current turn
+    :param pitch: the altitude of the head in degrees
+    :param site: the PolarisSite of the head, None for the one of the command line
+    """
+    site = site or current_site()
+    await polaris_start_stop_tracking(client, False)
+    cmd = '519'
+    msg = POLARIS_COMMANDS[cmd].encode(1, yaw, pitch, site.lat, 0, 0, site.lon)
+    if LOGGING:
+        log.info(">>> Polaris: Abort goto at yaw: %.5f pitch: %.5f", yaw, pitch)
+    return await client.request(cmd, msg, polaris_goto_timeout, final=polaris_goto_done)
 
 
-async def polaris_move(writer, az_axis, alt_axis, astro_axis, time):
+async def polaris_move(client, az_axis, alt_axis, astro_axis, time):
     """
     polaris_move is used to turn the head around the Azm and Alt axis at some speed
     and duration a fixed amount of time.
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param az_axis: rotation speed around the Azm axis between -5 and 5
     :param alt_axis: rotation speed around the Alt axis between -5 and 5
     :param astro_axis: rotation speed around the Astro axis between -5 and 5
     :param time: duration of the rotation in seconds
     """
-    global response_queues
-    cmd_az = '532'
-    cmd_alt = '533'
-    cmd_astro = '534'
-    
-    if az_axis != 0:
-        if az_axis > 0:
-            level = az_axis if az_axis <= 5 else 5
-            msg = f"1&{cmd_az}&3&key:0;state:1;level:{level};#"
-        else:
-            level = -az_axis if az_axis >= -5 else 5
-            msg = f"1&{cmd_az}&3&key:1;state:1;level:{level};#"
-        await polaris_send_msg(writer, msg)
-
-    if alt_axis != 0:
-        if alt_axis > 0:
-            level = alt_axis if alt_axis <= 5 else 5
-            msg = f"1&{cmd_alt}&3&key:0;state:1;level:{level};#"
-        else:
-            level = -alt_axis if alt_axis >= -5 else 5
-            msg = f"1&{cmd_alt}&3&key:1;state:1;level:{level};#"
-        await polaris_send_msg(writer, msg)
-
-    if astro_axis != 0:
-        if astro_axis > 0:
-            level = astro_axis if astro_axis <= 5 else 5
-            msg = f"1&{cmd_astro}&3&key:0;state:1;level:{level};#"
-        else:
-            level = -astro_axis if astro_axis >= -5 else 5
-            msg = f"1&{cmd_astro}&3&key:1;state:1;level:{level};#"
-        await polaris_send_msg(writer, msg)
+    moves = [(cmd, speed) for (cmd, speed) in (('532', az_axis), ('533', alt_axis), ('534', astro_axis)) if speed != 0]
+
+    for (cmd, speed) in moves:
+        await client.send(polaris_adjust_frame(cmd, speed, 1))
 
     await asyncio.sleep(time)
 
-    if az_axis != 0:
-        if az_axis > 0:
-            level = az_axis if az_axis <= 5 else 5
-            msg = f"1&{cmd_az}&3&key:0;state:0;level:{level};#"
-        else:
-            level = -az_axis if az_axis >= -5 else 5
-            msg = f"1&{cmd_az}&3&key:1;state:0;level:{level};#"
-        await polaris_send_msg(writer, msg)
-
-    if alt_axis != 0:
-        if alt_axis > 0:
-            level = alt_axis if alt_axis <= 5 else 5
-            msg = f"1&{cmd_alt}&3&key:0;state:0;level:{level};#"
-        else:
-            level = -alt_axis if alt_axis >= -5 else 5
-            msg = f"1&{cmd_alt}&3&key:1;state:0;level:{level};#"
-        await polaris_send_msg(writer, msg)
-
-    if astro_axis != 0:
-        if astro_axis > 0:
-            level = astro_axis if astro_axis <= 5 else 5
-            msg = f"1&{cmd_astro}&3&key:0;state:0;level:{level};#"
-        else:
-            level = -astro_axis if astro_axis >= -5 else 5
-            msg = f"1&{cmd_astro}&3&key:1;state:0;level:{level};#"
-        await polaris_send_msg(writer, msg)
+    for (cmd, speed) in moves:
+        await client.send(polaris_adjust_frame(cmd, speed, 0))
 
 
-async def polaris_stop_move(writer):
+def polaris_adjust_frame(cmd, speed, state):
     """
-    polaris_move is used to stop the rotation on both Azm, Alt and Astro axis.
-
-    :param writer: is used to send commands to the Polaris
+    polaris_adjust_frame returns the 532, 533 or 534 frame starting (state 1) or
+    stopping (state 0) the rotation of an axis, the sign of speed gives the direction.
     """
-    
-    global response_queues
-    cmd_az = '532'
-    cmd_alt = '533'
-    cmd_astro = '534'
+    key = 0 if speed > 0 else 1
+    level = min(abs(int(speed)), 5)
+    return POLARIS_COMMANDS[cmd].encode(key, state, level)
+
 
-    level = 0
-    msg = f"1&{cmd_az}&3&key:0;state:0;level:{level};#"
-    await polaris_send_msg(writer, msg)
+async def polaris_stop_move(client):
+    """
+    polaris_move is used to stop the rotation on both Azm, Alt and Astro axis.
 
-    msg = f"1&{cmd_alt}&3&key:1;state:0;level:{level};#"
-    await polaris_send_msg(writer, msg)
+    :param client: is used to send commands to the Polaris
+    """
     
-    msg = f"1&{cmd_astro}&3&key:1;state:0;level:{level};#"
-    await polaris_send_msg(writer, msg)
+    await client.send(POLARIS_COMMANDS['532'].encode(0, 0, 0))
+    await client.send(POLARIS_COMMANDS['533'].encode(1, 0, 0))
+    await client.send(POLARIS_COMMANDS['534'].encode(1, 0, 0))
 
 
-async def polaris_test_move(writer):
-    global response_queues
+async def polaris_test_move(client):
     await asyncio.sleep(10)
     
     # speed of the rotation 1 (slowest) ... 5 (fastest)
@@ -249,325 +861,2510 @@ async def polaris_test_move(writer):
     # duration of the rotation in seconds
     duration = 20
     
-    print("Polaris testing move commands...")
-    print("Stop tracking...")
-    await polaris_start_stop_tracking(writer, 0)
-    print("Move on az axis...")
-    await polaris_move(writer, speed, 0, 0, duration)
+    console.info("Polaris testing move commands...")
+    console.info("Stop tracking...")
+    await polaris_start_stop_tracking(client, 0)
+    console.info("Move on az axis...")
+    await polaris_move(client, speed, 0, 0, duration)
     await asyncio.sleep(3)
-    print("Move in opposite direction on az axis...")
-    await polaris_move(writer, -speed, 0, 0, duration)
+    console.info("Move in opposite direction on az axis...")
+    await polaris_move(client, -speed, 0, 0, duration)
     await asyncio.sleep(3)
-    print("Move on alt axis...")
-    await polaris_move(writer, 0, speed, 0, duration)
+    console.info("Move on alt axis...")
+    await polaris_move(client, 0, speed, 0, duration)
     await asyncio.sleep(3)
-    print("Move in opposite direction on alt axis...")
-    await polaris_move(writer, 0, -speed, 0, duration)
+    console.info("Move in opposite direction on alt axis...")
+    await polaris_move(client, 0, -speed, 0, duration)
     await asyncio.sleep(3)
-    print("Move on astro axis...")
-    await polaris_move(writer, 0, 0, speed, duration)
+    console.info("Move on astro axis...")
+    await polaris_move(client, 0, 0, speed, duration)
     await asyncio.sleep(3)
-    print("Move in opposite direction on astro axis...")
-    await polaris_move(writer, 0, 0, -speed, duration)
+    console.info("Move in opposite direction on astro axis...")
+    await polaris_move(client, 0, 0, -speed, duration)
     await asyncio.sleep(3)
-    print("Move on both axis...")
-    await polaris_move(writer, speed, speed, speed, duration)
+    console.info("Move on both axis...")
+    await polaris_move(client, speed, speed, speed, duration)
     await asyncio.sleep(3)
-    print("Move in opposite direction on both axis...")
-    await polaris_move(writer, -speed, -speed, -speed, duration)
+    console.info("Move in opposite direction on both axis...")
+    await polaris_move(client, -speed, -speed, -speed, duration)
     await asyncio.sleep(3)
-    print("Stop moving...")
-    await polaris_stop_move(writer)
+    console.info("Stop moving...")
+    await polaris_stop_move(client)
     await asyncio.sleep(1)
-    print ("End testing move commands")
+    console.info("End testing move commands")
 
 
-async def polaris_reset_rotation(writer, az_axis, alt_axis, astro_axis):
+async def polaris_reset_rotation(client, az_axis, alt_axis, astro_axis):
     """
     polaris_reset_rotation is used to reset the rotation around the 3 axis,
     going home position
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param az_axis: if true reset the Azm axis
     :param alt_axis: if true reset the Alt axis
     :param astro_axis: if true reset the Astro axis
     """
-    cmd = '523'
-    if az_axis:
-        msg = f"1&523&3&axis:1;#"
-        await polaris_send_msg(writer, msg)
-        
-    if alt_axis:
-        msg = f"1&523&3&axis:2;#"
-        await polaris_send_msg(writer, msg)
-    
-    if astro_axis:
-        msg = f"1&523&3&axis:3;#"
-        await polaris_send_msg(writer, msg)
+    command = POLARIS_COMMANDS['523']
+    for (axis, reset) in ((1, az_axis), (2, alt_axis), (3, astro_axis)):
+        if reset:
+            await client.send(command.encode(axis))
     
 
-async def polaris_test_reset_rotation(writer):
+async def polaris_test_reset_rotation(client):
     await asyncio.sleep(10)
-    print("Reset rotation on az axis...")
-    await polaris_reset_rotation(writer, True, 0, 0)
+    console.info("Reset rotation on az axis...")
+    await polaris_reset_rotation(client, True, 0, 0)
     await asyncio.sleep(5)
-    print("Reset rotation on alt axis...")
-    await polaris_reset_rotation(writer, 0, True, 0)
+    console.info("Reset rotation on alt axis...")
+    await polaris_reset_rotation(client, 0, True, 0)
     await asyncio.sleep(5)
-    print("Reset rotation on astro axis...")
-    await polaris_reset_rotation(writer, 0, 0, True)
+    console.info("Reset rotation on astro axis...")
+    await polaris_reset_rotation(client, 0, 0, True)
+
 
+class MotionEngine:
+    """
+    MotionEngine keeps alive the speed setpoints of the az (513), alt (514) and
+    astro (521) axes: the head stops an axis when its speed frame isn't repeated,
+    so the engine resends every moving axis on each tick, all the axes in one write.
 
-async def polaris_rotate_az(writer, speed, time):
+    Ticks are scheduled on the monotonic clock of the event loop, a late tick
+    doesn't shift the following ones, and speed changes are ramped at accel
+    speed units per second. The engine task only runs while an axis moves.
+    """
+    axes = {'az': '513', 'alt': '514', 'astro': '521'}
+    max_speed = 2000
+
+    def __init__(self, client, rate=None, accel=None):
+        """
+        :param client: is used to send commands to the Polaris
+        :param rate: number of ticks per second
+        :param accel: maximum speed change in speed units per second, 0 for no ramp
+        """
+        self.client = client
+        self.period = 1 / (motion_rate if rate is None else rate)
+        self.accel = motion_accel if accel is None else accel
+        self.target = dict.fromkeys(self.axes, 0)
+        self.speed = dict.fromkeys(self.axes, 0)
+        self.task = None
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.ticks = 0
+        self.overruns = 0
+        self.elapsed = 0.0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+
+    def set_speed(self, axis, speed):
+        """
+        set_speed changes the speed setpoint of an axis.
+
+        :param axis: 'az', 'alt' or 'astro'
+        :param speed: speed between -2000 and 2000, positive value turn clockwise
+        """
+        self.target[axis] = max(-self.max_speed, min(self.max_speed, int(speed)))
+        if self.task is None or self.task.done():
+            self.idle.clear()
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        """
+        stop sets every axis speed to 0 without ramp, the next tick sends the stop frames.
+        """
+        for axis in self.axes:
+            self.target[axis] = 0
+            self.speed[axis] = 0
+
+    async def move(self, duration, az=0, alt=0, astro=0):
+        """
+        move rotates the head around the 3 axes at the given speeds for duration
+        seconds, then ramps the speeds down and waits for the head to be stopped.
+        If move is cancelled the axes are stopped on the next tick.
+        """
+        try:
+            for (axis, speed) in (('az', az), ('alt', alt), ('astro', astro)):
+                self.set_speed(axis, speed)
+            await asyncio.sleep(duration)
+            for axis in self.axes:
+                self.target[axis] = 0
+            await self.idle.wait()
+        except asyncio.CancelledError:
+            self.stop()
+            raise
+
+    def ramp(self, axis):
+        target = self.target[axis]
+        speed = self.speed[axis]
+        if self.accel:
+            step = self.accel * self.period
+            target = max(speed - step, min(speed + step, target))
+        self.speed[axis] = int(target)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start
+        moving = set()
+        try:
+            while True:
+                msg = ""
+                for (axis, cmd) in self.axes.items():
+                    self.ramp(axis)
+                    if self.speed[axis]:
+                        moving.add(axis)
+                        msg += POLARIS_COMMANDS[cmd].encode(self.speed[axis])
+                    elif axis in moving:
+                        moving.discard(axis)
+                        msg += POLARIS_COMMANDS[cmd].encode(0)
+                if msg:
+                    await self.client.send(msg)
+                if not moving:
+                    break
+
+                deadline += self.period
+                now = loop.time()
+                if now > deadline + self.period:
+                    # too late, skip the missed ticks instead of sending them in a burst
+                    self.overruns += 1
+                    deadline = now
+                await asyncio.sleep(deadline - now)
+                jitter = abs(loop.time() - deadline)
+                self.ticks += 1
+                self.jitter_sum += jitter
+                self.jitter_max = max(self.jitter_max, jitter)
+        finally:
+            self.elapsed += loop.time() - start
+            if moving:
+                self.stop()
+                self.client.send_nowait("".join(POLARIS_COMMANDS[self.axes[axis]].encode(0) for axis in moving))
+            self.idle.set()
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'rate': self.ticks / self.elapsed if self.elapsed else 0.0,
+            'jitter_mean': self.jitter_sum / self.ticks if self.ticks else 0.0,
+            'jitter_max': self.jitter_max,
+            'overruns': self.overruns,
+        }
+
+
+motion_engines = weakref.WeakKeyDictionary()
+
+def polaris_motion_engine(client):
+    """
+    polaris_motion_engine returns the MotionEngine of a client, created on first use.
+    """
+    engine = motion_engines.get(client)
+    if engine is None:
+        engine = motion_engines[client] = MotionEngine(client)
+    return engine
+
+
+async def polaris_rotate(client, az_speed, alt_speed, astro_speed, time):
+    """
+    polaris_rotate rotate the head around the 3 axes at the same time
+
+    :param client: is used to send commands to the Polaris
+    :param az_speed: az axis speed between -2000 and 2000, positive value turn clockwise
+    :param alt_speed: alt axis speed between -2000 and 2000, positive value turn clockwise
+    :param astro_speed: astro axis speed between -2000 and 2000, positive value turn clockwise
+    :param time: rotation duration in seconds
+    """
+    engine = polaris_motion_engine(client)
+    await engine.move(time, az_speed, alt_speed, astro_speed)
+    if DEBUG:
+        log.debug("Motion engine: %s", engine.stats())
+
+
+async def polaris_rotate_az(client, speed, time):
     """
     polaris_rotate_az rotate the head around az axis for a given time and speed
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param speed: speed between -2000 and 2000, positive value turn clockwise
     :param time: rotation duration in seconds
     """
-    cmd = '513'
-    msg = f"1&{cmd}&3&speed:0;#"
-    await polaris_send_msg(writer, msg)
-    
-    msg = f"1&513&3&speed:{speed};#"
-    for t in range(0, time*20):
-        await polaris_send_msg(writer, msg)
-        await asyncio.sleep(0.05)
+    await polaris_rotate(client, speed, 0, 0, time)
         
-async def polaris_rotate_alt(writer, speed, time):
+async def polaris_rotate_alt(client, speed, time):
     """
     polaris_rotate_alt rotate the head around alt axis for a given time and speed
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param speed: speed between -2000 and 2000, positive value turn clockwise
     :param time: rotation duration in seconds
     """
-    cmd = '514'
-    msg = f"1&{cmd}&3&speed:0;#"
-    await polaris_send_msg(writer, msg)
-    
-    msg = f"1&{cmd}&3&speed:{speed};#"
-    for t in range(0, time*20):
-        await polaris_send_msg(writer, msg)
-        await asyncio.sleep(0.05)
+    await polaris_rotate(client, 0, speed, 0, time)
         
-async def polaris_rotate_astro(writer, speed, time):
+async def polaris_rotate_astro(client, speed, time):
     """
     polaris_rotate_astro rotate the head around astro axis for a given time and speed
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param speed: speed between -2000 and 2000, positive value turn clockwise
     :param time: rotation duration in seconds
     """
-    cmd = '521'
-    msg = f"1&{cmd}&3&speed:0;#"
-    await polaris_send_msg(writer, msg)
+    await polaris_rotate(client, 0, 0, speed, time)
     
-    msg = f"1&{cmd}&3&speed:{speed};#"
-    for t in range(0, time*20):
-        await polaris_send_msg(writer, msg)
-        await asyncio.sleep(0.05)
-    
-async def polaris_test_rotate(writer):
+async def polaris_test_rotate(client):
     await asyncio.sleep(10)
-    print("Rotate around az axis clockwise at low speed...")
-    await polaris_rotate_az(writer, 500, 10)
+    console.info("Rotate around az axis clockwise at low speed...")
+    await polaris_rotate_az(client, 500, 10)
     await asyncio.sleep(3)
-    print("Rotate around az axis clockwise at hight speed...")
-    await polaris_rotate_az(writer, 2000, 10)
+    console.info("Rotate around az axis clockwise at hight speed...")
+    await polaris_rotate_az(client, 2000, 10)
     await asyncio.sleep(3)
-    print("Rotate around az axis counter clockwise at low speed...")
-    await polaris_rotate_az(writer, -500, 10)
+    console.info("Rotate around az axis counter clockwise at low speed...")
+    await polaris_rotate_az(client, -500, 10)
     await asyncio.sleep(3)
-    print("Rotate around az axis counter clockwise at hight speed...")
-    await polaris_rotate_az(writer, -2000, 10)
+    console.info("Rotate around az axis counter clockwise at hight speed...")
+    await polaris_rotate_az(client, -2000, 10)
     await asyncio.sleep(3)
     
-    print("Rotate around alt axis clockwise at low speed...")
-    await polaris_rotate_alt(writer, 500, 10)
+    console.info("Rotate around alt axis clockwise at low speed...")
+    await polaris_rotate_alt(client, 500, 10)
     await asyncio.sleep(3)
-    print("Rotate around alt axis clockwise at hight speed...")
-    await polaris_rotate_alt(writer, 2000, 10)
+    console.info("Rotate around alt axis clockwise at hight speed...")
+    await polaris_rotate_alt(client, 2000, 10)
     await asyncio.sleep(3)
-    print("Rotate around alt axis counter clockwise at low speed...")
-    await polaris_rotate_alt(writer, -500, 10)
+    console.info("Rotate around alt axis counter clockwise at low speed...")
+    await polaris_rotate_alt(client, -500, 10)
     await asyncio.sleep(3)
-    print("Rotate around alt axis counter clockwise at hight speed...")
-    await polaris_rotate_alt(writer, -2000, 10)
+    console.info("Rotate around alt axis counter clockwise at hight speed...")
+    await polaris_rotate_alt(client, -2000, 10)
     await asyncio.sleep(3)
     
-    print("Rotate around astro axis clockwise at low speed...")
-    await polaris_rotate_astro(writer, 500, 10)
+    console.info("Rotate around astro axis clockwise at low speed...")
+    await polaris_rotate_astro(client, 500, 10)
     await asyncio.sleep(3)
-    print("Rotate around astro axis clockwise at hight speed...")
-    await polaris_rotate_astro(writer, 2000, 10)
+    console.info("Rotate around astro axis clockwise at hight speed...")
+    await polaris_rotate_astro(client, 2000, 10)
     await asyncio.sleep(3)
-    print("Rotate around astro axis counter clockwise at low speed...")
-    await polaris_rotate_astro(writer, -500, 10)
+    console.info("Rotate around astro axis counter clockwise at low speed...")
+    await polaris_rotate_astro(client, -500, 10)
     await asyncio.sleep(3)
-    print("Rotate around astro axis counter clockwise at hight speed...")
-    await polaris_rotate_astro(writer, -2000, 10)
+    console.info("Rotate around astro axis counter clockwise at hight speed...")
+    await polaris_rotate_astro(client, -2000, 10)
     await asyncio.sleep(3)
 
-async def polaris_new_alignment(writer, az, alt):
+async def polaris_new_alignment(client, az, alt, site=None):
     """
     polaris_new_alignment is used to do a new celestial alignment with star at (az,alt)
 
-    :param writer: is used to send commands to the Polaris
+    :param client: is used to send commands to the Polaris
     :param az: the azimut of the star used for celestial alignment
     :param alt: the altitude of the star used for celestial alignment
+    :param site: the PolarisSite of the head, None for the one of the command line
     """
-    global lat, lon
+    site = site or current_site()
     
     # goto (az,alt), stop tracking
-    await polaris_goto(writer, az, alt, 0)
+    await polaris_goto(client, az, alt, 0, site=site)
     
     # celestial alignment step 1
     polaris_az = 360 - az if az>180 else -az
-    cmd = '530'
-    msg = f"1&{cmd}&3&step:1;yaw:{polaris_az};pitch:{alt};lat:{lat};num:1;lng:{lon};#"
-    await polaris_send_msg(writer, msg)
+    command = POLARIS_COMMANDS['530']
+    await client.send(command.encode(1, polaris_az, alt, site.lat, 1, site.lon))
     
     await asyncio.sleep(15) # delay to align the star in the iPhone app
 
     # celestial alignment step 2 (validation)
-    msg = f"1&{cmd}&3&step:2;yaw:{polaris_az};pitch:{alt};lat:{lat};num:1;lng:{lon};#"
-    await polaris_send_msg(writer, msg)
+    await client.send(command.encode(2, polaris_az, alt, site.lat, 1, site.lon))
 
 
-async def polaris_test_new_alignment(writer):
+async def polaris_test_new_alignment(client):
     await asyncio.sleep(10)
-    print("New celestial position alignement...")
-    await polaris_new_alignment(writer, 120, 45)
+    console.info("New celestial position alignement...")
+    await polaris_new_alignment(client, 120, 45)
 
 
-async def polaris_get_current_mode(writer):
-    global response_queues
+async def polaris_get_current_mode(client):
+    global polaris_current_mode
     cmd = '284'
-    msg = f"1&{cmd}&2&-1#"
-    response_queues[cmd] = asyncio.Queue()
-    await polaris_send_msg(writer, msg)
-    ret_dict = await response_queues[cmd].get()
-    del response_queues[cmd]
+    reply = await client.request(cmd, POLARIS_COMMANDS[cmd].encode())
+    if reply.mode is not None:
+        polaris_current_mode = reply.mode
+        if DEBUG:
+            log.debug("<<< Polaris: current mode is %s", polaris_current_mode)
     if DEBUG:
-        print(f"<<< Polaris: result for cmd: {cmd} {ret_dict}")
-    return ret_dict
+        log.debug("<<< Polaris: result for cmd: %s %s", cmd, reply)
+    return reply
 
 
-async def polaris_init(writer):
-    global response_queues
-    print("Polaris communication init...")
-    ret_dict = await polaris_get_current_mode(writer)
+class DeviceState:
+    """
+    DeviceState is the last known state of the Polaris, updated from the 284, 775,
+    778 and 780 frames. The fields are None until their frame is received, updated
+    holds the time of the last frame of each code.
+    """
+    __slots__ = ('hardware', 'software', 'axis_firmware', 'battery', 'charging',
+                 'storage_total', 'storage_free', 'mode', 'state', 'track', 'updated')
+
+    def __init__(self):
+        self.hardware = None
+        self.software = None
+        self.axis_firmware = None
+        self.battery = None
+        self.charging = None
+        self.storage_total = None
+        self.storage_free = None
+        self.mode = None
+        self.state = None
+        self.track = None
+        self.updated = {}
+
+    def age(self, code):
+        """
+        age returns the number of seconds since the last frame of code, None if never received.
+        """
+        t = self.updated.get(code)
+        return None if t is None else time.monotonic() - t
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class StatusPoller:
+    """
+    StatusPoller keeps a DeviceState snapshot of the Polaris so the rest of the
+    bridge reads the battery, storage, firmware or mode without a round trip.
+
+    Every interval seconds the status queries are sent back to back in a single
+    write, like the iPhone app does, and the Polaris answers them in one coalesced
+    segment. The snapshot is updated by listeners, so the frames sent by the
+    Polaris on its own (778 when the battery changes) are taken into account too.
+    """
+
+    def __init__(self, client, codes=('778', '775', '780', '284'), interval=60.0):
+        """
+        :param client: is used to send commands to the Polaris
+        :param codes: the command codes of the status queries
+        :param interval: time between two polls in seconds
+        """
+        self.client = client
+        self.codes = tuple(codes)
+        self.interval = interval
+        self.state = DeviceState()
+        self.polls = 0
+        self.missing = 0
+        for (code, callback) in (('284', self.on_mode), ('775', self.on_storage), ('778', self.on_battery), ('780', self.on_firmware)):
+            client.subscribe(code, callback)
+
+    def on_mode(self, reply):
+        self.state.mode = reply.mode
+        self.state.state = reply.state
+        self.state.track = reply.track
+        self.state.updated['284'] = time.monotonic()
+
+    def on_storage(self, reply):
+        self.state.storage_total = reply.total
+        self.state.storage_free = reply.free
+        self.state.updated['775'] = time.monotonic()
+
+    def on_battery(self, reply):
+        self.state.battery = reply.capacity
+        self.state.charging = None if reply.charge is None else reply.charge != 0
+        self.state.updated['778'] = time.monotonic()
+
+    def on_firmware(self, reply):
+        self.state.hardware = reply.hardware
+        self.state.software = reply.software
+        self.state.axis_firmware = reply.axis
+        self.state.updated['780'] = time.monotonic()
+
+    async def poll(self, timeout=None):
+        """
+        poll sends all the status queries in one write and waits for their replies.
+
+        :return: the number of queries not answered in time
+        """
+        requests = [self.client.expect(code) for code in self.codes]
+        try:
+            await self.client.send(''.join(polaris_command(code).encode() for code in self.codes))
+        except BaseException:
+            for request in requests:
+                self.client.forget(request, sent=False)
+            raise
+        results = await asyncio.gather(*(self.client.wait(request, timeout) for request in requests), return_exceptions=True)
+        missing = sum(isinstance(result, Exception) for result in results)
+        self.polls += 1
+        self.missing += missing
+        if DEBUG:
+            log.debug("Polaris status: %s", self.state.as_dict())
+        return missing
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except ConnectionError:
+                pass
+            await asyncio.sleep(self.interval)
+
+
+async def polaris_init(client):
+    console.info("Polaris communication init...")
+    reply = await polaris_get_current_mode(client)
     if ALLMODES:
-        print(f"Current mode: {ret_dict['mode']}")
+        console.info("Current mode: %s", reply.mode)
     else:
-        if  'mode' in ret_dict and int(ret_dict['mode']) == 8:
-            if 'track' in ret_dict and int(ret_dict['track']) == 3:
-                raise ValueError('Polaris is in astro mode but not properly setup, please finish the astro mode setup with the mobile app.')
-            print("Polaris communication init... done")
+        if reply.mode == 8:
+            if reply.track == 3:
+                raise MountSetupError('Polaris is in astro mode but not properly setup, please finish the astro mode setup with the mobile app.')
+            console.info("Polaris communication init... done")
+        else:
+            raise MountSetupError('Polaris is not in astro mode, please use the mobile app to setup the astro mode.')
+
+
+class SlewPlan:
+    """
+    SlewPlan is a goto prepared by the SlewPlanner: the position to send, the yaw
+    turn chosen and the predicted duration of the slew.
+    """
+    __slots__ = ('az', 'alt', 'yaw', 'wrap', 'start', 'duration', 'lead')
+
+    def __init__(self, az, alt, yaw, wrap, start, duration, lead):
+        self.az = az
+        self.alt = alt
+        self.yaw = yaw
+        self.wrap = wrap
+        self.start = start
+        self.duration = duration
+        self.lead = lead
+
+
+class SlewPlanner:
+    """
+    SlewPlanner prepares the gotos of the GotoScheduler.
+
+    The yaw sent in the 519 goto is the absolute position of the head, the one
+    chosen is the closest to the current yaw within -yaw_limit..yaw_limit, so
+    with a limit above 180° the head doesn't turn the long way round when the
+    target is across the ±180° yaw. The current yaw comes from the 518 compass
+    (see HeadingRecord), an azimuth, unwrapped to the turn of the last known yaw.
+    The slew duration is predicted from the distance on each axis with a
+    trapezoidal speed profile, and when the head tracks the target the position
+    sent is the one of the object at the predicted end of the slew. The yaw is
+    chosen for the azimuth corrected by the pointing model of the site, the one
+    polaris_goto sends, and given to it as is.
+
+    The top speed and the acceleration of each axis are learned from the 518
+    headings received during the slews, the fixed latency from the error between
+    the predicted and actual durations.
+    """
+    sample_interval = 0.25
+    stale_after = 2.0
+
+    def __init__(self, bus, yaw_limit=180.0, speed=6.0, accel=3.0):
+        """
+        :param bus: the TelemetryBus of the 518 heading stream
+        :param yaw_limit: largest absolute yaw in degrees the head may be sent to
+        :param speed: initial top speed of the axes in °/s
+        :param accel: acceleration of the axes in °/s²
+        """
+        self.bus = bus
+        self.yaw_limit = max(180.0, yaw_limit)
+        self.speed = {'yaw': speed, 'pitch': speed}
+        self.accel = {'yaw': accel, 'pitch': accel}
+        self.overhead = 0.5
+        self.position = None
+        self.peak = None
+        self.peak_accel = None
+        self.slews = 0
+        self.wrapped = 0
+        self.error_sum = 0.0
+        self.error_max = 0.0
+        self.last = None
+        self.errors = Histogram((0.1, 0.25, 0.5, 1, 2, 5, 10))
+
+    def axis_time(self, axis, distance):
+        (speed, accel) = (self.speed[axis], self.accel[axis])
+        if distance >= speed * speed / accel:
+            return distance / speed + speed / accel
+        return 2 * sqrt(distance / accel)
+
+    def predict(self, start, yaw, alt):
+        """
+        predict returns the duration in seconds of a slew from start (yaw, pitch) in degrees.
+        """
+        return self.overhead + max(self.axis_time('yaw', abs(yaw - start[0])), self.axis_time('pitch', abs(alt - start[1])))
+
+    def choose_yaw(self, az, current):
+        """
+        choose_yaw returns the (yaw, wrap) closest to the current yaw for the azimuth
+        az, wrap is the multiple of 360° added to the -180..180 yaw.
+        """
+        base = 360 - az if az > 180 else -az
+        candidates = [base + wrap for wrap in (-360, 0, 360) if abs(base + wrap) <= self.yaw_limit]
+        yaw = min(candidates, key=lambda yaw: abs(yaw - current))
+        return (yaw, yaw - base)
+
+    def unwrap(self, az, alt):
+        """
+        unwrap returns the (yaw, pitch) of a heading, the yaw on the turn of the last
+        known yaw, in -180..180 when none is known.
+        """
+        yaw = (-az + 180) % 360 - 180
+        if self.position is not None:
+            yaw += 360 * round((self.position[0] - yaw) / 360)
+        self.position = (yaw, alt)
+        return self.position
+
+    async def angles(self):
+        azalt = await self.bus.azalt(self.stale_after)
+        if azalt is None:
+            return self.position
+        return self.unwrap(*azalt)
+
+    async def plan(self, az, alt, t, lead, site=None):
+        """
+        plan prepares the slew to (az, alt) clicked at time t.
+
+        :param lead: True to aim at the position of the object at the end of the slew
+        :param site: the PolarisSite of the head, None for the one of the command line
+        :return: a SlewPlan
+        """
+        start = await self.angles() or (0.0, 0.0)
+        site = site or current_site()
+        transform = site.transform()
+        (ra, dec) = transform.azalt_to_radec(radians(az), radians(alt), t)
+        now = time.time()
+        duration = 0.0
+        # the duration depends on the target which depends on the duration, converges in a few steps
+        for _ in range(3):
+            if lead:
+                (az, alt) = map(degrees, transform.radec_to_azalt(ra, dec, now + duration))
+            # the model may move the azimuth across 180°, the yaw is chosen after it
+            (model_az, model_alt) = site.model.apply(az, alt) if site.model else (az, alt)
+            (yaw, wrap) = self.choose_yaw(model_az, start[0])
+            duration = self.predict(start, yaw, model_alt)
+        return SlewPlan(az, alt, yaw, wrap, start, duration, now + duration - t if lead else 0.0)
+
+    async def sample(self):
+        """
+        sample measures the peak speed and acceleration of the axes during a slew
+        from the 518 headings, sample_interval apart.
+        """
+        self.peak = {'yaw': 0.0, 'pitch': 0.0}
+        self.peak_accel = {'yaw': 0.0, 'pitch': 0.0}
+        subscription = self.bus.subscribe(1 / self.sample_interval)
+        previous = None
+        velocity = None
+        try:
+            while True:
+                record = await subscription.get()
+                position = self.unwrap(*record.azalt())
+                if previous and record.t > previous[0]:
+                    dt = record.t - previous[0]
+                    speeds = [abs(position[i] - previous[1][i]) / dt for i in (0, 1)]
+                    for (i, axis) in enumerate(('yaw', 'pitch')):
+                        self.peak[axis] = max(self.peak[axis], speeds[i])
+                        if velocity:
+                            self.peak_accel[axis] = max(self.peak_accel[axis], abs(speeds[i] - velocity[i]) / dt)
+                    velocity = speeds
+                previous = (record.t, position)
+        finally:
+            self.bus.unsubscribe(subscription)
+
+    def learn(self, plan, actual):
+        """
+        learn updates the model with the actual duration of a completed slew.
+        """
+        error = actual - plan.duration
+        self.slews += 1
+        self.wrapped += plan.wrap != 0
+        self.error_sum += abs(error)
+        self.error_max = max(self.error_max, abs(error))
+        self.errors.observe(abs(error))
+        self.last = (plan.duration, actual)
+        for (i, axis) in enumerate(('yaw', 'pitch')):
+            distance = abs((plan.yaw, plan.alt)[i] - plan.start[i])
+            if not self.peak or distance < 1.0:
+                continue
+            if self.peak_accel[axis] > 0:
+                self.accel[axis] += 0.5 * (self.peak_accel[axis] - self.accel[axis])
+            # only the slews long enough to reach the top speed tell it
+            if distance > 2 * self.speed[axis] ** 2 / self.accel[axis] and self.peak[axis] > 0:
+                self.speed[axis] += 0.5 * (self.peak[axis] - self.speed[axis])
+        self.overhead = max(0.0, self.overhead + 0.3 * error)
+        if LOGGING:
+            log.info("Slew predicted %.1fs actual %.1fs, lead %.1fs", plan.duration, actual, plan.lead)
+
+    def stats(self):
+        return {
+            'slews': self.slews,
+            'wrapped': self.wrapped,
+            'error_mean': self.error_sum / self.slews if self.slews else 0.0,
+            'error_max': self.error_max,
+            'last': self.last,
+            'speed': dict(self.speed),
+            'accel': dict(self.accel),
+            'overhead': self.overhead,
+        }
+
+
+class GotoScheduler:
+    """
+    GotoScheduler drives the Polaris gotos requested by Stellarium in the background.
+
+    Only the newest target is kept: a target received while another one is waiting
+    replaces it (dropped), and a target received while the head is slewing cancels
+    the wait on the running goto and is sent right away (superseded), so the head
+    goes to the last clicked object without replaying the older ones. The late
+    replies of the superseded goto are dropped by PolarisClient.forget, they don't
+    complete the new one.
+    """
+
+    def __init__(self, client, tracking=True, planner=None, site=None):
+        """
+        :param client: is used to send commands to the Polaris
+        :param tracking: if 1 start tracking at star rotation speed once the target is reached
+        :param planner: the SlewPlanner preparing the gotos, None to send the targets as is
+        :param site: the PolarisSite of the head, None for the one of the command line
+        """
+        self.client = client
+        self.tracking = tracking
+        self.planner = planner
+        self.site = site
+        self.target = None
+        self.current = None
+        self.stopping = 0
+        self.target_time = None
+        self.interrupted = None
+        self.tracking_active = False
+        self.tracked = None
+        self.wakeup = asyncio.Event()
+        self.submitted = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.completed = 0
+        self.failed = 0
+        self.aborted = 0
+        self.results = {}
+        self.durations = Histogram((1, 2, 5, 10, 20, 30, 60, 120, 180))
+
+    @property
+    def queue_depth(self):
+        return 0 if self.target is None else 1
+
+    @property
+    def slewing(self):
+        # the abort goto moves the head too, until its final 519 reply
+        return (self.current is not None and not self.current.done()) or self.stopping > 0
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'slewing': self.slewing,
+            'submitted': self.submitted,
+            'dropped': self.dropped,
+            'superseded': self.superseded,
+            'completed': self.completed,
+            'failed': self.failed,
+            'aborted': self.aborted,
+        }
+
+    def submit(self, az, alt):
+        """
+        submit schedules a goto to (az, alt), replacing any target not reached yet.
+
+        :param az: is the azimuth to point, 0° < az < 360°
+        :param alt: is the altitude to point, -90° < alt < 90°
+        """
+        self.submitted += 1
+        if self.target is not None:
+            self.dropped += 1
+            if LOGGING:
+                log.info("Goto Az.: %.5f Alt.: %.5f dropped", self.target[0], self.target[1])
+        self.target = (az, alt)
+        self.target_time = time.time()
+        if self.current is not None and not self.current.done():
+            self.superseded += 1
+            if LOGGING:
+                log.info("Goto superseded by Az.: %.5f Alt.: %.5f", az, alt)
+            self.current.cancel()
+            self.current = None
+        self.wakeup.set()
+
+    async def abort(self, azalt):
+        """
+        abort drops the target not reached yet and stops the head where it is,
+        the tracking is stopped too. slewing stays True until the abort goto ends.
+
+        :param azalt: the (az, alt) in degrees of the last 518 heading
+        """
+        self.target = None
+        self.interrupted = None
+        self.tracking_active = False
+        self.tracked = None
+        if self.current is not None:
+            self.current.cancel()
+            self.current = None
+        self.aborted += 1
+        if self.planner:
+            # the yaw on the turn the head is on
+            (yaw, pitch) = self.planner.unwrap(*azalt)
+        else:
+            (yaw, pitch) = ((-azalt[0] + 180) % 360 - 180, azalt[1])
+        self.stopping += 1
+        try:
+            await polaris_abort_goto(self.client, yaw, pitch, self.site)
+        finally:
+            self.stopping -= 1
+
+    async def run(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                if self.target is None:
+                    continue
+                (az, alt) = self.target
+                t = self.target_time
+                self.target = None
+                self.interrupted = None
+                # polaris_goto stops the tracking before moving
+                self.tracking_active = False
+                self.tracked = None
+                task = asyncio.create_task(self.slew(az, alt, t))
+                self.current = task
+                await asyncio.wait([task])
+                if self.current is task:
+                    self.current = None
+                self.goto_done(az, alt, t, task)
+                if self.tracking_active:
+                    # the J2000 position of the object followed, for the TrackingCorrector
+                    self.tracked = (self.site or current_site()).transform().azalt_to_radec(radians(az), radians(alt), t)
+        finally:
+            if self.current is not None:
+                self.current.cancel()
+
+    async def slew(self, az, alt, t):
+        if self.planner is None:
+            start = time.monotonic()
+            reply = await polaris_goto(self.client, az, alt, self.tracking, site=self.site)
+            self.durations.observe(time.monotonic() - start)
+            return reply
+        plan = await self.planner.plan(az, alt, t, self.tracking, self.site)
+        sampler = asyncio.create_task(self.planner.sample())
+        try:
+            start = time.monotonic()
+            reply = await polaris_goto(self.client, plan.az, plan.alt, self.tracking, plan.yaw, self.site)
+            actual = time.monotonic() - start
+        finally:
+            sampler.cancel()
+        self.durations.observe(actual)
+        if reply.ret != -1:
+            self.planner.learn(plan, actual)
+        return reply
+
+    def goto_done(self, az, alt, t, task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if isinstance(error, asyncio.TimeoutError):
+            self.failed += 1
+            console.info("Goto Az.: %s Alt.: %s timed out", az, alt)
+        elif isinstance(error, ConnectionError):
+            # sent again by resume() once the connection is back
+            self.failed += 1
+            self.interrupted = (az, alt, t)
+            console.info("Goto Az.: %s Alt.: %s interrupted, %s", az, alt, error)
+        elif error is not None:
+            self.failed += 1
+            console.info("Goto Az.: %s Alt.: %s error %s", az, alt, error)
+        elif task.result().ret == -1:
+            self.results['-1'] = self.results.get('-1', 0) + 1
+            self.failed += 1
+            console.info("Goto Az.: %s Alt.: %s failed", az, alt)
+        else:
+            ret = str(task.result().ret)
+            self.results[ret] = self.results.get(ret, 0) + 1
+            self.completed += 1
+            self.tracking_active = self.tracking
+        if DEBUG:
+            log.debug("Goto scheduler: %s", self.stats())
+            if self.planner:
+                log.debug("Slew planner: %s", self.planner.stats())
+
+    async def resume(self, client):
+        """
+        resume restores the state of the head after a reconnection: the goto
+        interrupted by the connection loss is sent again, to where the object is
+        now when tracking, or the tracking is restarted if the last goto ended
+        tracking.
+        """
+        if self.interrupted is not None and self.target is None:
+            (az, alt, t) = self.interrupted
+            if self.tracking:
+                # the object has moved during the reconnection backoff
+                transform = (self.site or current_site()).transform()
+                (ra, dec) = transform.azalt_to_radec(radians(az), radians(alt), t)
+                (az, alt) = map(degrees, transform.radec_to_azalt(ra, dec, time.time()))
+            console.info("Resuming goto Az.: %.5f Alt.: %.5f", az, alt)
+            self.submit(az, alt)
+        elif self.tracking_active and self.target is None:
+            console.info("Resuming tracking")
+            await polaris_start_stop_tracking(client, True)
+        self.interrupted = None
+
+
+class TrackingCorrector:
+    """
+    TrackingCorrector checks that the head keeps following the object it tracks.
+
+    Every interval seconds the 518 heading of the head is compared with the Az/Alt
+    of the tracked object computed with the cached transform frames, or read in the
+    EphemerisCache when the object is the Sun, the Moon or a planet. When the error
+    exceeds threshold the head is corrected, either with a new goto ('goto' mode)
+    or by moving the axes with the 532/533 adjust commands at the lowest level
+    ('adjust' mode). The adjust speed of the Polaris is not documented, it is
+    estimated from the effect of every adjustment on the error, the first ones
+    are short probes.
+    """
+    modes = ('goto', 'adjust')
+    adjust_max_time = 5.0
+    adjust_probe_time = 0.2
+    stale_after = 2.0
+
+    def __init__(self, client, bus, scheduler, interval=30.0, threshold=5.0, mode='goto'):
+        """
+        :param client: is used to send commands to the Polaris
+        :param bus: the TelemetryBus of the 518 heading stream
+        :param scheduler: the GotoScheduler knowing the tracked object
+        :param interval: time between two checks in seconds
+        :param threshold: error in arc minutes above which the head is corrected
+        :param mode: 'goto' or 'adjust'
+        """
+        if mode not in self.modes:
+            raise ValueError(f"Unknown correction mode {mode}, expected one of {', '.join(self.modes)}")
+        self.client = client
+        self.bus = bus
+        self.scheduler = scheduler
+        self.interval = interval
+        self.threshold = threshold
+        self.mode = mode
+        # signed speeds in degrees per second of the az and alt axes with key:0 at level 1
+        self.adjust_rate = {'az': 0.1, 'alt': 0.1}
+        self.learned = set()
+        self.adjusted = None
+        self.tracked = None
+        self.body = None
+        self.samples = 0
+        self.corrections = 0
+        self.error_sum = 0.0
+        self.error_sq_sum = 0.0
+        self.error_max = 0.0
+        self.last_error = None
+
+    def stats(self):
+        return {
+            'samples': self.samples,
+            'corrections': self.corrections,
+            'error_mean': self.error_sum / self.samples if self.samples else 0.0,
+            'error_rms': sqrt(self.error_sq_sum / self.samples) if self.samples else 0.0,
+            'error_max': self.error_max,
+            'last_error': self.last_error,
+            'adjust_rate': dict(self.adjust_rate),
+        }
+
+    def measure(self, predicted, measured):
+        """
+        measure returns the (az, alt, total) error in arc minutes, az on the sky.
+        """
+        daz = (predicted[0] - measured[0] + 180) % 360 - 180
+        daz *= 60 * cos(radians(predicted[1]))
+        dalt = (predicted[1] - measured[1]) * 60
+        return (daz, dalt, hypot(daz, dalt))
+
+    async def adjust(self, daz, dalt, alt):
+        # both axes move together, each one stopped after its own duration
+        moves = []
+        for (axis, cmd, error) in (('az', '532', daz / max(cos(radians(alt)), 0.1)), ('alt', '533', dalt)):
+            error /= 60
+            rate = self.adjust_rate[axis]
+            duration = min(abs(error / rate), self.adjust_max_time if axis in self.learned else self.adjust_probe_time)
+            key = 0 if error / rate > 0 else 1
+            moves.append((duration, cmd, key))
+        for (duration, cmd, key) in moves:
+            await self.client.send(POLARIS_COMMANDS[cmd].encode(key, 1, 1))
+        start = time.monotonic()
+        for (duration, cmd, key) in sorted(moves):
+            await asyncio.sleep(max(0, start + duration - time.monotonic()))
+            await self.client.send(POLARIS_COMMANDS[cmd].encode(key, 0, 1))
+        return {cmd: duration * (1 if key == 0 else -1) for (duration, cmd, key) in moves}
+
+    def learn(self, errors):
+        # the error change since the adjustment gives the actual speed of each axis
+        (before, moves) = self.adjusted
+        self.adjusted = None
+        for (axis, cmd, index) in (('az', '532', 0), ('alt', '533', 1)):
+            signed_time = moves[cmd]
+            moved = (before[index] - errors[index]) / 60
+            if abs(signed_time) < 0.05 or abs(moved) < self.threshold / 240:
+                continue
+            self.adjust_rate[axis] = moved / signed_time
+            self.learned.add(axis)
+
+    def predict(self, t):
+        tracked = self.scheduler.tracked
+        site = self.scheduler.site or current_site()
+        (az, alt) = site.transform().radec_to_azalt(tracked[0], tracked[1], t)
+        predicted = (degrees(az), degrees(alt))
+        if tracked is not self.tracked:
+            # a new object, the solar system bodies move on the sky
+            self.tracked = tracked
+            self.body = site_ephemerides(site.lat, site.lon).identify(predicted[0], predicted[1], t)
+            if self.body and LOGGING:
+                console.info("Tracking %s", self.body)
+        if self.body:
+            return site_ephemerides(site.lat, site.lon).azalt(self.body, t)
+        return predicted
+
+    async def check(self):
+        measured = await self.bus.azalt(self.stale_after)
+        if measured is None:
+            raise asyncio.TimeoutError("no 518 heading")
+        t = time.time()
+        predicted = self.predict(t)
+        # the head is expected where the pointing model sends it
+        model = (self.scheduler.site or current_site()).model
+        expected = model.apply(*predicted) if model else predicted
+        (daz, dalt, error) = self.measure(expected, measured)
+        if self.adjusted:
+            self.learn((daz / max(cos(radians(predicted[1])), 0.1), dalt))
+        self.samples += 1
+        self.error_sum += error
+        self.error_sq_sum += error * error
+        self.error_max = max(self.error_max, error)
+        self.last_error = (daz, dalt)
+        if LOGGING:
+            log.info("Tracking error Az.: %.2f' Alt.: %.2f' total: %.2f'", daz, dalt, error)
+        if error <= self.threshold:
+            return
+        self.corrections += 1
+        console.info("Tracking error %.2f' above %s', correcting with %s", error, self.threshold, self.mode)
+        if self.mode == 'goto':
+            self.scheduler.submit(*predicted)
         else:
-            raise ValueError('Polaris is not in astro mode, please use the mobile app to setup the astro mode.')
+            moves = await self.adjust(daz, dalt, predicted[1])
+            self.adjusted = ((daz / max(cos(radians(predicted[1])), 0.1), dalt), moves)
+
+    async def run(self):
+        while True:
+            # the ephemeris of the next check is computed off the event loop
+            site = self.scheduler.site or current_site()
+            ephemerides = site_ephemerides(site.lat, site.lon)
+            next_check = time.time() + self.interval
+            for t in (next_check, next_check + self.stale_after):
+                await ephemerides.prepare(t)
+            await asyncio.sleep(self.interval)
+            if self.scheduler.tracked is None or self.scheduler.stats()['slewing']:
+                self.adjusted = None
+                continue
+            try:
+                await self.check()
+            except (asyncio.TimeoutError, ConnectionError, KeyError, ValueError) as error:
+                if DEBUG:
+                    log.debug("Tracking check failed: %s", error)
+            if DEBUG:
+                log.debug("Tracking corrector: %s", self.stats())
 
 
-####### Stellarium
+class PolarisSupervisor:
+    """
+    PolarisSupervisor keeps the client connected to the Polaris.
 
-def dec2dms(dd):
-   is_positive = dd >= 0
-   dd = abs(dd)
-   minutes,seconds = divmod(dd*3600,60)
-   degrees,minutes = divmod(minutes,60)
-   degrees = degrees if is_positive else -degrees
-   return f"{int(degrees)}:{int(minutes)}:{seconds:.2f}"
+    When the connection drops, or the h# heartbeat isn't echoed anymore, the pending
+    requests fail right away and the connection is opened again with an exponential
+    backoff. Once connected the on_connect coroutines are run with the client, they
+    check the Polaris mode and restore the session (goto, tracking). Their other
+    errors, like the MountSetupError of polaris_init, stop the supervisor.
+    """
 
-def dms2dec(dms):
-    (degree, minute, second, frac_seconds) = re.split('\D+', dms, maxsplit=4)
-    return int(degree) + float(minute) / 60 + float(second) / 3600 + float(frac_seconds) / 360000
+    def __init__(self, client, host, port, on_connect=(), heartbeat=5.0):
+        """
+        :param client: the PolarisClient to keep connected
+        :param host: the Polaris address
+        :param port: the Polaris port
+        :param on_connect: coroutine functions called with the client after each connection
+        :param heartbeat: interval in seconds of the h# ping, 0 to disable it
+        """
+        self.client = client
+        self.host = host
+        self.port = port
+        self.on_connect = list(on_connect)
+        self.heartbeat = heartbeat
+        self.connected = asyncio.Event()
+        self.connections = 0
+        self.failures = 0
+        self.delay = reconnect_min
+
+    @property
+    def reconnects(self):
+        return max(0, self.connections - 1)
+
+    async def open(self):
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.client.timeout)
+            except (OSError, asyncio.TimeoutError) as error:
+                self.failures += 1
+                console.info("Failed to connect to the Polaris %s:%s: %s, retry in %.1fs", self.host, self.port, error or 'timeout', self.delay)
+            await self.backoff()
+
+    async def backoff(self):
+        await asyncio.sleep(self.delay)
+        self.delay = min(self.delay * 2, reconnect_max)
+
+    async def run(self):
+        while True:
+            (reader, writer) = await self.open()
+            self.client.attach(reader, writer)
+            self.connections += 1
+            if self.connections > 1:
+                console.info("Polaris reconnected to %s:%s", self.host, self.port)
+            tasks = [asyncio.create_task(self.client.run())]
+            if self.heartbeat:
+                tasks.append(asyncio.create_task(self.client.heartbeat(self.heartbeat)))
+            try:
+                for callback in self.on_connect:
+                    await callback(self.client)
+                self.connected.set()
+                # the session is restored, the next failure starts a new backoff
+                self.delay = reconnect_min
+                await tasks[0]
+            except (OSError, asyncio.TimeoutError) as error:
+                console.info("Polaris connection error: %s", error or 'timeout')
+            finally:
+                self.connected.clear()
+                for task in tasks:
+                    task.cancel()
+                self.client.close(ConnectionError("Polaris connection lost"))
+            console.info("Polaris connection lost, reconnecting in %.1fs", self.delay)
+            await self.backoff()
+
+
+####### Coordinates
+
+ARCSEC = pi / (180 * 3600)
+ABERRATION = 20.49552 * ARCSEC
+
+
+def unix_to_jd(t):
+    return t / 86400.0 + 2440587.5
+
+def rot_x(a):
+    (c, s) = (cos(a), sin(a))
+    return ((1.0, 0.0, 0.0), (0.0, c, s), (0.0, -s, c))
+
+def rot_y(a):
+    (c, s) = (cos(a), sin(a))
+    return ((c, 0.0, -s), (0.0, 1.0, 0.0), (s, 0.0, c))
+
+def rot_z(a):
+    (c, s) = (cos(a), sin(a))
+    return ((c, s, 0.0), (-s, c, 0.0), (0.0, 0.0, 1.0))
+
+def mat_mul(a, b):
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(3)) for j in range(3)) for i in range(3))
+
+
+def equinox_of_date(jd):
+    """
+    equinox_of_date computes the quantities needed to go from J2000 mean coordinates
+    to the apparent coordinates of date: IAU 1976 precession, the main terms of
+    the IAU 1980 nutation and the annual aberration.
 
-def decode_stellarium_packet(s):
-    t = int.from_bytes(s[4:11], byteorder='little')
+    :param jd: the julian date
+    :return: (matrix J2000 -> true equator of date, aberration vector in the equator
+    of date in radians, equation of the equinoxes in radians)
+    """
+    T = (jd - 2451545.0) / 36525
+
+    zeta = (2306.2181 * T + 0.30188 * T**2 + 0.017998 * T**3) * ARCSEC
+    z = (2306.2181 * T + 1.09468 * T**2 + 0.018203 * T**3) * ARCSEC
+    theta = (2004.3109 * T - 0.42665 * T**2 - 0.041833 * T**3) * ARCSEC
+    precession = mat_mul(rot_z(-z), mat_mul(rot_y(theta), rot_z(-zeta)))
+
+    omega = radians(125.04452 - 1934.136261 * T)
+    L = radians(280.4665 + 36000.7698 * T)
+    Lm = radians(218.3165 + 481267.8813 * T)
+    dpsi = (-17.20 * sin(omega) - 1.32 * sin(2 * L) - 0.23 * sin(2 * Lm) + 0.21 * sin(2 * omega)) * ARCSEC
+    deps = (9.20 * cos(omega) + 0.57 * cos(2 * L) + 0.10 * cos(2 * Lm) - 0.09 * cos(2 * omega)) * ARCSEC
+    eps0 = (84381.448 - 46.8150 * T - 0.00059 * T**2 + 0.001813 * T**3) * ARCSEC
+    eps = eps0 + deps
+    nutation = mat_mul(rot_x(-eps), mat_mul(rot_z(-dpsi), rot_x(eps0)))
+
+    # Earth velocity from the Sun true longitude, with the eccentricity terms
+    M = radians(357.52911 + 35999.05029 * T)
+    sun = radians(280.46646 + 36000.76983 * T
+                  + (1.914602 - 0.004817 * T) * sin(M) + 0.019993 * sin(2 * M) + 0.000289 * sin(3 * M))
+    e = 0.016708634 - 0.000042037 * T
+    perihelion = radians(102.93735 + 1.71946 * T)
+    vx = ABERRATION * (sin(sun) - e * sin(perihelion))
+    vy = ABERRATION * (-cos(sun) + e * cos(perihelion))
+
+    return (mat_mul(nutation, precession), (vx, vy * cos(eps), vy * sin(eps)), dpsi * cos(eps))
+
+
+def sidereal_time(jd):
+    """
+    sidereal_time returns the Greenwich mean sidereal time (IAU 1982) in radians.
+    """
+    d = jd - 2451545.0
+    T = d / 36525
+    return radians((280.46061837 + 360.98564736629 * d + 0.000387933 * T**2 - T**3 / 38710000) % 360)
 
-    ra = int.from_bytes(s[12:16], byteorder='little')
-    dec = int.from_bytes(s[16:20], byteorder='little', signed=True)
 
-    ra = (24*ra)/0x100000000
-    dec = (90*dec)/0x40000000
+class CoordinateTransform:
+    """
+    CoordinateTransform converts between J2000 equatorial coordinates and the local
+    horizontal coordinates of a site, without refraction, all angles in radians.
 
-    if DEBUG:
-        print(f"<<< Stellarium: t={t} ra={ra} dec={dec}")
+    The precession, nutation and aberration terms move by less than 0.02" per hour,
+    they are computed once per hour bucket and reused for every conversion in it.
+    """
+    max_frames = 48
+
+    def __init__(self, lat, lon):
+        """
+        :param lat: site latitude in degrees
+        :param lon: site longitude in degrees, positive east
+        """
+        self.lat = radians(lat)
+        self.lon = radians(lon)
+        self.sin_lat = sin(self.lat)
+        self.cos_lat = cos(self.lat)
+        self.frames = {}
+
+    def frame_at(self, jd):
+        bucket = int(jd * 24)
+        frame = self.frames.get(bucket)
+        if frame is None:
+            if len(self.frames) >= self.max_frames:
+                self.frames.clear()
+            frame = self.frames[bucket] = equinox_of_date((bucket + 0.5) / 24)
+        return frame
+
+    def radec_to_azalt(self, ra, dec, t):
+        """
+        radec_to_azalt converts J2000 coordinates to horizontal coordinates.
+
+        :param ra: J2000 right ascension in radians
+        :param dec: J2000 declination in radians
+        :param t: UTC time as a unix timestamp in seconds
+        :return: (az, alt) in radians, azimuth from north toward east in 0..2pi
+        """
+        jd = unix_to_jd(t)
+        (m, v, eqeq) = self.frame_at(jd)
+        cos_dec = cos(dec)
+        x0 = cos_dec * cos(ra)
+        y0 = cos_dec * sin(ra)
+        z0 = sin(dec)
+        x = m[0][0] * x0 + m[0][1] * y0 + m[0][2] * z0 + v[0]
+        y = m[1][0] * x0 + m[1][1] * y0 + m[1][2] * z0 + v[1]
+        z = m[2][0] * x0 + m[2][1] * y0 + m[2][2] * z0 + v[2]
+        ha = sidereal_time(jd) + eqeq + self.lon - atan2(y, x)
+        cos_dec = sqrt(x * x + y * y)
+        sin_dec = z
+        cos_ha = cos(ha)
+        alt = atan2(self.sin_lat * sin_dec + self.cos_lat * cos_dec * cos_ha,
+                    hypot(cos_dec * sin(ha), self.cos_lat * sin_dec - self.sin_lat * cos_dec * cos_ha))
+        az = atan2(-cos_dec * sin(ha), self.cos_lat * sin_dec - self.sin_lat * cos_dec * cos_ha) % (2 * pi)
+        return (az, alt)
+
+    def azalt_to_radec(self, az, alt, t):
+        """
+        azalt_to_radec converts horizontal coordinates back to J2000 coordinates.
+
+        :param az: azimuth in radians from north toward east
+        :param alt: altitude in radians
+        :param t: UTC time as a unix timestamp in seconds
+        :return: (ra, dec) J2000 in radians, ra in 0..2pi
+        """
+        jd = unix_to_jd(t)
+        (m, v, eqeq) = self.frame_at(jd)
+        cos_alt = cos(alt)
+        sin_alt = sin(alt)
+        cos_az = cos(az)
+        sin_dec = self.sin_lat * sin_alt + self.cos_lat * cos_alt * cos_az
+        ha = atan2(-sin(az) * cos_alt, self.cos_lat * sin_alt - self.sin_lat * cos_alt * cos_az)
+        ra = sidereal_time(jd) + eqeq + self.lon - ha
+        cos_dec = sqrt(max(0.0, 1 - sin_dec * sin_dec))
+        x = cos_dec * cos(ra) - v[0]
+        y = cos_dec * sin(ra) - v[1]
+        z = sin_dec - v[2]
+        x0 = m[0][0] * x + m[1][0] * y + m[2][0] * z
+        y0 = m[0][1] * x + m[1][1] * y + m[2][1] * z
+        z0 = m[0][2] * x + m[1][2] * y + m[2][2] * z
+        return (atan2(y0, x0) % (2 * pi), atan2(z0, hypot(x0, y0)))
+
+    def radec_to_azalt_batch(self, ra, dec, t):
+        """
+        radec_to_azalt_batch converts arrays of J2000 coordinates in one call.
+
+        :param ra: array of J2000 right ascensions in radians
+        :param dec: array of J2000 declinations in radians
+        :param t: UTC unix timestamp in seconds, a scalar or an array
+        :return: (az, alt) arrays in radians, lists if numpy is not installed
+        """
+        if np is None:
+            if not isinstance(t, (list, tuple)):
+                t = [t] * len(ra)
+            return tuple(map(list, zip(*map(self.radec_to_azalt, ra, dec, t)))) or ([], [])
+
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        (ra, dec, jd) = np.broadcast_arrays(ra, dec, unix_to_jd(np.asarray(t, dtype=float)))
+        cos_dec = np.cos(dec)
+        p = np.stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+        x = np.empty_like(p)
+        lst = np.empty_like(jd)
+        buckets = np.floor(jd * 24)
+        for bucket in np.unique(buckets):
+            sel = buckets == bucket
+            (m, v, eqeq) = self.frame_at((bucket + 0.5) / 24)
+            x[:, sel] = np.asarray(m) @ p[:, sel] + np.asarray(v)[:, None]
+            lst[sel] = eqeq
+        d = jd - 2451545.0
+        T = d / 36525
+        lst += np.radians((280.46061837 + 360.98564736629 * d + 0.000387933 * T**2 - T**3 / 38710000) % 360)
+        ha = lst + self.lon - np.arctan2(x[1], x[0])
+        cos_dec = np.hypot(x[0], x[1])
+        sin_dec = x[2]
+        cos_ha = np.cos(ha)
+        north = self.cos_lat * sin_dec - self.sin_lat * cos_dec * cos_ha
+        east = -cos_dec * np.sin(ha)
+        alt = np.arctan2(self.sin_lat * sin_dec + self.cos_lat * cos_dec * cos_ha, np.hypot(east, north))
+        az = np.arctan2(east, north) % (2 * pi)
+        return (az, alt)
+
+
+@functools.lru_cache(maxsize=8)
+def site_transform(lat, lon):
+    """
+    site_transform returns the CoordinateTransform of a site, built once per site.
+    """
+    return CoordinateTransform(lat, lon)
 
-    observer = ephem.Observer()
-    observer.long = dec2dms(lon)
-    observer.lat = dec2dms(lat)
-    observer.elevation = 0
-    observer.pressure = 0 # no refraction correction.
-    observer.epoch = ephem.J2000
-    observer.date = ephem.Date(datetime.fromtimestamp(t/1E6, tz=timezone.utc))
 
-    if DEBUG:
-        print(f"<<< Stellarium: Observer location lat={observer.lat} lon={observer.lon}")
+####### Ephemeris
 
-    target = ephem.FixedBody()
-    target._ra = dec2dms(ra)
-    target._dec = dec2dms(dec)
-    target._epoch = ephem.J2000
-    target.compute(observer)
-    if LOGGING:
-        print(f"<<< Stellarium: Date: {observer.date} UT RA: {target.ra} Dec: {target.dec} -> Az.: {target.az} Alt.: {target.alt}")
-    return (dms2dec(str(target.az)), dms2dec(str(target.alt)))
+class EphemerisCache:
+    """
+    EphemerisCache precomputes the Az/Alt of the Sun, the Moon and the planets of
+    a site with ephem every step seconds over a whole night (from local noon to
+    the next one), a position is then a cubic interpolation of the samples.
+
+    The samples of a night are computed on its first lookup and kept in array('d')
+    tables, only max_nights nights are kept, the least recently used one is
+    evicted when another night is looked up. A night takes about 1300 ephem
+    computations, the asyncio code computes it ahead in a worker thread with
+    prepare so the lookups don't stall the event loop.
+    """
+    bodies = ('Sun', 'Moon', 'Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune')
+
+    def __init__(self, lat, lon, step=600.0, max_nights=2):
+        """
+        :param lat: latitude of the site in degrees
+        :param lon: longitude of the site in degrees, positive to the east
+        :param step: time between two samples in seconds
+        :param max_nights: number of nights kept in memory
+        """
+        self.lat = lat
+        self.lon = lon
+        self.step = step
+        self.max_nights = max_nights
+        self.nights = OrderedDict()
+        self.computed = 0
+        self.evicted = 0
+        self.lookups = 0
+
+    def night_of(self, t):
+        # local mean solar noon to noon
+        return int((t + self.lon * 240 - 43200) // 86400)
+
+    def night(self, t):
+        """
+        night returns the tables of the night of t, {body: (az, alt)} of unwrapped
+        azimuths and altitudes in degrees, and the time of their first sample.
+        """
+        key = self.night_of(t)
+        tables = self.nights.get(key)
+        if tables is None:
+            tables = self.store(key, self.compute(key))
+        else:
+            self.nights.move_to_end(key)
+        return tables
+
+    def store(self, key, tables):
+        self.nights[key] = tables
+        self.nights.move_to_end(key)
+        while len(self.nights) > self.max_nights:
+            self.nights.popitem(last=False)
+            self.evicted += 1
+        return tables
+
+    async def prepare(self, t):
+        """
+        prepare computes the night of t in a worker thread if it isn't cached yet.
+        """
+        key = self.night_of(t)
+        if key not in self.nights:
+            tables = await asyncio.get_running_loop().run_in_executor(None, self.compute, key)
+            self.store(key, tables)
+
+    def compute(self, key):
+        # 2 samples before and after the night for the cubic interpolation
+        start = key * 86400 + 43200 - self.lon * 240 - 2 * self.step
+        count = int(86400 / self.step) + 5
+        observer = ephem.Observer()
+        observer.lat = radians(self.lat)
+        observer.lon = radians(self.lon)
+        observer.pressure = 0
+        bodies = [(name, getattr(ephem, name)()) for name in self.bodies]
+        tables = {name: (array('d'), array('d')) for name in self.bodies}
+        for i in range(count):
+            observer.date = unix_to_jd(start + i * self.step) - 2415020.0
+            for (name, body) in bodies:
+                body.compute(observer)
+                (az, alt) = tables[name]
+                a = degrees(body.az)
+                if az:
+                    # unwrapped so the interpolation doesn't jump at 0°/360°
+                    a += round((az[-1] - a) / 360) * 360
+                az.append(a)
+                alt.append(degrees(body.alt))
+        self.computed += 1
+        if DEBUG:
+            log.debug("Ephemeris of the night %s computed, %s samples of %s bodies", key, count, len(self.bodies))
+        return (start, tables)
+
+    def azalt(self, name, t):
+        """
+        azalt returns the (az, alt) in degrees of a body at time t.
+
+        :param name: one of EphemerisCache.bodies
+        :param t: UTC unix timestamp in seconds
+        """
+        (start, tables) = self.night(t)
+        (az, alt) = tables[name]
+        self.lookups += 1
+        x = (t - start) / self.step
+        i = int(x)
+        f = x - i
+        return (catmull_rom(az, i, f) % 360, catmull_rom(alt, i, f))
+
+    def identify(self, az, alt, t, tolerance=0.5):
+        """
+        identify returns the name of the body at (az, alt) in degrees at time t,
+        None if no body is closer than tolerance degrees.
+        """
+        for name in self.bodies:
+            (body_az, body_alt) = self.azalt(name, t)
+            daz = ((body_az - az + 180) % 360 - 180) * cos(radians(alt))
+            if hypot(daz, body_alt - alt) < tolerance:
+                return name
+        return None
+
+    def stats(self):
+        return {
+            'nights': len(self.nights),
+            'computed': self.computed,
+            'evicted': self.evicted,
+            'lookups': self.lookups,
+        }
+
+
+def catmull_rom(p, i, f):
+    # cubic through p[i-1], p[i], p[i+1], p[i+2], evaluated between p[i] and p[i+1]
+    (p0, p1, p2, p3) = (p[i - 1], p[i], p[i + 1], p[i + 2])
+    return p1 + 0.5 * f * (p2 - p0 + f * (2 * p0 - 5 * p1 + 4 * p2 - p3 + f * (3 * (p1 - p2) + p3 - p0)))
+
+
+@functools.lru_cache(maxsize=8)
+def site_ephemerides(lat, lon):
+    """
+    site_ephemerides returns the EphemerisCache of a site, built once per site.
+    """
+    return EphemerisCache(lat, lon)
 
 
-####### network
+####### Pointing model
 
-async def client_reader(reader):
-    global response_queues
-    buffer = ""
-    while True:
-        data = await reader.read(256)
-        if not data:
-            break
-        buffer += data.decode()
-        parse_result = polaris_parse_msg(buffer)
-        if parse_result:
-            buffer = parse_result[0]
-            cmd = parse_result[1]
-            if LOGGING and (cmd != "518" or LOG518):
-                print(f"<<< Polaris: {cmd}@{parse_result[2]}#")
-            polaris_parse_cmd(cmd, parse_result[2])
-
-async def handle_local_input(server_writer, reader, writer):
+def solve_least_squares(rows, values, damping=1e-9):
+    """
+    solve_least_squares returns the x minimizing |rows . x - values| with the normal
+    equations, a small damping keeps the terms the samples can't constrain near 0.
+
+    :param rows: list of the coefficient lists of the equations
+    :param values: list of the right hand sides
+    """
+    n = len(rows[0])
+    normal = [[sum(row[i] * row[j] for row in rows) + (damping if i == j else 0.0) for j in range(n)] +
+              [sum(row[i] * value for (row, value) in zip(rows, values))] for i in range(n)]
+    # Gauss-Jordan elimination with partial pivoting
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda k: abs(normal[k][i]))
+        (normal[i], normal[pivot]) = (normal[pivot], normal[i])
+        for k in range(n):
+            if k != i:
+                factor = normal[k][i] / normal[i][i]
+                normal[k] = [a - factor * b for (a, b) in zip(normal[k], normal[i])]
+    return [normal[i][n] / normal[i][i] for i in range(n)]
+
+
+class PointingModel:
+    """
+    PointingModel corrects the Az/Alt sent to the Polaris for the mechanical errors
+    of the head and its setup, fitted from the pointing errors measured on a few
+    stars (see polaris_pointing_alignment).
+
+    The terms are the classic alt-az mount ones, in degrees:
+    IA, IE the azimuth and altitude index offsets, CA the collimation error, NPAE the
+    non-perpendicularity of the axes, AN and AW the tilt of the azimuth axis toward
+    the north and the west. offsets(az, alt) is the error of the head at (az, alt):
+    centered on a star at (az, alt) it reads (az, alt) + offsets(az, alt), so it
+    points at (az, alt) when sent there, which is what apply() returns.
+    With less than 3 stars only the index offsets (1 star) and the tilt (2 stars)
+    are fitted.
+    """
+    terms = ('IA', 'IE', 'CA', 'NPAE', 'AN', 'AW')
+
+    def __init__(self, coefficients=None, samples=None):
+        """
+        :param coefficients: dict of the terms in degrees, the missing ones are 0
+        :param samples: list of (az, alt, az_head, alt_head) in degrees, the computed
+        position of a star and the position read on the head once it is centered
+        """
+        self.coefficients = dict.fromkeys(self.terms, 0.0)
+        self.coefficients.update(coefficients or {})
+        self.samples = list(samples or ())
+
+    @staticmethod
+    def equations(az, alt):
+        # the azimuth equation is multiplied by cos(alt) to stay finite near the zenith
+        (a, e) = (radians(az), radians(alt))
+        az_row = (-cos(e), 0.0, -1.0, -sin(e), -sin(a) * sin(e), -cos(a) * sin(e))
+        alt_row = (0.0, 1.0, 0.0, 0.0, -cos(a), sin(a))
+        return (az_row, alt_row)
+
+    def offsets(self, az, alt):
+        """
+        offsets returns the (daz, dalt) pointing error in degrees of the head at (az, alt),
+        the position read on the head minus the position pointed.
+        """
+        coefficients = [self.coefficients[term] for term in self.terms]
+        (az_row, alt_row) = self.equations(az, alt)
+        daz = sum(c * x for (c, x) in zip(az_row, coefficients)) / max(cos(radians(alt)), 0.01)
+        dalt = sum(c * x for (c, x) in zip(alt_row, coefficients))
+        return (daz, dalt)
+
+    def apply(self, az, alt):
+        """
+        apply returns the (az, alt) in degrees to send to the Polaris to point at (az, alt).
+        """
+        (daz, dalt) = self.offsets(az, alt)
+        return ((az + daz) % 360, alt + dalt)
+
+    def add(self, az, alt, az_head, alt_head):
+        self.samples.append((az, alt, az_head, alt_head))
+
+    def residuals(self):
+        """
+        residuals returns the pointing errors in arc minutes of the samples left by the model.
+        """
+        errors = []
+        for (az, alt, az_head, alt_head) in self.samples:
+            (daz, dalt) = self.offsets(az, alt)
+            daz = (az_head - az - daz + 180) % 360 - 180
+            errors.append(60 * hypot(daz * cos(radians(alt)), alt_head - alt - dalt))
+        return errors
+
+    def fit(self):
+        """
+        fit computes the terms from the samples.
+
+        :return: the RMS of the residuals in arc minutes
+        """
+        if not self.samples:
+            raise ValueError("No alignment star measured, the pointing model can't be fitted")
+        count = len(self.samples)
+        terms = self.terms if count >= 3 else ('IA', 'IE', 'AN', 'AW') if count == 2 else ('IA', 'IE')
+        columns = [self.terms.index(term) for term in terms]
+        rows = []
+        values = []
+        for (az, alt, az_head, alt_head) in self.samples:
+            (az_row, alt_row) = self.equations(az, alt)
+            rows.append([az_row[i] for i in columns])
+            values.append(((az_head - az + 180) % 360 - 180) * cos(radians(alt)))
+            rows.append([alt_row[i] for i in columns])
+            values.append(alt_head - alt)
+        self.coefficients = dict.fromkeys(self.terms, 0.0)
+        self.coefficients.update(zip(terms, solve_least_squares(rows, values)))
+        errors = self.residuals()
+        return sqrt(sum(error * error for error in errors) / len(errors))
+
+    def save(self, path, site):
+        with open(path, 'w') as file:
+            json.dump({'terms': self.coefficients, 'samples': self.samples, 'lat': site.lat, 'lon': site.lon, 't': time.time()}, file, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            model = json.load(file)
+        return cls(model['terms'], [tuple(sample) for sample in model.get('samples', ())])
+
+    def __str__(self):
+        return ' '.join(f"{term}={60 * value:+.2f}'" for (term, value) in self.coefficients.items())
+
+
+class PolarisSite:
+    """
+    PolarisSite is the site (lat, lon) of a head and its PointingModel, each
+    PolarisBackend has its own so several heads can run in one event loop.
+    """
+
+    def __init__(self, lat, lon, model=None):
+        """
+        :param lat: latitude of the site in degrees
+        :param lon: longitude of the site in degrees
+        :param model: the PointingModel of the head, None for none
+        """
+        self.lat = lat
+        self.lon = lon
+        self.model = model
+
+    def transform(self):
+        return site_transform(self.lat, self.lon)
+
+
+def current_site():
+    """
+    current_site returns the PolarisSite of the command line (lat, lon and pointing_model globals).
+    """
+    return PolarisSite(lat, lon, pointing_model)
+
+
+async def polaris_pointing_alignment(client, bus, stars, site=None):
+    """
+    polaris_pointing_alignment is used to measure the pointing error of the head on
+    several stars and to fit a PointingModel.
+
+    Each star is pointed with tracking, the operator centers it with the mobile app
+    and presses Enter, then the 518 heading gives the position of the head. A star
+    unknown, too low or not measured is skipped.
+
+    :param client: is used to send commands to the Polaris
+    :param bus: the TelemetryBus of the 518 heading stream
+    :param stars: the names of the alignment stars, as known by ephem (e.g. Vega)
+    :param site: the PolarisSite of the head, its model is replaced by the fitted one
+    :return: the fitted PointingModel, None if no star was measured
+    """
+    site = site or current_site()
+    # the stars are pointed without the previous model
+    site.model = None
+    model = PointingModel()
+    loop = asyncio.get_running_loop()
+    transform = site.transform()
+    for name in stars:
+        try:
+            star = ephem.star(name)
+        except KeyError:
+            console.info("Unknown star %s, skipped", name)
+            continue
+        (az, alt) = map(degrees, transform.radec_to_azalt(star._ra, star._dec, time.time()))
+        if alt < 10:
+            console.info("%s is too low, Alt.: %.1f°, skipped", name, alt)
+            continue
+        try:
+            reply = await polaris_goto(client, az, alt, True, site=site)
+        except asyncio.TimeoutError:
+            reply = None
+        if reply is None or reply.ret == -1:
+            console.info("Goto %s failed, skipped", name)
+            continue
+        console.info("Center %s with the mobile app then press Enter", name)
+        await loop.run_in_executor(None, sys.stdin.readline)
+        # a heading received after Enter, the head may have been moved to center the star
+        measured = await bus.azalt(0)
+        if measured is None:
+            console.info("No heading received from the Polaris, %s skipped", name)
+            continue
+        (az_head, alt_head) = measured
+        # the star has moved since the goto, the head tracked it
+        (az, alt) = map(degrees, transform.radec_to_azalt(star._ra, star._dec, time.time()))
+        model.add(az, alt, az_head, alt_head)
+        console.info("%s: error Az.: %.2f' Alt.: %.2f'", name, 60 * ((az_head - az + 180) % 360 - 180), 60 * (alt_head - alt))
+    if not model.samples:
+        console.info("No alignment star measured, the pointing model is not fitted")
+        return None
+    errors = [60 * hypot(((az_head - az + 180) % 360 - 180) * cos(radians(alt)), alt_head - alt) for (az, alt, az_head, alt_head) in model.samples]
+    rms = model.fit()
+    console.info("Pointing model fitted on %s stars: %s", len(model.samples), model)
+    console.info("RMS pointing error %.2f' before, %.2f' after", sqrt(sum(error * error for error in errors) / len(errors)), rms)
+    site.model = model
+    return model
+
+
+####### Telemetry
+
+class HeadingRecord:
+    """
+    HeadingRecord is one 518 heading frame: the first quaternion of the frame, the
+    compass and the alt fields, t is the UTC unix timestamp of its reception.
+
+    The 518 heading is the only source of the direction pointed by the head. The
+    517 yaw and pitch are the mechanical angles of the axes from their home: they
+    read 0 after the 523 resets, and 517 yaw -146.4° with the head at azimuth 0.7°
+    in the Alignement capture.
+    """
+    __slots__ = ('t', 'w', 'x', 'y', 'z', 'compass', 'alt')
+    fields = __slots__
+
+    def __init__(self, t, w, x, y, z, compass, alt):
+        self.t = t
+        self.w = w
+        self.x = x
+        self.y = y
+        self.z = z
+        self.compass = compass
+        self.alt = alt
+
+    def azalt(self):
+        # the compass is the azimuth and the alt field is the opposite of the altitude
+        return (self.compass % 360, -self.alt)
+
+    def __repr__(self):
+        return f"HeadingRecord(t={self.t:.3f}, compass={self.compass}, alt={self.alt})"
+
+
+class TelemetrySubscription:
+    """
+    TelemetrySubscription delivers the heading records to one consumer at its own
+    decimated rate. It only keeps the latest record: when the consumer is slower
+    than its rate, the records it didn't take are dropped, the reader is never
+    blocked.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: maximum number of records per second, 0 for every record
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next = 0
+        self.record = None
+        self.event = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+
+    def offer(self, record):
+        if self.record is not None:
+            self.dropped += 1
+        self.record = record
+        self.event.set()
+
+    async def get(self):
+        """
+        get waits for the next record.
+        """
+        await self.event.wait()
+        self.event.clear()
+        record = self.record
+        self.record = None
+        self.delivered += 1
+        return record
+
+
+class TelemetryBus:
+    """
+    TelemetryBus parses the 518 heading stream into a fixed layout ring buffer of
+    doubles holding the last seconds of telemetry, and fans the records out to the
+    subscribers at their own rate.
+    """
+    width = len(HeadingRecord.fields)
+
+    def __init__(self, client, seconds=60.0, max_rate=50):
+        """
+        :param client: the PolarisClient receiving the 518 stream
+        :param seconds: duration of the history kept in memory
+        :param max_rate: highest expected 518 rate, used to size the ring buffer
+        """
+        self.seconds = seconds
+        self.capacity = max(1, int(seconds * max_rate))
+        self.ring = array('d', bytes(8 * self.width * self.capacity))
+        self.count = 0
+        self.errors = 0
+        self.subscriptions = []
+        client.subscribe('518', self.on_frame, raw=True)
+
+    def on_frame(self, args):
+        t = time.time()
+        try:
+            reply = HeadingReply(args)
+        except ValueError:
+            self.errors += 1
+            return
+        # decoded by key, a field moved or added by the firmware can't shift the others
+        values = (t, reply.w, reply.x, reply.y, reply.z, reply.compass, reply.alt)
+        if None in values:
+            self.errors += 1
+            return
+        i = (self.count % self.capacity) * self.width
+        self.ring[i:i + self.width] = array('d', values)
+        self.count += 1
+        record = None
+        for subscription in self.subscriptions:
+            if t >= subscription.next:
+                subscription.next = t + subscription.interval
+                if record is None:
+                    record = HeadingRecord(*values)
+                subscription.offer(record)
+
+    def subscribe(self, rate=0):
+        """
+        subscribe returns a TelemetrySubscription receiving at most rate records per second.
+        """
+        subscription = TelemetrySubscription(rate)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def record(self, n):
+        i = (n % self.capacity) * self.width
+        return HeadingRecord(*self.ring[i:i + self.width])
+
+    def latest(self, max_age=None):
+        """
+        latest returns the newest record, None if there is none or if it's older than max_age seconds.
+        """
+        if not self.count:
+            return None
+        record = self.record(self.count - 1)
+        if max_age is not None and time.time() - record.t > max_age:
+            return None
+        return record
+
+    async def azalt(self, max_age=2.0, timeout=2.0):
+        """
+        azalt returns the (az, alt) in degrees pointed by the head, from the newest
+        heading if it's not older than max_age seconds (0 to always wait for the next
+        one), else from the next one received within timeout seconds, None if the
+        stream is silent.
+        """
+        record = self.latest(max_age) if max_age else None
+        if record is None:
+            subscription = self.subscribe()
+            try:
+                record = await asyncio.wait_for(subscription.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self.unsubscribe(subscription)
+        return record.azalt()
+
+    def history(self, seconds=None):
+        """
+        history returns the records of the last seconds, oldest first.
+        """
+        since = time.time() - (self.seconds if seconds is None else seconds)
+        records = []
+        for n in range(self.count - 1, max(-1, self.count - 1 - self.capacity), -1):
+            record = self.record(n)
+            if record.t < since:
+                break
+            records.append(record)
+        records.reverse()
+        return records
+
+
+async def telemetry_logger(bus, rate):
+    """
+    telemetry_logger logs the 518 heading stream decimated at rate records per second.
+    """
+    subscription = bus.subscribe(rate)
     while True:
-        data = await reader.read(256)
-        if not data:
-            break
-        (az, alt) = decode_stellarium_packet(data)
-        if DEBUG:
-            print(f"<<< Stellarium: {':'.join(('0'+hex(x)[2:])[-2:] for x in data)}")
-        ret_dict = await polaris_goto(server_writer, az, alt, True)
-        if 'ret' in ret_dict:
-            goto_result = int(ret_dict['ret'])
-            if goto_result == -1:
-                print(f"Goto Az.: {az} Alt.: {alt} failed")
+        record = await subscription.get()
+        (az, alt) = record.azalt()
+        log.info("<<< Polaris: 518 heading Az.: %.5f Alt.: %.5f w:%s x:%s y:%s z:%s", az, alt, record.w, record.x, record.y, record.z, extra={'code': 'heading'})
+
+
+####### Recorder
+
+class ProtocolRecorder:
+    """
+    ProtocolRecorder writes the bytes exchanged with the Polaris to a JSONL file,
+    one line per write or read: {"t": seconds since the start, "dir": ">" sent to
+    the Polaris or "<" received from it, "data": the text}. The data are recorded
+    as they were read, the TCP segmentation is kept.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'w', buffering=1 << 16)
+        self.start = time.monotonic()
+        self.events = 0
+
+    def record(self, direction, data):
+        self.file.write(json.dumps({'t': round(time.monotonic() - self.start, 6), 'dir': direction, 'data': data}) + '\n')
+        self.events += 1
+
+    def close(self):
+        self.file.close()
+
+
+polaris_log_frames_re = re.compile(r"^((?:\d\d\d@[^#]*#|h#)+)")
+polaris_log_cmd_re = re.compile(r"^((?:1&\d\d\d&\d&[^#]*#|h#)+)")
+
+def load_capture(path, step=0.05):
+    """
+    load_capture reads a protocol capture, a JSONL file written by ProtocolRecorder
+    or one of the text logs of the Protocol directory. The text logs have no
+    timestamps, their lines are spaced by step seconds.
+
+    :return: a list of (t, direction, data) events
+    """
+    with open(path, encoding='utf-8', errors='replace') as file:
+        lines = file.read().splitlines()
+    if lines and lines[0].startswith('{'):
+        events = []
+        for line in lines:
+            if line:
+                event = json.loads(line)
+                events.append((event['t'], event['dir'], event['data']))
+        return events
+
+    events = []
+    for line in lines:
+        text = line.strip()
+        polaris_side = line[:1] in ('\t', ' ') or text.startswith('<-')
+        text = text[2:].strip() if text[:2] in ('->', '<-') else text
+        m = (polaris_log_frames_re if polaris_side else polaris_log_cmd_re).match(text)
+        if m:
+            events.append((len(events) * step, '<' if polaris_side else '>', m.group(1)))
+    return events
+
+
+####### Metrics
+
+class Histogram:
+    """
+    Histogram counts observations in cumulative buckets, the Prometheus way.
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: the increasing upper bounds of the buckets
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+    def render(self, name, help):
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class BridgeMetrics:
+    """
+    BridgeMetrics serves the counters of the bridge on a local HTTP endpoint in
+    the Prometheus text format: frames received per command code, parse errors,
+    gotos and their results, goto durations, reconnections, battery, storage and
+    the lag of the event loop.
+
+    The counters belong to the objects doing the work, they are only read when
+    the endpoint is scraped. The battery, storage and mode are read in the
+    DeviceState of the StatusPoller.
+    """
+    lag_interval = 0.5
+
+    def __init__(self, client, scheduler=None, supervisor=None, server=None, status=None):
+        """
+        :param server: the StellariumServer of the head, for its clients and position packets
+        """
+        self.client = client
+        self.scheduler = scheduler
+        self.supervisor = supervisor
+        self.server = server
+        self.status = status
+        self.loop_lag = Histogram((0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+        self.loop_lag_max = 0.0
+        self.scrapes = 0
+
+    async def measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - start - self.lag_interval)
+            self.loop_lag.observe(lag)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def render(self):
+        client = self.client
+        lines = [
+            "# HELP polaris_frames_received_total Frames received from the Polaris per command code.",
+            "# TYPE polaris_frames_received_total counter",
+        ]
+        lines += [f'polaris_frames_received_total{{code="{code}"}} {count}' for (code, count) in sorted(client.frames.items())]
+        lines += [
+            "# HELP polaris_parse_errors_total Garbage dropped by the frame parser.",
+            "# TYPE polaris_parse_errors_total counter",
+            f"polaris_parse_errors_total {client.parser.errors}",
+            "# HELP polaris_commands_sent_total Commands sent to the Polaris.",
+            "# TYPE polaris_commands_sent_total counter",
+            f"polaris_commands_sent_total {client.sent}",
+            "# HELP polaris_connected 1 if the Polaris is connected.",
+            "# TYPE polaris_connected gauge",
+            f"polaris_connected {0 if client.closed else 1}",
+        ]
+        if self.supervisor:
+            lines += [
+                "# HELP polaris_reconnects_total Reconnections to the Polaris.",
+                "# TYPE polaris_reconnects_total counter",
+                f"polaris_reconnects_total {self.supervisor.reconnects}",
+                "# HELP polaris_connect_failures_total Failed connection attempts.",
+                "# TYPE polaris_connect_failures_total counter",
+                f"polaris_connect_failures_total {self.supervisor.failures}",
+            ]
+        if self.scheduler:
+            stats = self.scheduler.stats()
+            lines += [
+                "# HELP polaris_gotos_total Gotos requested by Stellarium per outcome.",
+                "# TYPE polaris_gotos_total counter",
+            ]
+            lines += [f'polaris_gotos_total{{outcome="{outcome}"}} {stats[outcome]}' for outcome in ('submitted', 'completed', 'failed', 'dropped', 'superseded')]
+            lines += [
+                "# HELP polaris_goto_ret_total Final 519 replies per ret value.",
+                "# TYPE polaris_goto_ret_total counter",
+            ]
+            lines += [f'polaris_goto_ret_total{{ret="{ret}"}} {count}' for (ret, count) in sorted(self.scheduler.results.items())]
+            lines += self.scheduler.durations.render("polaris_goto_duration_seconds", "Time from the 519 goto to its final reply.")
+            lines += [
+                "# HELP polaris_slewing 1 if a goto is running.",
+                "# TYPE polaris_slewing gauge",
+                f"polaris_slewing {int(stats['slewing'])}",
+            ]
+        planner = self.scheduler.planner if self.scheduler else None
+        if planner:
+            lines += planner.errors.render("polaris_slew_prediction_error_seconds", "Absolute difference between the predicted and actual slew durations.")
+            lines += [
+                "# HELP polaris_slew_wrapped_total Slews sent past ±180° of yaw to take the short way.",
+                "# TYPE polaris_slew_wrapped_total counter",
+                f"polaris_slew_wrapped_total {planner.wrapped}",
+                "# HELP polaris_axis_speed_degrees_per_second Top speed of the axes learned from the 518 headings of the slews.",
+                "# TYPE polaris_axis_speed_degrees_per_second gauge",
+            ]
+            lines += [f'polaris_axis_speed_degrees_per_second{{axis="{axis}"}} {speed}' for (axis, speed) in planner.speed.items()]
+        state = self.status.state if self.status else None
+        if state and state.battery is not None:
+            lines += [
+                "# HELP polaris_battery_percent Battery capacity from 778.",
+                "# TYPE polaris_battery_percent gauge",
+                f"polaris_battery_percent {state.battery}",
+                "# HELP polaris_battery_charging 1 if the battery is charging.",
+                "# TYPE polaris_battery_charging gauge",
+                f"polaris_battery_charging {int(bool(state.charging))}",
+            ]
+        if state and state.storage_free is not None:
+            lines += [
+                "# HELP polaris_storage_free_megabytes Free storage from 775.",
+                "# TYPE polaris_storage_free_megabytes gauge",
+                f"polaris_storage_free_megabytes {state.storage_free}",
+                "# HELP polaris_storage_total_megabytes Total storage from 775.",
+                "# TYPE polaris_storage_total_megabytes gauge",
+                f"polaris_storage_total_megabytes {state.storage_total}",
+            ]
+        if state and state.mode is not None:
+            lines += [
+                "# HELP polaris_mode Mode of the Polaris from 284, 8 is astro.",
+                "# TYPE polaris_mode gauge",
+                f"polaris_mode {state.mode}",
+            ]
+        if state and state.software is not None:
+            lines += [
+                "# HELP polaris_info Firmware versions from 780.",
+                "# TYPE polaris_info gauge",
+                f'polaris_info{{hw="{state.hardware}",sw="{state.software}",axis="{state.axis_firmware}"}} 1',
+            ]
+        if self.server:
+            lines += [
+                "# HELP polaris_stellarium_clients Stellarium clients connected.",
+                "# TYPE polaris_stellarium_clients gauge",
+                f"polaris_stellarium_clients {len(self.server.writers)}",
+                "# HELP polaris_stellarium_rejected_total Stellarium gotos rejected by the control policy.",
+                "# TYPE polaris_stellarium_rejected_total counter",
+                f"polaris_stellarium_rejected_total {self.server.rejected}",
+                "# HELP polaris_feedback_packets_total Position packets sent to Stellarium.",
+                "# TYPE polaris_feedback_packets_total counter",
+                f"polaris_feedback_packets_total {self.server.packets}",
+            ]
+        lines += self.loop_lag.render("polaris_loop_lag_seconds", "Lateness of the event loop timers.")
+        lines += [
+            "# HELP polaris_loop_lag_max_seconds Largest lateness of the event loop timers.",
+            "# TYPE polaris_loop_lag_max_seconds gauge",
+            f"polaris_loop_lag_max_seconds {self.loop_lag_max}",
+        ]
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                (method, path) = request.split(b' ', 2)[:2]
+                if method == b'GET' and path.split(b'?')[0] in (b'/metrics', b'/'):
+                    self.scrapes += 1
+                    (status, body) = ("200 OK", self.render().encode())
+                else:
+                    (status, body) = ("404 Not Found", b"Not found\n")
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host='localhost'):
+        server = await asyncio.start_server(self.handle, host, port)
+        console.info("Metrics on http://%s:%s/metrics", host, port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.measure_lag())
+
+
+####### Alpaca server
+
+class AlpacaDeviceError(Exception):
+    """
+    AlpacaDeviceError is answered to the Alpaca client with its ErrorNumber.
+    """
+    not_implemented = 0x400
+    invalid_value = 0x401
+    not_connected = 0x407
+    invalid_operation = 0x40B
+
+    def __init__(self, number, message):
+        super().__init__(message)
+        self.number = number
+
+
+class AlpacaTelescope:
+    """
+    AlpacaTelescope serves the Polaris as an ASCOM Alpaca telescope device on a
+    local HTTP port, for the imaging software speaking Alpaca.
+
+    The clients poll the position and the state several times a second, so the
+    GETs are answered from what the bridge already knows: the 518 heading stream
+    of the telemetry bus for the position (see HeadingRecord) and the tracking of
+    the 284 status in the DeviceState, queried every status_every seconds and
+    updated by the 519 replies too. The slews go through the GotoScheduler like the Stellarium ones.
+    """
+    stale_after = 2.0
+    status_every = 5.0
+    path = '/api/v1/telescope/0/'
+
+    def __init__(self, client, bus, scheduler, supervisor, status, site=None):
+        """
+        :param client: is used to send commands to the Polaris
+        :param bus: the TelemetryBus of the 518 stream
+        :param scheduler: the GotoScheduler running the slews
+        :param supervisor: the PolarisSupervisor of the connection
+        :param status: the StatusPoller holding the mode of the Polaris
+        :param site: the PolarisSite of the head, None for the one of the command line
+        """
+        self.site = site or current_site()
+        self.client = client
+        self.bus = bus
+        self.scheduler = scheduler
+        self.supervisor = supervisor
+        self.state = status.state
+        self.target = (None, None)
+        self.transaction_id = 0
+        self.requests = 0
+        self.errors = 0
+        client.subscribe('519', self.on_goto)
+        self.getters = {
+            'connected': lambda: self.supervisor.connected.is_set(),
+            'name': lambda: 'Polaris',
+            'description': lambda: 'Benro Polaris head',
+            'driverinfo': lambda: 'polaris_stellarium.py Alpaca server',
+            'driverversion': lambda: '1.0',
+            'interfaceversion': lambda: 3,
+            'supportedactions': lambda: [],
+            'alignmentmode': lambda: 0,
+            'equatorialsystem': lambda: 2,
+            'sitelatitude': lambda: self.site.lat,
+            'sitelongitude': lambda: self.site.lon,
+            'utcdate': lambda: datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+            'canslewasync': lambda: True,
+            'cansettracking': lambda: True,
+            'canslew': lambda: False,
+            'canslewaltaz': lambda: False,
+            'canslewaltazasync': lambda: False,
+            'cansync': lambda: False,
+            'canpark': lambda: False,
+            'canpulseguide': lambda: False,
+            'atpark': lambda: False,
+            'athome': lambda: False,
+            'tracking': self.get_tracking,
+            'slewing': lambda: self.scheduler.slewing or self.scheduler.target is not None,
+            'altitude': lambda: self.azalt()[1],
+            'azimuth': lambda: self.azalt()[0],
+            'rightascension': lambda: self.radec()[0],
+            'declination': lambda: self.radec()[1],
+            'targetrightascension': lambda: self.get_target(0),
+            'targetdeclination': lambda: self.get_target(1),
+        }
+        self.setters = {
+            'connected': self.set_connected,
+            'tracking': self.set_tracking,
+            'slewtocoordinatesasync': self.slew_to_coordinates,
+            'abortslew': self.abort_slew,
+        }
+
+    def on_goto(self, reply):
+        # the head doesn't track while slewing, then tracks if asked once arrived
+        if reply.ret == 1:
+            self.state.track = 0
+        elif reply.ret == 0 and reply.track is not None:
+            self.state.track = reply.track
+
+    def azalt(self):
+        """
+        azalt returns the (az, alt) in degrees of the head from the last 518 heading.
+        """
+        record = self.bus.latest(self.stale_after)
+        if record is None:
+            raise AlpacaDeviceError(AlpacaDeviceError.not_connected, "No 518 heading received from the Polaris")
+        return record.azalt()
+
+    def radec(self):
+        (az, alt) = self.azalt()
+        (ra, dec) = self.site.transform().azalt_to_radec(radians(az), radians(alt), time.time())
+        return (degrees(ra) / 15, degrees(dec))
+
+    def get_tracking(self):
+        if self.state.track is not None:
+            return self.state.track != 0
+        return self.scheduler.tracking_active
+
+    def get_target(self, i):
+        if self.target[i] is None:
+            raise AlpacaDeviceError(AlpacaDeviceError.invalid_operation, "No target set")
+        return self.target[i]
+
+    async def set_connected(self, params):
+        # the connection to the Polaris is kept by the PolarisSupervisor
+        pass
+
+    async def set_tracking(self, params):
+        tracking = alpaca_bool(params, 'tracking')
+        await polaris_start_stop_tracking(self.client, tracking)
+        self.scheduler.tracking_active = tracking
+        self.state.track = int(tracking)
+
+    async def slew_to_coordinates(self, params):
+        ra = alpaca_float(params, 'rightascension', 0, 24)
+        dec = alpaca_float(params, 'declination', -90, 90)
+        if not self.supervisor.connected.is_set():
+            raise AlpacaDeviceError(AlpacaDeviceError.not_connected, "Polaris not connected")
+        (az, alt) = self.site.transform().radec_to_azalt(radians(ra * 15), radians(dec), time.time())
+        if LOGGING:
+            log.info("<<< Alpaca: slew RA: %s Dec: %s -> Az.: %.5f Alt.: %.5f", dec2dms(ra), dec2dms(dec), degrees(az), degrees(alt))
+        self.target = (ra, dec)
+        self.scheduler.submit(degrees(az), degrees(alt))
+
+    async def abort_slew(self, params):
+        if not self.supervisor.connected.is_set():
+            raise AlpacaDeviceError(AlpacaDeviceError.not_connected, "Polaris not connected")
+        await self.scheduler.abort(self.azalt())
+        self.state.track = 0
+
+    async def refresh(self):
+        """
+        refresh queries the 284 status every status_every seconds, the reply updates
+        the DeviceState through the StatusPoller listener.
+        """
+        while True:
+            await asyncio.sleep(self.status_every)
+            if not self.supervisor.connected.is_set():
+                continue
+            try:
+                await polaris_get_current_mode(self.client)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+
+    def answer(self, value, params, error=None):
+        self.transaction_id += 1
+        reply = {
+            'ClientTransactionID': alpaca_transaction_id(params),
+            'ServerTransactionID': self.transaction_id,
+            'ErrorNumber': 0 if error is None else error.number,
+            'ErrorMessage': '' if error is None else str(error),
+        }
+        if value is not None:
+            reply['Value'] = value
+        return json.dumps(reply).encode()
+
+    async def call(self, method, path, params):
+        """
+        call runs an Alpaca request and returns the (status, body) of its HTTP response.
+        """
+        if path == '/management/apiversions':
+            return ("200 OK", self.answer([1], params))
+        if path == '/management/v1/description':
+            return ("200 OK", self.answer({'ServerName': 'Polaris bridge', 'Manufacturer': 'Benro',
+                                           'ManufacturerVersion': '1.0', 'Location': f"{self.site.lat} {self.site.lon}"}, params))
+        if path == '/management/v1/configureddevices':
+            return ("200 OK", self.answer([{'DeviceName': 'Polaris', 'DeviceType': 'Telescope',
+                                            'DeviceNumber': 0, 'UniqueID': 'polaris-0'}], params))
+        if not path.startswith(self.path):
+            return ("404 Not Found", b"Not found\n")
+        name = path[len(self.path):].lower()
+        try:
+            if method == 'GET':
+                if name not in self.getters:
+                    raise AlpacaDeviceError(AlpacaDeviceError.not_implemented, f"{name} is not implemented")
+                return ("200 OK", self.answer(self.getters[name](), params))
+            if method == 'PUT':
+                if name not in self.setters:
+                    raise AlpacaDeviceError(AlpacaDeviceError.not_implemented, f"{name} is not implemented")
+                await self.setters[name](params)
+                return ("200 OK", self.answer(None, params))
+        except AlpacaDeviceError as error:
+            self.errors += 1
+            if DEBUG:
+                log.debug("Alpaca: %s %s error %s", method, name, error)
+            return ("200 OK", self.answer(None, params, error))
+        except (asyncio.TimeoutError, ConnectionError) as error:
+            self.errors += 1
+            return ("200 OK", self.answer(None, params, AlpacaDeviceError(0x500, f"Polaris error {error!r}")))
+        return ("405 Method Not Allowed", b"Method not allowed\n")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                lines = request.decode('latin-1').split('\r\n')
+                headers = {}
+                for line in lines[1:]:
+                    (name, _, value) = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    (method, target) = lines[0].split(' ', 2)[:2]
+                    length = int(headers.get('content-length', 0) or 0)
+                    if length < 0:
+                        raise ValueError(f"negative Content-Length {length}")
+                except ValueError as error:
+                    # the body can't be skipped without its length, the connection is closed after the answer
+                    self.errors += 1
+                    log.info("Alpaca: bad request %r: %s", lines[0], error)
+                    content = f"Bad request: {error}\n".encode()
+                    writer.write(f"HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\nContent-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode() + content)
+                    await writer.drain()
+                    break
+                body = (await reader.readexactly(length)).decode(errors='replace') if length else ''
+                (path, _, query) = target.partition('?')
+                # the Alpaca parameter names are case insensitive
+                params = {key.lower(): value for (key, value) in parse_qsl(query + '&' + body)}
+                self.requests += 1
+                (status, content) = await self.call(method, path, params)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n".encode() + content)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host='localhost'):
+        server = await asyncio.start_server(self.handle, host, port)
+        console.info("Alpaca telescope on http://%s:%s%s", host, port, self.path)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.refresh())
+
+
+def alpaca_transaction_id(params):
+    """
+    alpaca_transaction_id returns the ClientTransactionID of an Alpaca request, 0
+    when it is missing, not a number or out of the uint32 range.
+    """
+    try:
+        value = int(params.get('clienttransactionid', 0) or 0)
+    except ValueError:
+        return 0
+    return value if 0 <= value <= 0xffffffff else 0
+
+
+def alpaca_float(params, name, low, high):
+    """
+    alpaca_float returns the float parameter name of an Alpaca request, within low..high.
+    """
+    try:
+        value = float(params[name])
+    except (KeyError, ValueError):
+        raise AlpacaDeviceError(AlpacaDeviceError.invalid_value, f"Invalid {name} {params.get(name)!r}")
+    if not low <= value <= high:
+        raise AlpacaDeviceError(AlpacaDeviceError.invalid_value, f"{name} {value} out of {low}..{high}")
+    return value
+
+
+def alpaca_bool(params, name):
+    """
+    alpaca_bool returns the boolean parameter name of an Alpaca request.
+    """
+    value = params.get(name, '').lower()
+    if value not in ('true', 'false'):
+        raise AlpacaDeviceError(AlpacaDeviceError.invalid_value, f"Invalid {name} {params.get(name)!r}")
+    return value == 'true'
+
+
+####### network
+
+class PolarisBackend(MountBackend):
+    """
+    PolarisBackend drives a Polaris head for the StellariumServer of stellarium_core,
+    several heads of the same site can run in one event loop (see stellarium_mounts.py).
+
+    Each backend owns its connection, goto scheduler, telemetry, status and site
+    (lat, lon and pointing model). The position sent to Stellarium is the last 518
+    heading, none while the stream is silent.
+    """
+    stale_after = 2.0
+
+    def __init__(self, host, port=9090, heartbeat=5.0, yaw_limit=180.0, status_interval=60.0, site=None, history=60.0):
+        """
+        :param host: the address of the Polaris
+        :param port: the port of the Polaris
+        :param heartbeat: interval of the h# ping in seconds, 0 to disable it
+        :param yaw_limit: largest absolute yaw in degrees the head may be sent to
+        :param status_interval: interval of the status polls in seconds, 0 to disable them
+        :param site: the PolarisSite of the head, None for the one of the command line
+        :param history: duration in seconds of the 518 telemetry kept in memory
+        """
+        self.name = f"Polaris {host}:{port}"
+        self.site = site or current_site()
+        self.client = PolarisClient()
+        self.bus = TelemetryBus(self.client, history)
+        self.scheduler = GotoScheduler(self.client, planner=SlewPlanner(self.bus, yaw_limit), site=self.site)
+        self.supervisor = PolarisSupervisor(self.client, host, port, (polaris_init, self.scheduler.resume), heartbeat)
+        self.status = StatusPoller(self.client, status_codes, status_interval)
+
+    async def when_connected(self, run, *args):
+        # the coroutine is only created once connected, never left unawaited
+        await self.supervisor.connected.wait()
+        await run(*args)
+
+    async def run(self):
+        tasks = [self.supervisor.run(), self.scheduler.run()]
+        if self.status.interval > 0:
+            tasks.append(self.when_connected(self.status.run))
+        await asyncio.gather(*tasks)
+
+    async def goto(self, ra, dec, t):
+        (az, alt) = self.site.transform().radec_to_azalt(ra, dec, t)
+        if LOGGING:
+            log.info("%s: goto RA: %s Dec: %s -> Az.: %.5f Alt.: %.5f", self.name, dec2dms(degrees(ra)/15), dec2dms(degrees(dec)), degrees(az), degrees(alt))
+        self.scheduler.submit(degrees(az), degrees(alt))
+
+    def position(self):
+        record = self.bus.latest(self.stale_after)
+        if record is None:
+            return None
+        (az, alt) = record.azalt()
+        return self.site.transform().azalt_to_radec(radians(az), radians(alt), time.time())
+
+    def stats(self):
+        return dict(self.scheduler.stats(), reconnects=self.supervisor.reconnects, battery=self.status.state.battery)
+
+    async def close(self):
+        self.client.close()
+
 
 async def main(argv):
     global LOGGING, LOG518, DEBUG, TESTS, ALLMODES
-    global response_queues
     global lat, lon
-
-    usage = f"{os.path.basename(sys.argv[0])} [-adfhlLt]--lat <latitude> --lon <longitude>"
-    try:
-        opts, args = getopt.getopt(argv,"adhlLt",["lat=","lon="])
-    except getopt.GetoptError:
-        print (usage)
-        sys.exit(2)
+    global polaris_timeout, polaris_goto_timeout, feedback_rate, log518_rate, telemetry_history
+    global polaris_ip, polaris_port
+    global control_policy, control_timeout, max_clients, heartbeat_interval
+    global correct_interval, correct_threshold, correct_mode
+    global log_file, metrics_port, status_interval, status_codes
+    global pointing_model, model_path, align_stars, yaw_limit, alpaca_port
+
+    usage = f"{os.path.basename(sys.argv[0])} [-adfhlLt]--lat <latitude> --lon <longitude> [--timeout <seconds>] [--goto-timeout <seconds>] [--feedback-rate <Hz>] [--log518-rate <Hz>] [--history <seconds>] [--record <file>] [--polaris <address[:port]>] [--control <last|lock>] [--control-timeout <seconds>] [--max-clients <count>] [--heartbeat <seconds>] [--correct <seconds>] [--correct-threshold <arcmin>] [--correct-mode <goto|adjust>] [--log-file <file>] [--log-sample <code:N>] [--metrics <port>] [--status <seconds>] [--status-codes <code,...>] [--model <file>] [--align <star,...>] [--yaw-limit <degrees>] [--alpaca <port>]"
+    record_path = None
+    opts, args = parse_options(argv, usage, "adhlLt",["lat=","lon=","timeout=","goto-timeout=","feedback-rate=","log518-rate=","history=","record=","polaris=","control=","control-timeout=","max-clients=","heartbeat=","correct=","correct-threshold=","correct-mode=","log-file=","log-sample=","metrics=","status=","status-codes=","model=","align=","yaw-limit=","alpaca="])
     for opt, arg in opts:
-        if opt == '-h':
-            print (usage)
-            sys.exit()
-        elif opt == "--lat":
+        if opt == "--lat":
             lat = float(arg)
         elif opt == "--lon":
             lon = float(arg)
+        elif opt == "--timeout":
+            polaris_timeout = float(arg)
+        elif opt == "--goto-timeout":
+            polaris_goto_timeout = float(arg)
+        elif opt == "--feedback-rate":
+            feedback_rate = float(arg)
+        elif opt == "--log518-rate":
+            log518_rate = float(arg)
+        elif opt == "--history":
+            telemetry_history = float(arg)
+        elif opt == "--record":
+            record_path = arg
+        elif opt == "--polaris":
+            (polaris_ip, _, port) = arg.partition(':')
+            if port:
+                polaris_port = int(port)
+        elif opt == "--control":
+            control_policy = arg
+        elif opt == "--control-timeout":
+            control_timeout = float(arg)
+        elif opt == "--max-clients":
+            max_clients = int(arg)
+        elif opt == "--heartbeat":
+            heartbeat_interval = float(arg)
+        elif opt == "--correct":
+            correct_interval = float(arg)
+        elif opt == "--correct-threshold":
+            correct_threshold = float(arg)
+        elif opt == "--correct-mode":
+            correct_mode = arg
+        elif opt == "--log-file":
+            log_file = arg
+        elif opt == "--metrics":
+            metrics_port = int(arg)
+        elif opt == "--status":
+            status_interval = float(arg)
+        elif opt == "--status-codes":
+            status_codes = tuple(code.strip() for code in arg.split(',') if code.strip())
+        elif opt == "--model":
+            model_path = arg
+        elif opt == "--align":
+            align_stars = tuple(star.strip() for star in arg.split(',') if star.strip())
+        elif opt == "--yaw-limit":
+            yaw_limit = float(arg)
+        elif opt == "--alpaca":
+            alpaca_port = int(arg)
+        elif opt == "--log-sample":
+            (code, _, every) = arg.partition(':')
+            log_sampling[code] = int(every or 1)
         elif opt == "-l":
             LOGGING = True
         elif opt == "-L":
@@ -594,37 +3391,58 @@ async def main(argv):
     if DEBUG:
         print("Debug is on")
 
-    try:
-        server_reader, server_writer = await asyncio.open_connection(polaris_ip, polaris_port)
-    except Exception as e:
-        print(f"Failed to connect to server: {e}")
-        return
-
-    local_server = await asyncio.start_server(lambda reader, writer: handle_local_input(server_writer, reader, writer), 'localhost', local_port)
-
-    tasks = [
-        client_reader(server_reader),
-        polaris_init(server_writer),
-    ]
+    listener = setup_logging(log_file, log_sampling)
+    if log_file:
+        console.info("Logging to %s", log_file)
+
+    if model_path and os.path.exists(model_path) and not align_stars:
+        pointing_model = PointingModel.load(model_path)
+        console.info("Pointing model %s: %s", model_path, pointing_model)
+
+    site = PolarisSite(lat, lon, pointing_model)
+    backend = PolarisBackend(polaris_ip, polaris_port, heartbeat_interval, yaw_limit, status_interval, site, telemetry_history)
+    server = StellariumServer(backend, local_port, feedback_rate, max_clients, policy=control_policy, timeout=control_timeout)
+    client = backend.client
+    if record_path:
+        client.recorder = ProtocolRecorder(record_path)
+        console.info("Recording the Polaris session in %s", record_path)
+
+    # the Stellarium side is the one of stellarium_core, restarted with the head on errors
+    tasks = [run_mounts([server])]
+    if metrics_port:
+        metrics = BridgeMetrics(client, backend.scheduler, backend.supervisor, server, backend.status)
+        tasks.append(metrics.serve(metrics_port))
+    if alpaca_port:
+        telescope = AlpacaTelescope(client, backend.bus, backend.scheduler, backend.supervisor, backend.status, site)
+        tasks.append(telescope.serve(alpaca_port))
+    if correct_interval > 0:
+        corrector = TrackingCorrector(client, backend.bus, backend.scheduler, correct_interval, correct_threshold, correct_mode)
+        tasks.append(corrector.run())
+    if LOG518:
+        tasks.append(telemetry_logger(backend.bus, log518_rate))
+    if align_stars:
+        async def align():
+            model = await polaris_pointing_alignment(client, backend.bus, align_stars, site)
+            if model and model_path:
+                model.save(model_path, site)
+                console.info("Pointing model saved in %s", model_path)
+        tasks.append(backend.when_connected(align))
     
     if TESTS:
-#        tasks.append(polaris_test_move(server_writer))
-#        tasks.append(polaris_test_reset_rotation(server_writer))
-#        tasks.append(polaris_test_new_alignment(server_writer))
-        tasks.append(polaris_test_rotate(server_writer))
+#        tasks.append(backend.when_connected(polaris_test_move, client))
+#        tasks.append(backend.when_connected(polaris_test_reset_rotation, client))
+#        tasks.append(backend.when_connected(polaris_test_new_alignment, client))
+        tasks.append(backend.when_connected(polaris_test_rotate, client))
 
-    async with local_server:
+    try:
         await asyncio.gather(*tasks)
+    finally:
+        if client.recorder:
+            client.recorder.close()
+        listener.stop()
 
 
 #######
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main(sys.argv[1:]))
-    except ValueError as value:
-        print(f"{value}\nQuit.")
-    except Exception as error:
-        print(f"Error {error}, quit.")
-    except KeyboardInterrupt as kb:
-        print("Keyboard interrupt.")
+    run_main(main)
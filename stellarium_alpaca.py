@@ -3,21 +3,14 @@
 import sys
 assert sys.version_info >= (3, 0)
 
-import warnings
-warnings.filterwarnings("ignore", module="urllib3")
-
 import os
-import getopt
-import re
 import asyncio
-import time
-import requests
-from datetime import datetime
-from datetime import timezone
-from math import pi
+import json
+import logging
+from urllib.parse import urlencode
+from math import radians, degrees
 
-# https://rhodesmill.org/pyephem
-import ephem
+from stellarium_core import MountBackend, StellariumServer, run_mounts, parse_options, run_main
 
 ####### Globals
 
@@ -27,6 +20,8 @@ alpaca_server = '127.0.0.1'
 alpaca_port = 5555
 alpaca_client_id = 65432
 alpaca_transaction_id = 123
+alpaca_timeout = 5.0
+alpaca_poll_rate = 2.0
 
 LOGGING = False
 DEBUG = False
@@ -34,86 +29,235 @@ TESTS = False
 
 ####### Alpaca
 
-def alpaca_goto(ra, dec):
-    rest_cmd = '/api/v1/telescope/0/slewtocoordinatesasync'
-    url = 'http://' + alpaca_server + ':' + str(alpaca_port) + rest_cmd
-    payload = {'ClientTransactionID' : str(alpaca_transaction_id) , 'ClientID' : str(alpaca_client_id), 'RightAscension' : str(ra), 'Declination' : str(dec) }
-    if LOGGING:
-        print(f">>> Alpaca: {url}: {payload}")
-    
+class AlpacaError(Exception):
+    """
+    AlpacaError is raised when the Alpaca device answers with a non zero ErrorNumber.
+    """
+    def __init__(self, number, message):
+        super().__init__(f"Alpaca error {number}: {message}")
+        self.number = number
+
+
+class AlpacaClient:
+    """
+    AlpacaClient is an asyncio client of an Alpaca telescope device.
+
+    It keeps a pool of HTTP/1.1 keep-alive connections to the Alpaca server so the
+    requests don't open a new TCP connection each, every request has a timeout and
+    an incrementing ClientTransactionID.
+    """
+
+    def __init__(self, host, port, device=0, client_id=None, timeout=None, pool_size=4):
+        """
+        :param host: the Alpaca server address
+        :param port: the Alpaca server port
+        :param device: the telescope device number
+        :param client_id: the ClientID sent with every request
+        :param timeout: timeout in seconds of a request
+        :param pool_size: maximum number of simultaneous connections
+        """
+        self.host = host
+        self.port = port
+        self.path = f"/api/v1/telescope/{device}/"
+        self.client_id = alpaca_client_id if client_id is None else client_id
+        self.timeout = alpaca_timeout if timeout is None else timeout
+        self.transaction_id = alpaca_transaction_id
+        self.idle = []
+        self.slots = asyncio.Semaphore(pool_size)
+        self.connections = 0
+
+    def next_transaction_id(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xffffffff
+        return self.transaction_id
+
+    async def get(self, name, **params):
+        return await self.request('GET', name, params)
+
+    async def put(self, name, **params):
+        return await self.request('PUT', name, params)
+
+    async def request(self, method, name, params):
+        """
+        request calls an Alpaca telescope method and returns its Value.
+
+        :param method: 'GET' or 'PUT'
+        :param name: the lower case Alpaca method name, e.g. 'slewing'
+        :param params: dict of the method parameters
+        :raise AlpacaError: if the device answers with an error
+        :raise asyncio.TimeoutError: if the device doesn't answer in time
+        """
+        params = dict(params, ClientID=self.client_id, ClientTransactionID=self.next_transaction_id())
+        query = urlencode(params)
+        if method == 'GET':
+            head = f"GET {self.path}{name}?{query} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n\r\n"
+            body = b''
+        else:
+            body = query.encode()
+            head = (f"{method} {self.path}{name} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                    f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n\r\n")
+        if LOGGING:
+            print(f">>> Alpaca: {method} {name}: {params}")
+        async with self.slots:
+            (status, content) = await asyncio.wait_for(self.exchange(head.encode() + body), self.timeout)
+        if DEBUG:
+            print(f"<<< Alpaca: {name} http status code={status} response={content}")
+        if status != 200:
+            raise AlpacaError(status, content.decode(errors='replace').strip())
+        reply = json.loads(content)
+        if reply.get('ErrorNumber', 0):
+            raise AlpacaError(reply['ErrorNumber'], reply.get('ErrorMessage', ''))
+        return reply.get('Value')
+
+    async def exchange(self, data):
+        # a pooled connection may have been closed by the server while idle, retry once on a new one
+        while True:
+            if self.idle:
+                (reader, writer) = self.idle.pop()
+                reused = True
+            else:
+                (reader, writer) = await asyncio.open_connection(self.host, self.port)
+                self.connections += 1
+                reused = False
+            try:
+                writer.write(data)
+                await writer.drain()
+                (status, keep_alive, content) = await self.read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return (status, content)
+
+    async def read_response(self, reader):
+        status_line = await reader.readuntil(b'\r\n')
+        (version, status) = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            (name, _, value) = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = b''
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                content += chunk[:-2]
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            headers['connection'] = 'close'
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version != b'HTTP/1.0' or connection == 'keep-alive')
+        return (int(status), keep_alive, content)
+
+    async def close(self):
+        while self.idle:
+            (reader, writer) = self.idle.pop()
+            writer.close()
+
+
+async def alpaca_goto(alpaca, ra, dec):
+    """
+    alpaca_goto starts a slew of the Alpaca telescope, it doesn't wait for its end.
+
+    :param alpaca: the AlpacaClient of the telescope
+    :param ra: J2000 right ascension in hours
+    :param dec: J2000 declination in degrees
+    """
     try:
-        r = requests.put(url, data=payload)
+        await alpaca.put('slewtocoordinatesasync', RightAscension=ra, Declination=dec)
         if DEBUG:
-            print(f"alpaca_goto ra={ra} decl={dec} http status code={r.status_code} response={r.content}")
-    
+            print(f"alpaca_goto ra={ra} decl={dec}")
+    except asyncio.TimeoutError:
+        print(f"Error alpaca_goto ra={ra} decl={dec} timed out")
     except Exception as error:
         print(f"Error {error}")
-    
-####### Stellarium
 
-def dec2dms(dd):
-   is_positive = dd >= 0
-   dd = abs(dd)
-   minutes,seconds = divmod(dd*3600,60)
-   degrees,minutes = divmod(minutes,60)
-   degrees = degrees if is_positive else -degrees
-   return f"{int(degrees)}:{int(minutes)}:{seconds:.2f}"
 
-def dms2dec(dms):
-    (degree, minute, second, frac_seconds) = re.split('\D+', dms, maxsplit=4)
-    return int(degree) + float(minute) / 60 + float(second) / 3600 + float(frac_seconds) / 360000
+class AlpacaBackend(MountBackend):
+    """
+    AlpacaBackend drives an Alpaca telescope for the StellariumServer of
+    stellarium_core. The position of the telescope is polled without blocking
+    and cached for the position packets sent to Stellarium.
+    """
 
-def decode_stellarium_packet(s):
-    t = int.from_bytes(s[4:11], byteorder='little')
+    def __init__(self, host, port, device=0, rate=2.0):
+        """
+        :param host: the Alpaca server address
+        :param port: the Alpaca server port
+        :param device: the telescope device number
+        :param rate: number of polls per second
+        """
+        self.name = f"Alpaca {host}:{port}"
+        self.alpaca = AlpacaClient(host, port, device)
+        self.interval = 1 / rate
+        self.slewing = None
+        self.ra = None
+        self.dec = None
 
-    ra = int.from_bytes(s[12:16], byteorder='little')
-    dec = int.from_bytes(s[16:20], byteorder='little', signed=True)
+    async def poll(self):
+        (self.slewing, self.ra, self.dec) = await asyncio.gather(
+            self.alpaca.get('slewing'),
+            self.alpaca.get('rightascension'),
+            self.alpaca.get('declination'))
 
-    ra = (24*ra)/0x100000000
-    dec = (90*dec)/0x40000000
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception as error:
+                if DEBUG:
+                    print(f"Error polling Alpaca: {error}")
 
-    if DEBUG:
-        print(f"<<< Stellarium: t={t} ra={ra} dec={dec}")
-    
-    return (ra, dec)
+    async def goto(self, ra, dec, t):
+        if DEBUG:
+            print(f"<<< Stellarium: t={t} ra={degrees(ra) / 15} dec={degrees(dec)}")
+        await alpaca_goto(self.alpaca, degrees(ra) / 15, degrees(dec))
 
-####### main loop
+    def position(self):
+        if self.ra is None or self.dec is None:
+            return None
+        return (radians(self.ra * 15), radians(self.dec))
 
-async def mainloop():
-    while True:
-        await asyncio.sleep(1)
+    def stats(self):
+        return {'slewing': self.slewing, 'connections': self.alpaca.connections}
 
-####### network
+    async def close(self):
+        await self.alpaca.close()
 
-async def handle_local_input(reader, writer):
-    while True:
-        data = await reader.read(256)
-        if not data:
-            break
-        if DEBUG:
-            print(f"<<< Stellarium: {':'.join(('0'+hex(x)[2:])[-2:] for x in data)}")
-        (ra, dec) = decode_stellarium_packet(data)
-        alpaca_goto(ra, dec)
 
 async def main(argv):
-    global LOGGING, DEBUG, TESTS
+    global LOGGING, DEBUG
     global local_port
-    global alpaca_port
+    global alpaca_server, alpaca_port, alpaca_timeout, alpaca_poll_rate
     
-    usage = f"{os.path.basename(sys.argv[0])} [-dhl]  --StellariumPort <Stellarium port> --AlpacaPort <Alpca port>"
-    try:
-        opts, args = getopt.getopt(argv,"dhl",["StellariumPort=", "AlpacaPort="])
-    except getopt.GetoptError:
-        print (usage)
-        sys.exit(2)
+    usage = f"{os.path.basename(sys.argv[0])} [-dhl]  --StellariumPort <Stellarium port> --AlpacaPort <Alpca port> [--AlpacaServer <address>] [--Timeout <seconds>] [--PollRate <Hz>]"
+    opts, args = parse_options(argv, usage, "dhl", ["StellariumPort=", "AlpacaPort=", "AlpacaServer=", "Timeout=", "PollRate="])
     for opt, arg in opts:
-        if opt == '-h':
-            print (usage)
-            sys.exit()
-        elif opt == "--StellariumPort":
+        if opt == "--StellariumPort":
             local_port = int(arg)
         elif opt == "--AlpacaPort":
             alpaca_port = int(arg)
+        elif opt == "--AlpacaServer":
+            alpaca_server = arg
+        elif opt == "--Timeout":
+            alpaca_timeout = float(arg)
+        elif opt == "--PollRate":
+            alpaca_poll_rate = float(arg)
         elif opt == "-l":
             LOGGING = True
         elif opt == "-d":
@@ -128,24 +272,14 @@ async def main(argv):
     if DEBUG:
         print("Debug is on")
 
-    local_server = await asyncio.start_server(lambda reader, writer: handle_local_input(reader, writer), 'localhost', local_port)
+    # the progress messages of stellarium_core
+    logging.basicConfig(stream=sys.stdout, format='%(message)s')
 
-    tasks = [
-        mainloop()
-    ]
-    
-    async with local_server:
-        await asyncio.gather(*tasks)
+    backend = AlpacaBackend(alpaca_server, alpaca_port, rate=alpaca_poll_rate)
+    await run_mounts([StellariumServer(backend, local_port, alpaca_poll_rate)])
 
 
 #######
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main(sys.argv[1:]))
-    except ValueError as value:
-        print(f"{value}\nQuit.")
-    except Exception as error:
-        print(f"Error {error}, quit.")
-    except KeyboardInterrupt as kb:
-        print("Keyboard interrupt.")
+    run_main(main)
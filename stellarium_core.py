@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import getopt
+import re
+import asyncio
+import time
+import struct
+import logging
+from abc import ABC, abstractmethod
+from math import pi
+
+####### Globals
+
+log = logging.getLogger('polaris.stellarium')
+
+# the progress messages, shown whatever the log level
+console = logging.getLogger('polaris.console')
+console.setLevel(logging.INFO)
+
+
+####### Stellarium
+
+STELLARIUM_RA_UNIT = 2 * pi / 0x100000000
+STELLARIUM_DEC_UNIT = (pi / 2) / 0x40000000
+STELLARIUM_HEADER = struct.Struct('<HH')
+STELLARIUM_GOTO = struct.Struct('<qIi')
+
+def dec2dms(dd):
+   is_positive = dd >= 0
+   dd = abs(dd)
+   minutes,seconds = divmod(dd*3600,60)
+   degrees,minutes = divmod(minutes,60)
+   degrees = degrees if is_positive else -degrees
+   return f"{int(degrees)}:{int(minutes)}:{seconds:.2f}"
+
+def dms2dec(dms):
+    (degree, minute, second, frac_seconds) = re.split(r'\D+', dms, maxsplit=4)
+    return int(degree) + float(minute) / 60 + float(second) / 3600 + float(frac_seconds) / 360000
+
+
+class StellariumFrameParser:
+    """
+    StellariumFrameParser splits the stream of a Stellarium client into packets.
+
+    Every packet starts with its length and its type, 2 little endian bytes each,
+    the goto packet (type 0) is 20 bytes long. A packet may be split across reads
+    and several of them may be coalesced in one, feed() returns all the complete
+    goto packets and keeps the incomplete one for the next read. The packets of
+    another type are skipped, a length that can't be a packet means the stream is
+    out of sync and the pending bytes are dropped.
+    """
+    goto_type = 0
+    goto_size = 20
+    max_size = 256
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.packets = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """
+        feed appends data to the pending buffer and returns the complete goto packets.
+
+        :param data: bytes received from the client
+        :return: a list of goto packets, oldest first
+        """
+        buffer = self.buffer
+        buffer += data
+        packets = []
+        start = 0
+        while len(buffer) - start >= 4:
+            (size, kind) = STELLARIUM_HEADER.unpack_from(buffer, start)
+            if size < 4 or size > self.max_size:
+                self.errors += 1
+                start = len(buffer)
+                break
+            if len(buffer) - start < size:
+                break
+            if kind == self.goto_type and size >= self.goto_size:
+                packets.append(bytes(buffer[start:start + size]))
+            else:
+                self.errors += 1
+            start += size
+        if start:
+            del buffer[:start]
+        self.packets += len(packets)
+        return packets
+
+
+def decode_stellarium_goto(packet):
+    """
+    decode_stellarium_goto returns the (t, ra, dec) of a goto packet, t the UTC unix
+    timestamp in seconds, ra and dec the J2000 coordinates in radians.
+    """
+    (t, ra, dec) = STELLARIUM_GOTO.unpack_from(packet, 4)
+    return (t / 1E6, ra * STELLARIUM_RA_UNIT, dec * STELLARIUM_DEC_UNIT)
+
+
+def encode_stellarium_position(ra, dec, t, status=0):
+    """
+    encode_stellarium_position builds the 24 bytes "current position" packet sent
+    to Stellarium.
+
+    :param ra: J2000 right ascension in radians
+    :param dec: J2000 declination in radians
+    :param t: UTC unix timestamp in seconds
+    :param status: 0 if the position is valid
+    """
+    return struct.pack('<HHqIii', 24, 0, int(t * 1E6),
+                       int(round(ra / STELLARIUM_RA_UNIT)) & 0xffffffff,
+                       int(round(dec / STELLARIUM_DEC_UNIT)), status)
+
+
+def broadcast_stellarium_position(writers, ra, dec, t, max_buffered=4096):
+    """
+    broadcast_stellarium_position writes the same "current position" packet to
+    every Stellarium client, the closed ones are removed from writers.
+
+    A client not reading its socket skips the packets while more than max_buffered
+    bytes are waiting for it instead of slowing the others.
+
+    :param writers: the set of StreamWriter of the clients
+    :param ra: J2000 right ascension in radians
+    :param dec: J2000 declination in radians
+    :param t: UTC unix timestamp in seconds
+    :param max_buffered: bytes pending on a client above which its packet is skipped
+    """
+    packet = encode_stellarium_position(ra, dec, t)
+    for writer in list(writers):
+        if writer.is_closing():
+            writers.discard(writer)
+        elif writer.transport.get_write_buffer_size() < max_buffered:
+            writer.write(packet)
+
+
+####### Mounts
+
+class MountSetupError(ValueError):
+    """
+    MountSetupError is raised by a backend that can't be used as it is set up (e.g.
+    a Polaris not in astro mode), serve_mount doesn't restart it and the program
+    stops like on a wrong option.
+    """
+
+
+class MountBackend(ABC):
+    """
+    MountBackend is the interface of a mount driven by a StellariumServer, the
+    Polaris head (PolarisBackend of polaris_stellarium.py) or an Alpaca telescope
+    (AlpacaBackend of stellarium_alpaca.py).
+
+    All the state of a mount belongs to its backend object so several of them can
+    run in the same event loop. A backend missing run, goto or position can't be
+    instantiated.
+    """
+    name = 'mount'
+
+    @abstractmethod
+    async def run(self):
+        """
+        run drives the mount (connection, polling...) until cancelled.
+        """
+
+    @abstractmethod
+    async def goto(self, ra, dec, t):
+        """
+        goto points the mount at J2000 (ra, dec) in radians, clicked at UTC unix time t.
+        """
+
+    @abstractmethod
+    def position(self):
+        """
+        position returns the last known J2000 (ra, dec) in radians of the mount, None
+        if unknown, without any round trip to the mount.
+        """
+
+    def stats(self):
+        return {}
+
+    async def close(self):
+        pass
+
+
+class StellariumServer:
+    """
+    StellariumServer serves one mount to the Stellarium clients connected to a local
+    port: the gotos received are sent to the backend and the position of the mount
+    is sent back to every client rate times per second.
+
+    With the 'last' policy every client may move the mount and the last goto wins.
+    With the 'lock' policy the first client sending a goto takes the control, the
+    gotos of the other clients are rejected until it disconnects or doesn't send any
+    goto for timeout seconds. In both cases the position is sent to every client.
+    """
+    max_buffered = 4096
+    policies = ('last', 'lock')
+
+    def __init__(self, backend, port, rate=2.0, max_clients=8, host='localhost', policy='last', timeout=300.0):
+        """
+        :param backend: the MountBackend of the mount
+        :param port: the local port Stellarium connects to
+        :param rate: number of position packets sent per second, 0 for none
+        :param max_clients: number of simultaneous clients, the others are refused
+        :param host: the local address to listen on
+        :param policy: 'last' or 'lock'
+        :param timeout: idle time in seconds after which the control lock is released
+        """
+        if policy not in self.policies:
+            raise ValueError(f"Unknown control policy {policy}, expected one of {', '.join(self.policies)}")
+        self.backend = backend
+        self.port = port
+        self.rate = rate
+        self.max_clients = max_clients
+        self.host = host
+        self.policy = policy
+        self.timeout = timeout
+        self.writers = set()
+        self.owner = None
+        self.owner_goto = None
+        self.gotos = 0
+        self.superseded = 0
+        self.rejected = 0
+        self.refused = 0
+        self.errors = 0
+        self.packets = 0
+
+    def has_control(self, writer, peer):
+        """
+        has_control returns True if the client may move the mount, with the 'lock'
+        policy the client takes the control if nobody has it.
+        """
+        if self.policy == 'last':
+            return True
+        if self.owner is not None and self.owner is not writer and time.monotonic() - self.owner_goto > self.timeout:
+            log.info("%s: Stellarium client %s lost the control after %ss without goto", self.backend.name,
+                     self.owner.get_extra_info('peername'), self.timeout)
+            self.owner = None
+        if self.owner is None:
+            self.owner = writer
+            log.info("%s: Stellarium client %s took the control", self.backend.name, peer)
+        if self.owner is not writer:
+            return False
+        self.owner_goto = time.monotonic()
+        return True
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        if len(self.writers) >= self.max_clients:
+            self.refused += 1
+            console.info("%s: Stellarium client %s refused, %s clients already connected", self.backend.name, peer, self.max_clients)
+            writer.close()
+            return
+        self.writers.add(writer)
+        console.info("%s: Stellarium client %s connected", self.backend.name, peer)
+        parser = StellariumFrameParser()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                packets = parser.feed(data)
+                if not packets:
+                    continue
+                for packet in packets:
+                    log.debug("<<< Stellarium %s: %s", self.port, packet.hex(':'))
+                # a burst of gotos is collapsed, only the newest one is sent
+                self.superseded += len(packets) - 1
+                if not self.has_control(writer, peer):
+                    self.rejected += 1
+                    console.info("%s: goto of Stellarium client %s rejected, client %s has the control",
+                                 self.backend.name, peer, self.owner.get_extra_info('peername'))
+                    continue
+                self.gotos += 1
+                (t, ra, dec) = decode_stellarium_goto(packets[-1])
+                await self.backend.goto(ra, dec, t)
+        finally:
+            self.errors += parser.errors
+            self.writers.discard(writer)
+            if self.owner is writer:
+                self.owner = None
+                log.info("%s: Stellarium client %s released the control", self.backend.name, peer)
+            writer.close()
+            console.info("%s: Stellarium client %s disconnected", self.backend.name, peer)
+
+    async def broadcast(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            if not self.writers:
+                continue
+            position = self.backend.position()
+            if position is None:
+                continue
+            broadcast_stellarium_position(self.writers, position[0], position[1], time.time(), self.max_buffered)
+            self.packets += 1
+
+    async def serve(self):
+        """
+        serve runs the backend and accepts the Stellarium clients until cancelled.
+        """
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        console.info("%s: Stellarium port %s", self.backend.name, self.port)
+        tasks = [asyncio.create_task(self.backend.run())]
+        if self.rate > 0:
+            tasks.append(asyncio.create_task(self.broadcast()))
+        try:
+            async with server:
+                await asyncio.gather(*tasks)
+        finally:
+            # an error of one task stops the others, serve_mount may restart them
+            for task in tasks:
+                task.cancel()
+            await self.backend.close()
+
+    def stats(self):
+        return dict(self.backend.stats(), clients=len(self.writers), gotos=self.gotos, superseded=self.superseded,
+                    rejected=self.rejected, refused=self.refused, errors=self.errors, packets=self.packets)
+
+
+async def serve_mount(server, retry_min=1.0, retry_max=60.0, retries=None):
+    """
+    serve_mount runs the StellariumServer of one mount until cancelled, an error of
+    the mount is logged and its server restarted after a growing delay, so it
+    doesn't stop the other mounts. A MountSetupError isn't retried, a restart
+    wouldn't fix it and would only drop the Stellarium clients each time.
+
+    :param server: the StellariumServer of the mount
+    :param retry_min: first delay in seconds before a restart
+    :param retry_max: largest delay in seconds between two restarts
+    :param retries: number of restarts before the mount is dropped, None for no limit
+    """
+    delay = retry_min
+    failures = 0
+    while True:
+        started = time.monotonic()
+        try:
+            await server.serve()
+            return
+        except (asyncio.CancelledError, MountSetupError):
+            raise
+        except Exception as error:
+            log.debug("%s: mount failed", server.backend.name, exc_info=True)
+            console.info("%s: error %s", server.backend.name, error)
+            failures += 1
+        if retries is not None and failures > retries:
+            console.info("%s: dropped after %s errors", server.backend.name, failures)
+            return
+        if time.monotonic() - started > retry_max:
+            # it ran fine for a while, a new error
+            delay = retry_min
+        console.info("%s: restart in %.0fs", server.backend.name, delay)
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, retry_max)
+
+
+async def run_mounts(servers, retries=None):
+    """
+    run_mounts serves several mounts in the same event loop, each one with its own
+    StellariumServer and backend. A mount failing is restarted or dropped alone (see
+    serve_mount), the others keep running.
+
+    :param servers: the StellariumServer of every mount
+    :param retries: number of restarts of a failing mount before it is dropped, None for no limit
+    """
+    await asyncio.gather(*(serve_mount(server, retries=retries) for server in servers))
+
+
+####### Command line
+
+def parse_options(argv, usage, shortopts, longopts):
+    """
+    parse_options parses the command line with getopt, prints the usage and exits
+    on an unknown option or with -h.
+
+    :return: the (opts, args) of getopt
+    """
+    try:
+        opts, args = getopt.getopt(argv, shortopts, longopts)
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    if ('-h', '') in opts:
+        print (usage)
+        sys.exit()
+    return (opts, args)
+
+
+def run_main(main):
+    """
+    run_main runs the async main of a script with its command line arguments.
+    """
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except ValueError as value:
+        print(f"{value}\nQuit.")
+    except Exception as error:
+        print(f"Error {error}, quit.")
+    except KeyboardInterrupt:
+        print("Keyboard interrupt.")
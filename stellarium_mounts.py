@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import sys
+assert sys.version_info >= (3, 0)
+
+import os
+
+import polaris_stellarium as polaris
+import stellarium_alpaca as alpaca
+from stellarium_core import StellariumServer, run_mounts, parse_options, run_main
+
+####### Globals
+
+feedback_rate = 2.0
+max_clients = 8
+retries = None
+
+LOGGING = False
+DEBUG = False
+
+####### Mounts
+
+def parse_mount(arg, default_port=None):
+    """
+    parse_mount splits a mount option "<address[:port]>=<Stellarium port>".
+
+    :return: (address, port, Stellarium port)
+    """
+    (address, sep, local_port) = arg.rpartition('=')
+    if not sep:
+        raise ValueError(f"Missing Stellarium port in {arg}")
+    (host, _, port) = address.partition(':')
+    if not port and default_port is None:
+        raise ValueError(f"Missing port in {address}")
+    return (host, int(port) if port else default_port, int(local_port))
+
+
+async def main(argv):
+    global LOGGING, DEBUG
+    global feedback_rate, max_clients, retries
+
+    usage = f"{os.path.basename(sys.argv[0])} [-dhl] --lat <latitude> --lon <longitude> [[--model <file>] --polaris <address[:port]>=<Stellarium port>]... [--alpaca <address:port>=<Stellarium port>]... [--feedback-rate <Hz>] [--max-clients <count>] [--yaw-limit <degrees>] [--retries <count>]"
+    opts, args = parse_options(argv, usage, "dhl", ["lat=", "lon=", "model=", "polaris=", "alpaca=", "feedback-rate=", "max-clients=", "yaw-limit=", "retries="])
+    mounts = []
+    model_path = None
+    for opt, arg in opts:
+        if opt == "--lat":
+            polaris.lat = float(arg)
+        elif opt == "--lon":
+            polaris.lon = float(arg)
+        elif opt == "--model":
+            # the pointing model of the --polaris heads that follow
+            model_path = arg or None
+        elif opt == "--polaris":
+            mounts.append(('polaris', parse_mount(arg, polaris.polaris_port), model_path))
+        elif opt == "--alpaca":
+            mounts.append(('alpaca', parse_mount(arg), None))
+        elif opt == "--feedback-rate":
+            feedback_rate = float(arg)
+        elif opt == "--max-clients":
+            max_clients = int(arg)
+        elif opt == "--yaw-limit":
+            polaris.yaw_limit = float(arg)
+        elif opt == "--retries":
+            retries = int(arg)
+        elif opt == "-l":
+            LOGGING = True
+        elif opt == "-d":
+            DEBUG = True
+
+    if not mounts or (any(kind == 'polaris' for (kind, _, _) in mounts) and (polaris.lat is None or polaris.lon is None)):
+        print(usage)
+        sys.exit(2)
+
+    polaris.LOGGING = alpaca.LOGGING = LOGGING
+    polaris.DEBUG = alpaca.DEBUG = DEBUG
+
+    if polaris.lat is not None:
+        print (f"Current location: latitude={polaris.lat} longitude={polaris.lon}")
+
+    if LOGGING:
+        print("Logging is on")
+
+    if DEBUG:
+        print("Debug is on")
+
+    listener = polaris.setup_logging()
+
+    servers = []
+    for (kind, (host, port, local_port), model_path) in mounts:
+        if kind == 'polaris':
+            # every head has its own site and pointing model
+            model = polaris.PointingModel.load(model_path) if model_path else None
+            if model:
+                print(f"Polaris {host}:{port}: pointing model {model_path}: {model}")
+            site = polaris.PolarisSite(polaris.lat, polaris.lon, model)
+            backend = polaris.PolarisBackend(host, port, polaris.heartbeat_interval, polaris.yaw_limit, polaris.status_interval, site)
+        else:
+            backend = alpaca.AlpacaBackend(host, port, rate=feedback_rate or alpaca.alpaca_poll_rate)
+        servers.append(StellariumServer(backend, local_port, feedback_rate, max_clients))
+
+    try:
+        await run_mounts(servers, retries)
+    finally:
+        listener.stop()
+
+
+#######
+
+if __name__ == "__main__":
+    run_main(main)
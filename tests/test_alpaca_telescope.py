@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import polaris_stellarium as polaris
+
+
+def make_telescope():
+    client = polaris.PolarisClient()
+    bus = polaris.TelemetryBus(client)
+    scheduler = polaris.GotoScheduler(client)
+    supervisor = polaris.PolarisSupervisor(client, '127.0.0.1', 9090)
+    status = polaris.StatusPoller(client, interval=0)
+    return polaris.AlpacaTelescope(client, bus, scheduler, supervisor, status, polaris.PolarisSite(44.5, 4.42))
+
+
+async def exchange(request):
+    telescope = make_telescope()
+    server = await asyncio.start_server(telescope.handle, '127.0.0.1', 0)
+    (reader, writer) = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+    writer.write(request)
+    writer.write_eof()
+    # every request gets an answer, the connection is never dropped silently
+    response = await asyncio.wait_for(reader.read(), 2)
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return response
+
+
+async def get(target):
+    response = await exchange(f"GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    (_, _, body) = response.partition(b'\r\n\r\n')
+    return json.loads(body)
+
+
+def test_client_transaction_id():
+    body = asyncio.run(get('/api/v1/telescope/0/sitelatitude?ClientTransactionID=42'))
+    assert body['ClientTransactionID'] == 42
+    assert body['Value'] == 44.5
+
+
+def test_invalid_client_transaction_id():
+    for value in ('abc', '-1', '4294967296', '1.5'):
+        body = asyncio.run(get(f'/api/v1/telescope/0/sitelongitude?ClientTransactionID={value}'))
+        assert body['ClientTransactionID'] == 0
+        assert body['ErrorNumber'] == 0
+        assert body['Value'] == 4.42
+
+
+def test_bad_content_length():
+    response = asyncio.run(exchange(b"PUT /api/v1/telescope/0/abortslew HTTP/1.1\r\nContent-Length: x\r\n\r\n"))
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+
+def test_bad_request_line():
+    response = asyncio.run(exchange(b"GARBAGE\r\n\r\n"))
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
@@ -0,0 +1,64 @@
+from datetime import datetime, timezone
+from math import cos, degrees, hypot, pi, radians
+
+import ephem
+
+from polaris_stellarium import CoordinateTransform, np
+
+LAT = 44.5
+LON = 4.42
+
+EPOCHS = [datetime(year, month, 1, hour, tzinfo=timezone.utc).timestamp()
+          for (year, month, hour) in ((2000, 1, 12), (2012, 6, 3), (2024, 8, 22), (2031, 3, 5), (2045, 11, 18))]
+# -0.5° and -0.01° lost their sign in the dec2dms strings of the legacy conversion
+DECLINATIONS = (-75.0, -30.0, -0.99, -0.5, -0.01, 0.0, 0.3, 20.0, 60.0, 89.0)
+RIGHT_ASCENSIONS = (0.0, 1.3, 2.9, 4.4, 5.8)
+
+
+def ephem_radec_to_azalt(ra, dec, t):
+    observer = ephem.Observer()
+    observer.long = radians(LON)
+    observer.lat = radians(LAT)
+    observer.elevation = 0
+    observer.pressure = 0
+    observer.epoch = ephem.J2000
+    observer.date = ephem.Date(datetime.fromtimestamp(t, tz=timezone.utc))
+    target = ephem.FixedBody()
+    target._ra = ra
+    target._dec = dec
+    target._epoch = ephem.J2000
+    target.compute(observer)
+    return (float(target.az), float(target.alt))
+
+
+def arcsec(azalt, reference):
+    daz = (azalt[0] - reference[0] + pi) % (2 * pi) - pi
+    return degrees(hypot(daz * cos(reference[1]), azalt[1] - reference[1])) * 3600
+
+
+def targets():
+    return [(ra, radians(dec), t) for t in EPOCHS for dec in DECLINATIONS for ra in RIGHT_ASCENSIONS]
+
+
+def test_scalar_agrees_with_ephem():
+    transform = CoordinateTransform(LAT, LON)
+    for (ra, dec, t) in targets():
+        assert arcsec(transform.radec_to_azalt(ra, dec, t), ephem_radec_to_azalt(ra, dec, t)) < 1, (ra, degrees(dec), t)
+
+
+def test_batch_agrees_with_ephem():
+    transform = CoordinateTransform(LAT, LON)
+    (ra, dec, t) = map(list, zip(*targets()))
+    if np is not None:
+        (ra, dec, t) = (np.asarray(ra), np.asarray(dec), np.asarray(t))
+    (az, alt) = transform.radec_to_azalt_batch(ra, dec, t)
+    for (i, target) in enumerate(targets()):
+        assert arcsec((az[i], alt[i]), ephem_radec_to_azalt(*target)) < 1, (target[0], degrees(target[1]), target[2])
+
+
+def test_azalt_to_radec_round_trip():
+    transform = CoordinateTransform(LAT, LON)
+    for (ra, dec, t) in targets():
+        (az, alt) = transform.radec_to_azalt(ra, dec, t)
+        # the aberration is removed to first order, far below the arcsecond
+        assert arcsec(transform.azalt_to_radec(az, alt, t), (ra, dec)) < 0.01
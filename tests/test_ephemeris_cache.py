@@ -0,0 +1,39 @@
+import asyncio
+import threading
+
+from polaris_stellarium import EphemerisCache
+
+
+class CountingCache(EphemerisCache):
+    # the tables are not computed, only the nights asked
+    def compute(self, key):
+        self.computed += 1
+        self.thread = threading.get_ident()
+        return (key, {})
+
+
+def test_least_recently_used_night_evicted():
+    cache = CountingCache(44.5, 4.42, max_nights=2)
+    today = 20000 * 86400 + 43200
+    cache.night(today)
+    cache.night(today - 86400)
+    cache.night(today)
+    # a night older than the cached ones evicts yesterday, not itself
+    cache.night(today - 2 * 86400)
+    cache.night(today - 2 * 86400)
+    cache.night(today)
+    assert cache.computed == 3
+    assert cache.evicted == 1
+    assert list(cache.nights) == [cache.night_of(today - 2 * 86400), cache.night_of(today)]
+
+
+def test_prepare_computes_off_the_event_loop():
+    cache = CountingCache(44.5, 4.42)
+    today = 20000 * 86400 + 43200
+    asyncio.run(cache.prepare(today))
+    assert cache.thread != threading.get_ident()
+    assert cache.computed == 1
+    cache.night(today)
+    asyncio.run(cache.prepare(today))
+    # the lookup and the second prepare find the night cached
+    assert cache.computed == 1
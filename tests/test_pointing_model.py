@@ -0,0 +1,64 @@
+import asyncio
+import random
+
+import pytest
+
+from polaris_stellarium import PointingModel, PolarisClient, PolarisSite, SlewPlanner, TelemetryBus
+
+
+HEAD = PointingModel({'IA': 0.5, 'IE': -0.3, 'CA': 0.2, 'NPAE': -0.1, 'AN': 0.05, 'AW': -0.08})
+
+
+def head_reading(az, alt):
+    # centered on a star at (az, alt) the head reads (az, alt) + offsets
+    (daz, dalt) = HEAD.offsets(az, alt)
+    return ((az + daz) % 360, alt + dalt)
+
+
+def head_pointing(az_sent, alt_sent):
+    # the head goes where its reading is the position sent
+    (az, alt) = (az_sent, alt_sent)
+    for _ in range(50):
+        (az_read, alt_read) = head_reading(az, alt)
+        az -= (az_read - az_sent + 180) % 360 - 180
+        alt -= alt_read - alt_sent
+    return (az % 360, alt)
+
+
+def test_fit_then_apply_round_trip():
+    rng = random.Random(1)
+    model = PointingModel()
+    for _ in range(12):
+        (az, alt) = (rng.uniform(0, 360), rng.uniform(15, 80))
+        model.add(az, alt, *head_reading(az, alt))
+    assert model.fit() == pytest.approx(0, abs=1e-6)
+    for term in PointingModel.terms:
+        assert model.coefficients[term] == pytest.approx(HEAD.coefficients[term], abs=1e-6)
+    for _ in range(20):
+        target = (rng.uniform(0, 360), rng.uniform(15, 80))
+        (az, alt) = head_pointing(*model.apply(*target))
+        assert (az - target[0] + 180) % 360 - 180 == pytest.approx(0, abs=1e-6)
+        assert alt == pytest.approx(target[1], abs=1e-6)
+
+
+def test_apply_adds_the_offsets():
+    model = PointingModel({'IA': 0.5, 'IE': -0.3})
+    (daz, dalt) = model.offsets(100, 40)
+    (az, alt) = model.apply(100, 40)
+    assert (az - 100, alt - 40) == pytest.approx((daz, dalt))
+    assert head_pointing(*PointingModel(HEAD.coefficients).apply(100, 40)) == pytest.approx((100, 40), abs=1e-6)
+
+
+def test_fit_without_samples():
+    with pytest.raises(ValueError):
+        PointingModel().fit()
+
+
+def test_yaw_chosen_for_the_corrected_azimuth():
+    # the model moves az 179.9 to 180.4, across the -180..180 yaw seam
+    site = PolarisSite(44.5, 4.42, PointingModel({'IA': -0.5}))
+    planner = SlewPlanner(TelemetryBus(PolarisClient()), yaw_limit=540)
+    planner.position = (179.5, 40.0)
+    plan = asyncio.run(planner.plan(179.9, 40.0, 0.0, False, site))
+    assert plan.yaw == pytest.approx(179.6)
+    assert plan.wrap == 0
@@ -0,0 +1,365 @@
+import asyncio
+import time
+from math import degrees, radians
+
+import pytest
+
+from polaris_stellarium import POLARIS_COMMANDS, GotoScheduler, PolarisClient, PolarisFrameParser, PolarisSite, TelemetryBus, polaris_command, polaris_goto_done
+
+
+class Writer:
+    # the StreamWriter side of the Polaris connection, records every write
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data.decode())
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        pass
+
+
+def test_send_nowait_on_a_full_queue_keeps_the_order():
+    async def run():
+        writer = Writer()
+        client = PolarisClient(None, writer)
+        queued = [f"1&{n}&3&-1#" for n in range(client.max_queued)]
+        for msg in queued:
+            client.send_nowait(msg)
+        assert client.outgoing.full()
+        client.send_nowait("1&532&3&speed:0;#")
+        # nothing is written outside of the write_loop
+        assert writer.writes == []
+        loop = asyncio.create_task(client.write_loop())
+        while client.sent < len(queued) + 1:
+            await asyncio.sleep(0)
+        loop.cancel()
+        return (writer.writes, queued)
+
+    (writes, queued) = asyncio.run(run())
+    assert ''.join(writes) == ''.join(queued) + "1&532&3&speed:0;#"
+
+
+def test_send_nowait_dropped_on_reconnection():
+    async def run():
+        writer = Writer()
+        client = PolarisClient(None, writer)
+        for n in range(client.max_queued + 1):
+            client.send_nowait(f"1&{n}&3&-1#")
+        client.attach(None, writer)
+        await asyncio.sleep(0)
+        return client
+
+    client = asyncio.run(run())
+    assert client.outgoing.empty()
+    assert not client.overflow
+
+
+def test_parser_split_frames():
+    parser = PolarisFrameParser()
+    assert parser.feed(b"284@mode:8;sta") == []
+    assert parser.feed(b"te:0;") == []
+    assert parser.feed(b"#5") == [('284', 'mode:8;state:0;')]
+    assert parser.feed(b"20@ret:0;#") == [('520', 'ret:0;')]
+    assert parser.buffer == bytearray()
+    assert (parser.frames, parser.errors) == (2, 0)
+
+
+def test_parser_coalesced_frames():
+    parser = PolarisFrameParser()
+    frames = parser.feed(b"520@ret:0;#524@state:1;#h#517@yaw:-0.129433;pitch:0.007093;roll:0.019947;#545@dir:0;#531@")
+    assert frames == [('520', 'ret:0;'), ('524', 'state:1;'), ('h', ''),
+                      ('517', 'yaw:-0.129433;pitch:0.007093;roll:0.019947;'), ('545', 'dir:0;')]
+    assert parser.buffer == bytearray(b"531@")
+    assert parser.feed(b"ret:1;#") == [('531', 'ret:1;')]
+
+
+def test_parser_garbage_dropped():
+    parser = PolarisFrameParser(max_size=16)
+    assert parser.feed(b"xyz#52@ret:0;##780@hw:1#") == [('780', 'hw:1')]
+    assert parser.errors == 2
+    # an unterminated frame larger than max_size is dropped, the stream resyncs on the next '#'
+    assert parser.feed(b"518@" + b"0" * 20) == []
+    assert parser.errors == 3
+    assert parser.feed(b";#520@ret:0;#") == [('520', 'ret:0;')]
+    assert parser.errors == 4
+
+
+class PolarisStub:
+    """
+    PolarisStub is an in-process Polaris, it records the commands received and
+    sends the frames pushed by the test.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.received = asyncio.Condition()
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                command = await reader.readuntil(b'#')
+                async with self.received:
+                    self.commands.append(command.decode())
+                    self.received.notify_all()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+
+    async def wait_commands(self, count):
+        async with self.received:
+            await asyncio.wait_for(self.received.wait_for(lambda: len(self.commands) >= count), 1)
+
+    def reply(self, frames):
+        for writer in self.writers:
+            writer.write(frames.encode())
+
+
+async def connect(stub):
+    client = await PolarisClient.connect('127.0.0.1', await stub.start(), timeout=1)
+    return (client, asyncio.create_task(client.run()))
+
+
+def run_with_stub(test):
+    async def run():
+        stub = PolarisStub()
+        (client, reader) = await connect(stub)
+        try:
+            return await test(stub, client)
+        finally:
+            reader.cancel()
+            client.close()
+            await stub.stop()
+    return asyncio.run(run())
+
+
+def test_replies_matched_in_fifo_order():
+    async def test(stub, client):
+        first = asyncio.create_task(client.request('284', polaris_command('284').encode()))
+        second = asyncio.create_task(client.request('284', polaris_command('284').encode()))
+        battery = asyncio.create_task(client.request('778', polaris_command('778').encode()))
+        await stub.wait_commands(3)
+        # one coalesced segment, the 778 reply in the middle
+        stub.reply("284@mode:8;state:0;#778@capacity:90;charge:0;#284@mode:1;state:0;#")
+        return await asyncio.gather(first, second, battery)
+
+    (first, second, battery) = run_with_stub(test)
+    assert (first.mode, second.mode) == (8, 1)
+    assert battery.capacity == 90
+
+
+def test_multiple_replies_until_final():
+    async def test(stub, client):
+        started = []
+        goto = asyncio.create_task(client.request('519', POLARIS_COMMANDS['519'].encode(1, 10, 45, 44.5, 1, 0, 4.42),
+                                                  final=polaris_goto_done, on_reply=started.append))
+        await stub.wait_commands(1)
+        stub.reply("519@ret:1;track:0;#")
+        await asyncio.sleep(0.05)
+        assert not goto.done()
+        stub.reply("519@ret:0;track:1;#")
+        return (await goto, started)
+
+    (reply, started) = run_with_stub(test)
+    assert [reply.ret for reply in started] == [1]
+    assert (reply.ret, reply.track) == (0, 1)
+
+
+def test_timeout_late_reply_dropped():
+    async def test(stub, client):
+        with pytest.raises(asyncio.TimeoutError):
+            await client.request('284', polaris_command('284').encode(), timeout=0.05)
+        second = asyncio.create_task(client.request('284', polaris_command('284').encode()))
+        await stub.wait_commands(2)
+        # the late reply to the first request then the reply to the second one
+        stub.reply("284@mode:1;#")
+        stub.reply("284@mode:8;#")
+        return (await second, client)
+
+    (reply, client) = run_with_stub(test)
+    assert reply.mode == 8
+    assert client.late == 1
+    assert not client.pending['284']
+
+
+def test_cancelled_goto_late_replies_dropped():
+    async def test(stub, client):
+        msg = POLARIS_COMMANDS['519'].encode(1, 10, 45, 44.5, 1, 0, 4.42)
+        first = asyncio.create_task(client.request('519', msg, final=polaris_goto_done))
+        await stub.wait_commands(1)
+        stub.reply("519@ret:1;#")
+        await asyncio.sleep(0.05)
+        first.cancel()
+        second = asyncio.create_task(client.request('519', msg, final=polaris_goto_done))
+        await stub.wait_commands(2)
+        # the end of the first goto doesn't complete the second one
+        stub.reply("519@ret:0;#519@ret:1;#")
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        stub.reply("519@ret:0;track:1;#")
+        return await second
+
+    assert run_with_stub(test).track == 1
+
+
+def test_forgotten_request_released_when_its_reply_is_lost():
+    async def test(stub, client):
+        with pytest.raises(asyncio.TimeoutError):
+            await client.request('775', polaris_command('775').encode(), timeout=0.05)
+        # the late reply never comes, the place is released after another timeout
+        await asyncio.sleep(0.1)
+        second = asyncio.create_task(client.request('775', polaris_command('775').encode()))
+        await stub.wait_commands(2)
+        stub.reply("775@status:1;totalspace:100;freespace:20;usespace:80;#")
+        return (await second, client)
+
+    (reply, client) = run_with_stub(test)
+    assert reply.free == 20
+    assert client.late == 0
+
+
+def test_forget_unsent_request_expects_no_reply():
+    async def test(stub, client):
+        request = client.expect('284')
+        client.forget(request, sent=False)
+        assert request.future.cancelled()
+        second = asyncio.create_task(client.request('284', polaris_command('284').encode()))
+        await stub.wait_commands(1)
+        stub.reply("284@mode:8;#")
+        return await second
+
+    assert run_with_stub(test).mode == 8
+
+
+def test_close_fails_pending_requests():
+    async def test(stub, client):
+        request = asyncio.create_task(client.request('284', polaris_command('284').encode()))
+        await stub.wait_commands(1)
+        for writer in stub.writers:
+            writer.close()
+        with pytest.raises(ConnectionError):
+            await request
+        with pytest.raises(ConnectionError):
+            client.expect('284')
+
+    run_with_stub(test)
+
+
+def goto_commands(stub):
+    return [command for command in stub.commands if command.startswith('1&519&')]
+
+
+async def wait_gotos(stub, count):
+    async with stub.received:
+        await asyncio.wait_for(stub.received.wait_for(lambda: len(goto_commands(stub)) >= count), 1)
+
+
+def test_scheduler_drops_waiting_target():
+    async def test(stub, client):
+        scheduler = GotoScheduler(client, site=PolarisSite(44.5, 4.42))
+        scheduler.submit(10, 30)
+        scheduler.submit(20, 40)
+        task = asyncio.create_task(scheduler.run())
+        await wait_gotos(stub, 1)
+        stub.reply("519@ret:1;#519@ret:0;track:1;#")
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return (scheduler, goto_commands(stub))
+
+    (scheduler, gotos) = run_with_stub(test)
+    # only the newest target is sent
+    assert len(gotos) == 1 and 'yaw:-20.00000;pitch:40.00000;' in gotos[0]
+    assert scheduler.stats()['dropped'] == 1
+    assert scheduler.completed == 1 and scheduler.tracking_active
+
+
+def test_scheduler_superseded_goto_late_reply_discarded():
+    async def test(stub, client):
+        scheduler = GotoScheduler(client, site=PolarisSite(44.5, 4.42))
+        task = asyncio.create_task(scheduler.run())
+        scheduler.submit(10, 30)
+        await wait_gotos(stub, 1)
+        stub.reply("519@ret:1;#")
+        await asyncio.sleep(0.05)
+        scheduler.submit(20, 40)
+        await wait_gotos(stub, 2)
+        # the end of the superseded slew
+        stub.reply("519@ret:0;track:1;#")
+        await asyncio.sleep(0.05)
+        states = [(scheduler.slewing, scheduler.completed, scheduler.tracking_active)]
+        stub.reply("519@ret:1;#519@ret:0;track:1;#")
+        await asyncio.sleep(0.05)
+        states.append((scheduler.slewing, scheduler.completed, scheduler.tracking_active))
+        task.cancel()
+        return (scheduler, states, client)
+
+    (scheduler, states, client) = run_with_stub(test)
+    assert states == [(True, 0, False), (False, 1, True)]
+    assert scheduler.superseded == 1
+    assert client.late == 1
+
+
+def test_scheduler_resumes_interrupted_goto_where_the_object_is():
+    async def run():
+        site = PolarisSite(44.5, 4.42)
+        scheduler = GotoScheduler(None, site=site)
+        t = time.time() - 30
+        (ra, dec) = site.transform().azalt_to_radec(radians(120), radians(45), t)
+        scheduler.interrupted = (120.0, 45.0, t)
+        await scheduler.resume(None)
+        (az, alt) = site.transform().radec_to_azalt(ra, dec, scheduler.target_time)
+        return (scheduler, (degrees(az), degrees(alt)))
+
+    (scheduler, now) = asyncio.run(run())
+    assert scheduler.interrupted is None
+    assert scheduler.target == pytest.approx(now, abs=1e-6)
+    # 30 seconds of sidereal motion, a few arc minutes
+    assert abs(scheduler.target[0] - 120) > 0.05
+
+
+def test_heading_decoded_by_key():
+    client = PolarisClient()
+    bus = TelemetryBus(client)
+    bus.on_frame("w:0.33;x:-0.44;y:-0.80;z:-0.19;w:-0.19;x:-0.44;y:-0.80;z:-0.33;compass:148.72;alt:-44.66;")
+    # a field added ahead of the compass doesn't shift it
+    bus.on_frame("w:0.33;x:-0.44;y:-0.80;z:-0.19;w:-0.19;x:-0.44;y:-0.80;z:-0.33;roll:1.5;compass:150.0;alt:-45.0;")
+    assert bus.count == 2
+    assert bus.latest().azalt() == pytest.approx((150.0, 45.0))
+    bus.on_frame("w:0.33;x:-0.44;y:-0.80;z:-0.19;alt:-45.0;")
+    bus.on_frame("w:0.33;x:-0.44;y:-0.80;z:-0.19;compass:abc;alt:-45.0;")
+    assert (bus.count, bus.errors) == (2, 2)
+
+
+def test_scheduler_slewing_until_the_abort_goto_ends():
+    async def test(stub, client):
+        scheduler = GotoScheduler(client, site=PolarisSite(44.5, 4.42))
+        abort = asyncio.create_task(scheduler.abort((10.0, 30.0)))
+        await wait_gotos(stub, 1)
+        states = [scheduler.slewing]
+        stub.reply("519@ret:1;#")
+        await asyncio.sleep(0.05)
+        states.append(scheduler.slewing)
+        stub.reply("519@ret:0;track:0;#")
+        await abort
+        states.append(scheduler.slewing)
+        return (scheduler, states)
+
+    (scheduler, states) = run_with_stub(test)
+    assert states == [True, True, False]
+    assert scheduler.aborted == 1
@@ -0,0 +1,31 @@
+import pytest
+
+from polaris_plan import PlanTarget, plan_order, slew_distance
+from polaris_stellarium import PolarisClient, SlewPlanner, TelemetryBus
+
+
+def planner(yaw_limit):
+    return SlewPlanner(TelemetryBus(PolarisClient()), yaw_limit)
+
+
+def fixed_target(name, az, alt, times):
+    target = PlanTarget(name, 0.0, 0.0, 60)
+    target.az = [az] * len(times)
+    target.alt = [alt] * len(times)
+    return target
+
+
+def test_slew_distance_in_yaw():
+    # az 179 is yaw -179, az 182 is across the ±180° yaw
+    assert slew_distance(planner(180), (-179.0, 40.0), (182.0, 40.0)) == pytest.approx((357.0, 178.0))
+    assert slew_distance(planner(270), (-179.0, 40.0), (182.0, 40.0)) == pytest.approx((3.0, -182.0))
+    assert slew_distance(planner(180), (-179.0, 40.0), (170.0, 50.0)) == pytest.approx((10.0, -170.0))
+
+
+@pytest.mark.parametrize('yaw_limit, order', [(180, ['west', 'east']), (270, ['east', 'west'])])
+def test_plan_order_across_the_yaw_seam(yaw_limit, order):
+    times = [0.0, 3600.0]
+    targets = [fixed_target('east', 182.0, 40.0, times), fixed_target('west', 170.0, 40.0, times)]
+    (planned, skipped) = plan_order(targets, times, 0.0, (-179.0, 40.0), planner(yaw_limit))
+    assert [target.name for (target, t, slew) in planned] == order
+    assert skipped == []
@@ -0,0 +1,218 @@
+import asyncio
+import json
+from math import radians
+from urllib.parse import parse_qsl
+
+import pytest
+
+from stellarium_alpaca import AlpacaBackend, AlpacaClient, AlpacaError, alpaca_goto
+
+
+class AlpacaStub:
+    """
+    AlpacaStub is an in-process Alpaca telescope server, it answers the device
+    methods over HTTP/1.1 keep-alive connections and records every request.
+    """
+
+    def __init__(self):
+        self.values = {'slewing': False, 'rightascension': 5.5, 'declination': 22.0}
+        self.errors = {}
+        self.statuses = {}
+        self.delays = {}
+        self.keep_alive = True
+        self.close_silently = False
+        self.requests = []
+        self.connections = 0
+        self.server_transaction_id = 0
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        connection = self.connections
+        self.writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                (method, target, _) = lines[0].split(' ')
+                headers = {name.strip().lower(): value.strip() for (name, _, value) in (line.partition(':') for line in lines[1:] if line)}
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                (path, _, query) = target.partition('?')
+                name = path.rsplit('/', 1)[1]
+                params = dict(parse_qsl(query if method == 'GET' else body.decode()))
+                self.requests.append((connection, method, name, params))
+                await asyncio.sleep(self.delays.get(name, 0))
+                (status, content) = self.answer(method, name, params)
+                head = (f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\n")
+                if not self.keep_alive:
+                    head += "Connection: close\r\n"
+                writer.write((head + "\r\n").encode() + content)
+                await writer.drain()
+                if not self.keep_alive or self.close_silently:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def answer(self, method, name, params):
+        if name in self.statuses:
+            return (self.statuses[name], f"Invalid request {name}".encode())
+        self.server_transaction_id += 1
+        reply = {'ClientTransactionID': int(params.get('ClientTransactionID', 0)),
+                 'ServerTransactionID': self.server_transaction_id, 'ErrorNumber': 0, 'ErrorMessage': ''}
+        if name in self.errors:
+            (reply['ErrorNumber'], reply['ErrorMessage']) = self.errors[name]
+        elif method == 'PUT' and name == 'slewtocoordinatesasync':
+            self.values['rightascension'] = float(params['RightAscension'])
+            self.values['declination'] = float(params['Declination'])
+        elif method == 'GET' and name in self.values:
+            reply['Value'] = self.values[name]
+        else:
+            (reply['ErrorNumber'], reply['ErrorMessage']) = (0x400, f"{method} {name} not implemented")
+        return (200, json.dumps(reply).encode())
+
+
+def run_with_stub(test, **options):
+    # runs test(stub, client) against a fresh stub server
+    async def run():
+        stub = AlpacaStub()
+        port = await stub.start()
+        client = AlpacaClient('127.0.0.1', port, **options)
+        try:
+            return await test(stub, client)
+        finally:
+            await client.close()
+            await stub.stop()
+
+    return asyncio.run(run())
+
+
+def test_goto():
+    async def test(stub, client):
+        await alpaca_goto(client, 18.6, 38.8)
+        return stub
+
+    stub = run_with_stub(test)
+    [(_, method, name, params)] = stub.requests
+    assert (method, name) == ('PUT', 'slewtocoordinatesasync')
+    assert (float(params['RightAscension']), float(params['Declination'])) == (18.6, 38.8)
+    assert (stub.values['rightascension'], stub.values['declination']) == (18.6, 38.8)
+
+
+def test_position_polling():
+    async def test(stub, client):
+        backend = AlpacaBackend('127.0.0.1', client.port)
+        assert backend.position() is None
+        await backend.poll()
+        stub.values.update(slewing=True, rightascension=6.75, declination=-16.7)
+        await backend.poll()
+        position = backend.position()
+        stats = backend.stats()
+        await backend.close()
+        return (position, stats, stub.connections)
+
+    (position, stats, connections) = run_with_stub(test)
+    assert position == pytest.approx((radians(6.75 * 15), radians(-16.7)))
+    assert stats['slewing'] is True
+    # the 3 concurrent GETs of a poll, reused by the next one
+    assert stats['connections'] == connections == 3
+
+
+def test_keep_alive_pool():
+    async def test(stub, client):
+        for _ in range(10):
+            assert await client.get('declination') == 22.0
+        await asyncio.gather(*(client.get('slewing') for _ in range(10)))
+        return stub
+
+    stub = run_with_stub(test, pool_size=2)
+    assert stub.connections == 2
+    assert [connection for (connection, _, _, _) in stub.requests[:10]] == [1] * 10
+
+
+def test_connection_close():
+    async def test(stub, client):
+        stub.keep_alive = False
+        for _ in range(3):
+            await client.get('slewing')
+        return (stub.connections, client.connections, len(client.idle))
+
+    assert run_with_stub(test) == (3, 3, 0)
+
+
+def test_idle_connection_closed_by_the_server():
+    async def test(stub, client):
+        stub.close_silently = True
+        assert await client.get('rightascension') == 5.5
+        await asyncio.sleep(0.05)
+        # the pooled connection is dead, the request is sent again on a new one
+        assert await client.get('rightascension') == 5.5
+        return stub.connections
+
+    assert run_with_stub(test) == 2
+
+
+def test_transaction_ids():
+    async def test(stub, client):
+        await client.get('slewing')
+        await client.put('slewtocoordinatesasync', RightAscension=1.0, Declination=2.0)
+        await client.get('declination')
+        return stub
+
+    stub = run_with_stub(test, client_id=42)
+    ids = [int(params['ClientTransactionID']) for (_, _, _, params) in stub.requests]
+    assert ids == [ids[0], ids[0] + 1, ids[0] + 2]
+    assert {params['ClientID'] for (_, _, _, params) in stub.requests} == {'42'}
+
+
+def test_error_number():
+    async def test(stub, client):
+        stub.errors['slewtocoordinatesasync'] = (0x40b, "Declination out of range")
+        with pytest.raises(AlpacaError) as error:
+            await client.put('slewtocoordinatesasync', RightAscension=1.0, Declination=95.0)
+        # the connection stays usable after an Alpaca error
+        assert await client.get('slewing') is False
+        return (error.value, stub.connections)
+
+    (error, connections) = run_with_stub(test)
+    assert error.number == 0x40b
+    assert "Declination out of range" in str(error)
+    assert connections == 1
+
+
+def test_http_error():
+    async def test(stub, client):
+        stub.statuses['rightascension'] = 400
+        with pytest.raises(AlpacaError) as error:
+            await client.get('rightascension')
+        return error.value
+
+    error = run_with_stub(test)
+    assert error.number == 400
+    assert "Invalid request rightascension" in str(error)
+
+
+def test_timeout():
+    async def test(stub, client):
+        stub.delays['slewing'] = 1.0
+        with pytest.raises(asyncio.TimeoutError):
+            await client.get('slewing')
+        del stub.delays['slewing']
+        # the connection of the timed out request is not reused
+        assert await client.get('slewing') is False
+        return stub.connections
+
+    assert run_with_stub(test, timeout=0.1) == 2
@@ -0,0 +1,106 @@
+import asyncio
+import struct
+
+import pytest
+
+from stellarium_core import MountBackend, MountSetupError, StellariumServer, serve_mount
+
+
+class RecordingBackend(MountBackend):
+    name = "recording"
+
+    def __init__(self):
+        self.gotos = []
+        self.moved = asyncio.Event()
+
+    async def run(self):
+        await asyncio.Event().wait()
+
+    async def goto(self, ra, dec, t):
+        self.gotos.append(t)
+        self.moved.set()
+
+    def position(self):
+        return None
+
+
+def goto_packet(t):
+    return struct.pack('<HHqIi', 20, 0, int(t * 1E6), 0, 0)
+
+
+async def send_goto(backend, writer, t):
+    backend.moved.clear()
+    writer.write(goto_packet(t))
+    await writer.drain()
+    # a rejected goto never moves the backend, let the server read it
+    try:
+        await asyncio.wait_for(backend.moved.wait(), 0.2)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def run_policy(policy, timeout=300.0):
+    backend = RecordingBackend()
+    server = StellariumServer(backend, 0, rate=0, policy=policy, timeout=timeout)
+    local_server = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+    port = local_server.sockets[0].getsockname()[1]
+    (_, first) = await asyncio.open_connection('127.0.0.1', port)
+    (_, second) = await asyncio.open_connection('127.0.0.1', port)
+    await send_goto(backend, first, 1)
+    await send_goto(backend, second, 2)
+    first.close()
+    await first.wait_closed()
+    await asyncio.sleep(0.1)
+    await send_goto(backend, second, 3)
+    second.close()
+    await second.wait_closed()
+    local_server.close()
+    await local_server.wait_closed()
+    return (backend, server)
+
+
+def test_last_policy():
+    (backend, server) = asyncio.run(run_policy('last'))
+    assert backend.gotos == [1, 2, 3]
+    assert server.rejected == 0
+
+
+def test_lock_policy():
+    (backend, server) = asyncio.run(run_policy('lock'))
+    # the second client only moves the mount once the first one is gone
+    assert backend.gotos == [1, 3]
+    assert server.rejected == 1
+    assert server.owner is None
+
+
+def test_lock_released_after_timeout():
+    (backend, server) = asyncio.run(run_policy('lock', timeout=0))
+    assert backend.gotos == [1, 2, 3]
+
+
+class FailingBackend(RecordingBackend):
+    name = "failing"
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+        self.runs = 0
+
+    async def run(self):
+        self.runs += 1
+        raise self.error
+
+
+def test_mount_error_restarts():
+    backend = FailingBackend(ConnectionError("lost"))
+    server = StellariumServer(backend, 0, rate=0)
+    asyncio.run(serve_mount(server, retry_min=0, retries=2))
+    assert backend.runs == 3
+
+
+def test_mount_setup_error_stops():
+    backend = FailingBackend(MountSetupError("not in astro mode"))
+    server = StellariumServer(backend, 0, rate=0)
+    with pytest.raises(MountSetupError):
+        asyncio.run(serve_mount(server, retry_min=0))
+    assert backend.runs == 1